@@ -0,0 +1,268 @@
+# Jack O'Connor
+# Pygame Chess Project
+# AsyncChessServer.py
+
+import asyncio
+import os
+import random
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from ChessProtocol import *
+from ChessBook import OpeningBook
+from ChessJournal import GameStore
+from ChessMatchmaking import Matchmaker, Ratings
+from ChessMetrics import METRICS, serveMetrics
+from ChessServer import BotPlayer, ChessGamesObject, ClientSession, SpectatorSession, log, logMatch, pruneClients, recordResult, registerGauges
+from ChessTablebase import Tablebase
+
+
+class AsyncClient(ClientSession):
+
+    # A player connection served by the event loop, requests are handled on the server's executor
+
+    def __init__(self, reader, writer, loop, executor, game_object, game_id, team, version=TEXT_PROTOCOL, frame_reader=None, board_delay=1.0):
+        self.reader, self.writer = reader, writer
+        self.frame_reader = frame_reader or FrameReader()
+        self.loop, self.executor = loop, executor
+        self.client_address = writer.get_extra_info('peername')
+        super().__init__(game_object, game_id, team, version)
+
+        self.loop.call_later(board_delay, self.sendStartingBoard)
+
+    async def handleClient(self):
+        try:
+            while self.active:
+                try:
+                    data = await self.reader.read(4096 if self.version else 64)
+                except OSError:
+                    break
+                METRICS.count('bytes_received_total', len(data))
+                if self.version:
+                    if not data: break
+                    for (msg_type, payload) in self.frame_reader.feed(data):
+                        if msg_type == DISCONNECT or not self.active: self.active = False; break
+                        await self.loop.run_in_executor(self.executor, self.handleFrame, msg_type, payload)
+                    continue
+
+                msg = data.decode(errors='replace')
+                log.debug(f'[MESSAGE] Game {self.game_id} team {self.team}: {msg}')
+                if not msg or msg == '!DISCONNECT': break
+
+                await self.loop.run_in_executor(self.executor, self.handleMsg, msg)
+        finally:
+            self.active = False
+            self.writer.close()
+
+    def sendBytes(self, data):
+        # Safe to call from executor and bot threads, the write itself happens on the loop
+        METRICS.count('bytes_sent_total', len(data))
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def endConnection(self):
+        self.sendBytes(encodeFrame(DISCONNECT) if self.version else b'!DISCONNECT')
+        self.active = False
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+
+# Bytes a spectator's transport may hold unsent before updates to it are skipped until it catches up
+SPECTATOR_BUFFER = 64 * 1024
+
+
+class AsyncSpectator(SpectatorSession):
+
+    # The transport's write buffer is the spectator's bounded queue: past SPECTATOR_BUFFER updates are dropped,
+    # and once there is room again the next one is replaced by the whole position. Whole positions need the game's
+    # lock, so they are built by the pushing thread or on the executor, never on the loop, which only writes bytes.
+    # Call watch() off the loop to start.
+
+    def __init__(self, reader, writer, loop, game_object, game_id, version=TEXT_PROTOCOL, frame_reader=None):
+        self.stream_reader, self.writer, self.loop = reader, writer, loop
+        self.reader = frame_reader or FrameReader()
+        super().__init__(game_object, game_id, version)
+        self.behind = self.resyncing = False
+
+    def push(self, data):
+        full = data is None
+        if full: data = self.fullUpdate()
+        self.loop.call_soon_threadsafe(self.write, data, full)
+
+    def resync(self):
+        # Called on the loop
+        self.loop.run_in_executor(None, self.push, None)
+
+    def write(self, data, full=False):
+        if self.writer.is_closing(): return
+        if self.writer.transport.get_write_buffer_size() > SPECTATOR_BUFFER:
+            self.behind = True
+            return
+        if self.behind and not full:
+            # Moves missed while behind are replaced by a whole position, until it arrives the rest are dropped too
+            if not self.resyncing:
+                self.resyncing = True
+                self.resync()
+            return
+        if full: self.behind = self.resyncing = False
+        METRICS.count('bytes_sent_total', len(data))
+        self.writer.write(data)
+
+    async def handleClient(self):
+        while self.active:
+            try:
+                data = await self.stream_reader.read(4096)
+            except OSError:
+                break
+            METRICS.count('bytes_received_total', len(data))
+            if not self.handleData(data): break
+        self.endConnection()
+
+    def endConnection(self):
+        if not self.active: return
+        self.active = False
+        self.game_object.removeSpectator(self.game_id, self)
+        self.loop.call_soon_threadsafe(self.writer.write, encodeFrame(DISCONNECT) if self.version else b'!DISCONNECT')
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncChessServer:
+
+    def __init__(self, host, port, max_conns, move_cache_size=10000, bot_wait=0, bot_time=500, bot_threads=2, workers=4, hello_timeout=0.5,
+                 data_dir='saved_games', fsync_interval=50, metrics_port=0, book=None, tablebases=None, idle_timeout=300, max_resident_games=0):
+        self.host, self.port, self.max_conns = host, port, max_conns
+        self.bot_wait, self.bot_time = bot_wait, bot_time
+        self.hello_timeout = hello_timeout
+        self.bot_executor = ThreadPoolExecutor(max_workers=bot_threads)
+        self.book = OpeningBook(book) if book else None
+        self.tablebase = Tablebase(tablebases) if tablebases else None
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        store = GameStore(data_dir, fsync_interval / 1000)
+        log.info(f'Starting with {len(store.statuses)} saved games')
+        self.chess_games = ChessGamesObject(games={}, move_cache_size=move_cache_size, store=store,
+                                            on_finish=lambda *result: recordResult(self.ratings, *result),
+                                            idle_timeout=idle_timeout, max_resident=max_resident_games, bot_factory=self.startBot)
+        self.clients = []
+        self.ratings = Ratings(os.path.join(data_dir, 'ratings.json'))
+        self.matchmaker = Matchmaker(self.pairPlayers, self.pairWithBot, bot_wait, self.evictPlayer)
+        registerGauges(self)
+        if metrics_port:
+            serveMetrics(metrics_port)
+            log.info(f'Serving metrics on 127.0.0.1 at port {metrics_port}')
+
+        try:
+            asyncio.run(self.listenForClients())
+        except KeyboardInterrupt:
+            log.info('Exiting...')
+        store.close()
+
+
+    async def listenForClients(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handleClient, self.host, self.port, backlog=self.max_conns)
+        log.info(f'Accepting clients on {self.host} at port {self.port} (asyncio)')
+        async with server:
+            await server.serve_forever()
+
+    async def handleClient(self, reader, writer):
+        METRICS.count('connections_total')
+        log.info(f'[CONNECTION] New connection to {writer.get_extra_info("peername")[0]}')
+        (version, frame_reader, name, spectate, resume) = await self.negotiateProtocol(reader, writer)
+        if spectate is not None:
+            await self.startSpectating(spectate, reader, writer, version, frame_reader)
+            return
+        if resume is not None:
+            await self.resumeGame(resume, reader, writer, version, frame_reader)
+            return
+        seat = self.loop.create_future()
+        writer.write(waitingMsg(version))
+        self.matchmaker.join(seat, name, self.ratings.get(name), lambda: not reader.at_eof() and reader.exception() is None)
+
+        # The matchmaker resolves the seat with (game_id, team), or None if the client left while waiting
+        if await seat is None:
+            writer.close()
+            return
+        (game_id, team) = seat.result()
+        writer.write(enteringMsg(version, game_id, team))
+        client = AsyncClient(reader, writer, self.loop, self.executor, self.chess_games, game_id, team, version, frame_reader)
+        pruneClients(self.clients)
+        self.clients.append(client)
+        await client.handleClient()
+
+    async def negotiateProtocol(self, reader, writer):
+        # Same as ChessServer.negotiateProtocol: a HELLO frame within the timeout, or the text protocol
+        frame_reader = FrameReader()
+        try:
+            data = await asyncio.wait_for(reader.read(64), self.hello_timeout)
+            if data.startswith(b'SPECTATE:') and data[9:].strip().isdigit():
+                return TEXT_PROTOCOL, None, None, int(data[9:]), None
+            if data[:1] == b'\x00':
+                frames = frame_reader.feed(data)
+                while not frames and data:
+                    data = await asyncio.wait_for(reader.read(64), self.hello_timeout)
+                    frames = frame_reader.feed(data)
+                version = parseHello(frames[0][1]) if frames and frames[0][0] in (HELLO, SPECTATE, RESUME) else None
+                if version is not None:
+                    version = min(version, PROTOCOL_VERSION)
+                    writer.write(encodeFrame(WELCOME, bytes([version])))
+                    if frames[0][0] == SPECTATE: return version, frame_reader, None, spectateId(frames[0][1]), None
+                    if frames[0][0] == RESUME: return version, frame_reader, None, None, resumeToken(frames[0][1])
+                    return version, frame_reader, helloName(frames[0][1]), None, None
+        except (asyncio.TimeoutError, OSError, struct.error):
+            pass
+        return TEXT_PROTOCOL, None, None, None, None
+
+    async def startSpectating(self, game_id, reader, writer, version, frame_reader):
+        # Loading a saved game replays its journal, so it runs on the executor
+        game = await self.loop.run_in_executor(self.executor, self.chess_games.getGame, game_id)
+        if game is None:
+            writer.write(encodeFrame(DISCONNECT) if version else b'!DISCONNECT')
+            writer.close()
+            return
+        log.info(f'[SPECTATE] {writer.get_extra_info("peername")[0]} watching game {game_id}')
+        writer.write(enteringMsg(version, game_id, 0))
+        spectator = AsyncSpectator(reader, writer, self.loop, self.chess_games, game_id, version, frame_reader)
+        await self.loop.run_in_executor(self.executor, spectator.watch)
+        pruneClients(self.clients)
+        self.clients.append(spectator)
+        await spectator.handleClient()
+
+    async def resumeGame(self, token, reader, writer, version, frame_reader):
+        # A hibernated game is loaded again from its journal, so this runs on the executor too
+        seat = await self.loop.run_in_executor(self.executor, self.chess_games.resumeSeat, token)
+        if seat is None:
+            writer.write(encodeFrame(DISCONNECT))
+            writer.close()
+            return
+        (game_id, team) = seat
+        log.info(f'[RESUME] {writer.get_extra_info("peername")[0]} back in game {game_id} as team {team}')
+        writer.write(enteringMsg(version, game_id, team))
+        client = AsyncClient(reader, writer, self.loop, self.executor, self.chess_games, game_id, team, version, frame_reader, board_delay=0)
+        pruneClients(self.clients)
+        self.clients.append(client)
+        await client.handleClient()
+
+    def startBot(self, game_id, team):
+        return BotPlayer(self.chess_games, game_id, team, self.bot_executor, self.bot_time, self.book, self.tablebase)
+
+    # Matchmaker callbacks come from the loop thread or the matchmaker's ticker thread, seats are resolved on the loop
+
+    def pairPlayers(self, first, second):
+        self.startGame([(1, first), (-1, second)])
+
+    def pairWithBot(self, ticket):
+        team = random.choice([1, -1])
+        self.startGame([(team, ticket)], bot_team=-team)
+
+    def evictPlayer(self, ticket):
+        log.info(f'[MATCH] Dropped {ticket.name or "anonymous"} from the queue after it disconnected')
+        self.loop.call_soon_threadsafe(ticket.player.set_result, None)
+
+    def startGame(self, tickets, bot_team=None):
+        game_id = self.chess_games.nextGameId()
+        self.chess_games.createGame(game_id, None, None, {team: ticket.name for (team, ticket) in tickets}, bot_team)
+        logMatch(game_id, tickets, self.matchmaker)
+        if bot_team is not None:
+            log.info(f'[BOT] Game {game_id} against the computer')
+            self.startBot(game_id, bot_team)
+        for (team, ticket) in tickets:
+            self.loop.call_soon_threadsafe(ticket.player.set_result, (game_id, team))
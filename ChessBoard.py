@@ -2,180 +2,560 @@
 # Pygame Chess Project
 # ChessBoard.py
 
-import numpy as np
 import copy
+import random
+import threading
+from array import array
+from collections import namedtuple, OrderedDict
+
+
+WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE = 1, 2, 4, 8
+ALL_CASTLING = WHITE_KINGSIDE | WHITE_QUEENSIDE | BLACK_KINGSIDE | BLACK_QUEENSIDE
+
+NORMAL, DOUBLE_PUSH, EN_PASSANT, CASTLE, PROMOTION = range(5)
+
+START_SQUARES = [-5, -4, -3, -2, -1, -3, -4, -5] + [-6]*8 + [0]*32 + [6]*8 + [5, 4, 3, 2, 1, 3, 4, 5]
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+FEN_PIECES = {'k': 1, 'q': 2, 'b': 3, 'n': 4, 'r': 5, 'p': 6}
+FEN_CASTLING = {'K': WHITE_KINGSIDE, 'Q': WHITE_QUEENSIDE, 'k': BLACK_KINGSIDE, 'q': BLACK_QUEENSIDE}
+
+# Same order as the old createMovePath directions: odd entries are diagonals, even are straight lines
+DIRECTIONS = [(-1, -1), (0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0)]
+KNIGHT_OFFSETS = [(1, -2), (-1, -2), (1, 2), (-1, 2), (2, -1), (-2, -1), (2, 1), (-2, 1)]
+
+# Castling rights lost when a piece moves from or to one of these squares
+CASTLING_SQUARES = {56: WHITE_QUEENSIDE, 63: WHITE_KINGSIDE, 60: WHITE_KINGSIDE | WHITE_QUEENSIDE,
+                    0: BLACK_QUEENSIDE, 7: BLACK_KINGSIDE, 4: BLACK_KINGSIDE | BLACK_QUEENSIDE}
+
+# King square -> (castling right, king destination, rook start, rook destination, squares that must be empty)
+CASTLES = {
+    60: [(WHITE_QUEENSIDE, 58, 56, 59, (57, 58, 59)), (WHITE_KINGSIDE, 62, 63, 61, (61, 62))],
+    4: [(BLACK_QUEENSIDE, 2, 0, 3, (1, 2, 3)), (BLACK_KINGSIDE, 6, 7, 5, (5, 6))],
+}
+
+# Ways a game ends, in the order the protocol numbers them
+GAME_OVER_REASONS = ('checkmate', 'stalemate', 'threefold repetition', 'fifty-move rule', 'insufficient material')
+# Plies without a capture or pawn move that draw the game
+FIFTY_MOVE_PLIES = 100
+
+
+def toSquare(pos): return pos[1]*8 + pos[0]
+
+def toPos(square): return (square % 8, square // 8)
+
+
+def createRays():
+    rays = []
+    for square in range(64):
+        (x, y) = toPos(square)
+        square_rays = []
+        for (dx, dy) in DIRECTIONS:
+            ray = []
+            (nx, ny) = (x+dx, y+dy)
+            while 0 <= nx < 8 and 0 <= ny < 8:
+                ray.append(toSquare((nx, ny)))
+                (nx, ny) = (nx+dx, ny+dy)
+            square_rays.append(tuple(ray))
+        rays.append(tuple(square_rays))
+    return tuple(rays)
+
+def createJumps(offsets):
+    jumps = []
+    for square in range(64):
+        (x, y) = toPos(square)
+        jumps.append(tuple(toSquare((x+dx, y+dy)) for (dx, dy) in offsets if 0 <= x+dx < 8 and 0 <= y+dy < 8))
+    return tuple(jumps)
+
+RAYS = createRays()
+KNIGHT_MOVES = createJumps(KNIGHT_OFFSETS)
+KING_MOVES = createJumps(DIRECTIONS)
+# Squares a pawn of each team would have to stand on to attack a given square
+PAWN_ATTACKERS = {1: createJumps([(-1, 1), (1, 1)]), -1: createJumps([(-1, -1), (1, -1)])}
+
+# Zobrist keys, seeded so every process hashes the same position to the same value.
+# Pieces are indexed by value + 6, the empty square row is all zeros.
+zobrist_random = random.Random(0x5EED)
+ZOBRIST_PIECES = tuple(tuple(zobrist_random.getrandbits(64) if value != 0 else 0 for square in range(64)) for value in range(-6, 7))
+ZOBRIST_CASTLING = tuple(zobrist_random.getrandbits(64) for rights in range(16))
+ZOBRIST_EN_PASSANT = tuple(zobrist_random.getrandbits(64) for file in range(8))
+ZOBRIST_TURN = zobrist_random.getrandbits(64)
+
 
 class Piece:
 
     def __init__(self, value):
         self.value = value
         self.team = int(value / abs(value))
-        self.has_moved = False
+
+PIECES = {value: Piece(value) for value in [*range(-6, 0), *range(1, 7)]}
+
+
+class Move(namedtuple('Move', ['start', 'end', 'flag', 'promotion'], defaults=[NORMAL, 0])):
+
+    __slots__ = ()
+
+    @property
+    def startPos(self): return toPos(self.start)
+
+    @property
+    def endPos(self): return toPos(self.end)
+
+
+class BoardView:
+
+    # Read-only board[y][x] access to the compact squares, yielding Piece objects or 0 like the old object array
+
+    def __init__(self, squares):
+        self.squares = squares
+
+    def __len__(self): return 8
+
+    def __getitem__(self, y):
+        if y < 0: y += 8
+        return [PIECES[value] if value != 0 else 0 for value in self.squares[y*8:y*8+8]]
+
+    def __iter__(self):
+        return (self[y] for y in range(8))
+
+
+class MoveCache:
+
+    # Bounded LRU map from position hash to that position's legal moves, shared between boards
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self): return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            moves = self.entries.get(key)
+            if moves is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return moves
+
+    def put(self, key, moves):
+        with self.lock:
+            self.entries[key] = moves
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self.entries), 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses}
 
 
 class ChessBoard:
 
-    def __init__(self, promotionCallback=lambda pos: 2, test=False):
-        self._board = self.createBoard()
+    def __init__(self, promotionCallback=lambda pos: 2, test=False, move_cache=None):
+        self.squares = self.createBoard()
         self.promotionCallback = promotionCallback
         self.test = test
         self.turn = 1
+        self.castling = ALL_CASTLING
+        self.en_passant = None
+        self.history = []
+        self.start_ply = 0
+        self.halfmove_clock = 0
+        self.kings = self.findKings()
+        self.hash = self.computeHash()
+        self.move_cache = move_cache
 
     @property
-    def board(self): return self._board
+    def board(self): return BoardView(self.squares)
 
     @board.getter
-    def board(self): return self._board
+    def board(self): return BoardView(self.squares)
 
 
     def createBoard(self):
-        board = np.zeros((8, 8), object)
-        board[0] = [-5, -4, -3, -2, -1, -3, -4, -5]
-        board[1] = [-6]*8
-        board[-2] = [6]*8
-        board[-1] = [5, 4, 3, 2, 1, 3, 4, 5]
-
-        for i in range(len(board)):
-            board[i] = [Piece(val) if val != 0 else 0 for val in board[i]]
-
-        return board
+        return array('b', START_SQUARES)
+
+    def findKings(self):
+        return {team: self.squares.index(team) if team in self.squares else None for team in (1, -1)}
+
+    def setFEN(self, fen):
+        fields = fen.split()
+        squares = []
+        for char in fields[0].replace('/', ''):
+            if char.isdigit(): squares += [0]*int(char)
+            else: squares.append(FEN_PIECES[char.lower()] * (1 if char.isupper() else -1))
+        if len(squares) != 64: raise ValueError(f'Invalid FEN board: {fields[0]}')
+
+        self.squares = array('b', squares)
+        self.turn = 1 if len(fields) < 2 or fields[1] == 'w' else -1
+        self.castling = 0
+        for char in (fields[2] if len(fields) > 2 else '-'):
+            self.castling |= FEN_CASTLING.get(char, 0)
+        self.en_passant = None
+        if len(fields) > 3 and fields[3] != '-':
+            self.en_passant = toSquare(('abcdefgh'.index(fields[3][0]), 8 - int(fields[3][1])))
+        self.history = []
+        self.halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        self.start_ply = 2 * (int(fields[5]) - 1) + (self.turn == -1) if len(fields) > 5 else 0
+        self.kings = self.findKings()
+        self.hash = self.computeHash()
+
+    def getFEN(self):
+        rows = []
+        for y in range(8):
+            row, empty = '', 0
+            for value in self.squares[y*8:y*8+8]:
+                if value == 0:
+                    empty += 1
+                    continue
+                if empty: row, empty = row + str(empty), 0
+                char = 'kqbnrp'[abs(value)-1]
+                row += char.upper() if value > 0 else char
+            rows.append(row + (str(empty) if empty else ''))
+
+        castling = ''.join(char for (char, right) in FEN_CASTLING.items() if self.castling & right) or '-'
+        en_passant = '-' if self.en_passant is None else 'abcdefgh'[self.en_passant % 8] + str(8 - self.en_passant // 8)
+        fullmove = self.plyCount() // 2 + 1
+        return f"{'/'.join(rows)} {'w' if self.turn == 1 else 'b'} {castling} {en_passant} {self.halfmove_clock} {fullmove}"
+
+    def pack(self):
+        # 67 bytes: the squares, then side to move, castling rights and en passant square (64 for none)
+        return self.squares.tobytes() + bytes([0 if self.turn == 1 else 1, self.castling, 64 if self.en_passant is None else self.en_passant])
+
+    def unpack(self, data):
+        self.squares = array('b')
+        self.squares.frombytes(data[:64])
+        self.turn = 1 if data[64] == 0 else -1
+        self.castling = data[65]
+        self.en_passant = None if data[66] == 64 else data[66]
+        self.history = []
+        self.start_ply = 0
+        self.halfmove_clock = 0
+        self.kings = self.findKings()
+        self.hash = self.computeHash()
+
+    def plyCount(self):
+        # Plies played in the game, including any before the position was set or unpacked
+        return self.start_ply + len(self.history)
+
+    def computeHash(self):
+        key = ZOBRIST_CASTLING[self.castling]
+        for square, value in enumerate(self.squares):
+            key ^= ZOBRIST_PIECES[value+6][square]
+        if self.en_passant is not None: key ^= ZOBRIST_EN_PASSANT[self.en_passant % 8]
+        if self.turn == -1: key ^= ZOBRIST_TURN
+        return key
+
+    def repetitionCount(self):
+        # Times the current position has occurred, comparing hashes of earlier positions with the same side to move.
+        # Nothing before the last capture or pawn move can repeat, so only the halfmove clock's worth of history is read.
+        return 1 + sum(1 for entry in self.history[-2:-self.halfmove_clock-1:-2] if entry[4] == self.hash)
+
+    def insufficientMaterial(self):
+        # Kings alone, with one minor piece, or with only bishops that all stand on one colour of square
+        if self.squares.count(0) < 60: return False
+        others = [(square, abs(value)) for (square, value) in enumerate(self.squares) if abs(value) > 1]
+        if len(others) <= 1: return all(kind in (3, 4) for (square, kind) in others)
+        return all(kind == 3 for (square, kind) in others) and len({(square + square // 8) % 2 for (square, kind) in others}) == 1
+
+    def gameResult(self):
+        # (white's score, reason) once the game is over, else None. The legal moves come from the move cache,
+        # where the next player's move validation will look for them anyway, and the rest only reads counters.
+        if not self.legalMoves():
+            if self.checkForCheck(self.turn): return (0 if self.turn == 1 else 1), 'checkmate'
+            return 0.5, 'stalemate'
+        if self.halfmove_clock >= FIFTY_MOVE_PLIES: return 0.5, 'fifty-move rule'
+        if self.halfmove_clock >= 8 and self.repetitionCount() >= 3: return 0.5, 'threefold repetition'
+        if self.insufficientMaterial(): return 0.5, 'insufficient material'
+        return None
 
 
     def movePiece(self, start, end):
 
-        startPiece = self.board[start[1]][start[0]]
-        if startPiece == 0 or startPiece.team != self.turn:
+        startPiece = self.squares[toSquare(start)]
+        if startPiece == 0 or (startPiece > 0) - (startPiece < 0) != self.turn:
             return
-        possibleMoves, specialMoves = self.getPossibleMoves(start, special=True)
-        if end in possibleMoves:
-            for move in specialMoves:
-                if move['move'] == (start, end):
-                    if move['type'] == 'castle':
-                        for (start_pos, end_pos) in move['additionalMoves']:
-                            self._board[end_pos[1]][end_pos[0]] = self._board[start_pos[1]][start_pos[0]]
-                            self._board[start_pos[1]][start_pos[0]] = 0
-                    elif move['type'] == 'promotion':
-                        if not self.test:
-                            self._board[start[1]][start[0]].value = self._board[start[1]][start[0]].team * self.promotionCallback(end)
-                        else:
-                            self._board[start[1]][start[0]].value = self._board[start[1]][start[0]].team * 2
-
-            self._board[end[1]][end[0]] = self._board[start[1]][start[0]]
-            self._board[start[1]][start[0]] = 0
-            if not self.test: self._board[end[1]][end[0]].has_moved = True
-            self.turn *= -1
+        if self.test:
+            candidates = self.pseudoMoves(toSquare(start))
+        elif self.move_cache is not None:
+            candidates = [move for move in self.legalMoves() if move.start == toSquare(start)]
+        else:
+            candidates = self.generateLegalMoves(self.turn, toSquare(start))
+        moves = [move for move in candidates if move.end == toSquare(end)]
+        if moves:
+            promotion = 0
+            if moves[0].flag == PROMOTION:
+                promotion = 2 if self.test else self.promotionCallback(end)
+
+            self.makeMove(next((move for move in moves if move.promotion == promotion), moves[0]))
         else:
             print("Not a valid move:", start, end)
 
 
+    def makeMove(self, move):
+        squares = self.squares
+        (start, end, flag, promotion) = move
+        piece = squares[start]
+        team = 1 if piece > 0 else -1
+        captured = squares[end]
+        self.history.append((move, captured, self.castling, self.en_passant, self.hash, self.halfmove_clock))
+        self.halfmove_clock = 0 if captured != 0 or piece == 6*team else self.halfmove_clock + 1
+        key = self.hash ^ ZOBRIST_TURN ^ ZOBRIST_PIECES[piece+6][start] ^ ZOBRIST_PIECES[captured+6][end]
+
+        if flag == EN_PASSANT:
+            squares[end + 8*team] = 0
+            key ^= ZOBRIST_PIECES[-6*team+6][end + 8*team]
+        elif flag == PROMOTION:
+            piece = team * promotion
+        elif flag == CASTLE:
+            for (right, king_end, rook_start, rook_end, empty) in CASTLES[start]:
+                if king_end == end:
+                    squares[rook_end] = squares[rook_start]
+                    squares[rook_start] = 0
+                    key ^= ZOBRIST_PIECES[5*team+6][rook_start] ^ ZOBRIST_PIECES[5*team+6][rook_end]
+
+        if self.en_passant is not None: key ^= ZOBRIST_EN_PASSANT[self.en_passant % 8]
+        self.en_passant = (start + end) // 2 if flag == DOUBLE_PUSH else None
+        if self.en_passant is not None: key ^= ZOBRIST_EN_PASSANT[self.en_passant % 8]
+
+        squares[end] = piece
+        squares[start] = 0
+        key ^= ZOBRIST_PIECES[piece+6][end] ^ ZOBRIST_CASTLING[self.castling]
+        if piece == team: self.kings[team] = end
+        if start in CASTLING_SQUARES: self.castling &= ~CASTLING_SQUARES[start]
+        if end in CASTLING_SQUARES: self.castling &= ~CASTLING_SQUARES[end]
+        self.hash = key ^ ZOBRIST_CASTLING[self.castling]
+        self.turn = -team
+
+    def unmakeMove(self):
+        squares = self.squares
+        (move, captured, self.castling, self.en_passant, self.hash, self.halfmove_clock) = self.history.pop()
+        (start, end, flag, promotion) = move
+        team = self.turn = -self.turn
+
+        squares[start] = 6*team if flag == PROMOTION else squares[end]
+        squares[end] = captured
+        if flag == EN_PASSANT:
+            squares[end + 8*team] = -6*team
+        elif flag == CASTLE:
+            for (right, king_end, rook_start, rook_end, empty) in CASTLES[start]:
+                if king_end == end:
+                    squares[rook_start] = squares[rook_end]
+                    squares[rook_end] = 0
+        if squares[start] == team: self.kings[team] = start
+
 
     def getBoardValues(self):
-        return np.array(list(map(lambda l: [item.value if item != 0 else 0 for item in l], self.board)), int)
+        # Only the network client wants the board as an array, so numpy is loaded here rather than with the board
+        import numpy as np
+        return np.array(self.squares, int).reshape((8, 8))
 
 
     def duplicateBoard(self):
-        return copy.deepcopy(self)
+        board = copy.copy(self)
+        board.squares = self.squares[:]
+        board.history = self.history[:]
+        board.kings = dict(self.kings)
+        return board
 
     def checkForCheck(self, team):
-        king = None
-        for y in range(len(self.board)):
-            for x in range(len(self.board[0])):
-                if self.board[y][x] != 0 and self.board[y][x].value == team: king = (x, y)
-
-        for y in range(len(self.board)):
-            if any(king in self.getPossibleMoves((x, y), checking=True) for x in range(len(self.board[0])) if self.board[y][x] != 0): return True
+        king = self.kings[team]
+        if king is None: return False
+        return self.isSquareAttacked(king, -team)
+
+    def isSquareAttacked(self, square, by_team):
+        # Look outward from the square for an attacker instead of generating the attackers' moves
+        squares = self.squares
+        for start in KNIGHT_MOVES[square]:
+            if squares[start] == 4*by_team: return True
+        for start in PAWN_ATTACKERS[by_team][square]:
+            if squares[start] == 6*by_team: return True
+        for start in KING_MOVES[square]:
+            if squares[start] == by_team: return True
+
+        rays = RAYS[square]
+        for d in range(8):
+            for start in rays[d]:
+                value = squares[start]
+                if value != 0:
+                    if value*by_team > 0 and (value*by_team == 2 or value*by_team == (3 if d % 2 == 0 else 5)): return True
+                    break
 
         return False
 
 
-    def getPossibleMoves(self, pos, checking=False, special=False):
+    def findChecksAndPins(self, team):
+        # Squares of the pieces giving check, the squares that block or capture a single checker,
+        # and for each pinned piece the line it may still move along
+        squares = self.squares
+        king = self.kings[team]
+        checkers = []
+        check_mask = set()
+        pins = {}
+
+        for start in KNIGHT_MOVES[king]:
+            if squares[start] == -4*team: checkers.append(start); check_mask.add(start)
+        for start in PAWN_ATTACKERS[-team][king]:
+            if squares[start] == -6*team: checkers.append(start); check_mask.add(start)
+
+        rays = RAYS[king]
+        for d in range(8):
+            sliders = (-2*team, (-3 if d % 2 == 0 else -5)*team)
+            blocker = None
+            for i, square in enumerate(rays[d]):
+                value = squares[square]
+                if value == 0: continue
+                if value*team > 0:
+                    if blocker is not None: break
+                    blocker = square
+                    continue
+                if value in sliders:
+                    line = rays[d][:i+1]
+                    if blocker is None:
+                        checkers.append(square)
+                        check_mask.update(line)
+                    else:
+                        pins[blocker] = line
+                break
+
+        return checkers, check_mask, pins
+
+    def legalMoves(self, team=None):
+        # Like generateLegalMoves, but looked up in and stored to the move cache when the board has one
+        team = self.turn if team is None else team
+        if self.move_cache is None or team != self.turn:
+            return self.generateLegalMoves(team)
+
+        moves = self.move_cache.get(self.hash)
+        if moves is None:
+            moves = tuple(self.generateLegalMoves(team))
+            self.move_cache.put(self.hash, moves)
+        return moves
+
+    def generateLegalMoves(self, team=None, start=None):
+        # Every legal move for team (the side to move by default), or only those of the piece on start
+        team = self.turn if team is None else team
+        squares = self.squares
+        king = self.kings[team]
+        starts = range(64) if start is None else [start]
+        if king is None:
+            return [move for square in starts if squares[square]*team > 0 for move in self.pseudoMoves(square)]
+
+        checkers, check_mask, pins = self.findChecksAndPins(team)
         moves = []
-        specialMoves = []
-        (x, y) = pos
-        piece = self.board[y][x]
-        team = int(piece.value / abs(piece.value))
-
-        if abs(piece.value) == 6:
-            if self.board[y-team][x] == 0:
-                moves.append((x, y-team))
-                if piece.has_moved == False and self.board[y-2*team][x] == 0: moves.append((x, y-2*team))
-            if x < 7 and 0 <= y-team <= 7:
-                if self.board[y-team][x+1] != 0 and self.board[y-team][x+1].team != team: moves.append((x+1, y-team))
-            if x > 0 and 0 <= y-team <= 7:
-                if self.board[y-team][x-1] != 0 and self.board[y-team][x-1].team != team: moves.append((x-1, y-team))
-
-            for move in moves:
-                if move[1] == int(3.5-team*3.5): specialMoves.append({'type':'promotion','move':(pos, move)})
-        elif abs(piece.value) == 5:
-            for i in range(2, 9, 2): moves += self.createMovePath(pos, i)
-        elif abs(piece.value) == 4:
-            moves.append((pos[0]+1, pos[1]-2))
-            moves.append((pos[0]-1, pos[1]-2))
-            moves.append((pos[0]+1, pos[1]+2))
-            moves.append((pos[0]-1, pos[1]+2))
-            moves.append((pos[0]+2, pos[1]-1))
-            moves.append((pos[0]-2, pos[1]-1))
-            moves.append((pos[0]+2, pos[1]+1))
-            moves.append((pos[0]-2, pos[1]+1))
-        elif abs(piece.value) == 3:
-            for i in range(1, 8, 2): moves += self.createMovePath(pos, i)
-        elif abs(piece.value) == 2:
-            for i in range(1, 9): moves += self.createMovePath(pos, i)
-        elif abs(piece.value) == 1:
-            for i in range(-1, 2):
-                for j in range(-1, 2):
-                    if (j, i) != (0, 0): moves.append((x+j, y+i))
-
-            if pos == (4, 0) or pos == (4, 7):
-                for (rookX, mult) in [(0, 1), (7, -1)]:
-                    if self.board[y][rookX] != 0:
-                        if all(i == 0 for i in (self.board[y][min(rookX+mult, x-mult):max(rookX, x)])):
-                            if abs(self.board[y][rookX].value) == 5 and self.board[y][rookX].team == team and self.board[y][rookX].has_moved == False:
-                                moves.append((x - 2*mult, y))
-                                specialMoves.append({'type':'castle','move':(pos, (x - 2*mult, y)),'additionalMoves':[((rookX, y), (x - mult, y))]})
-
-        
-        for move in moves[:]:
-            if 0 > move[0] or move[0] > 7 or 0 > move[1] or move[1] > 7:
-                moves.remove(move)
+        for square in starts:
+            if squares[square]*team <= 0: continue
+
+            if square == king:
+                candidates = self.pseudoMoves(king)
+                squares[king] = 0
+                moves += [move for move in candidates if not self.isSquareAttacked(move.end, -team)]
+                squares[king] = team
                 continue
-            dest = self.board[move[1]][move[0]]
-            if dest != 0:
-                if dest.team == team:
-                    moves.remove(move)
+            if len(checkers) > 1: continue
+
+            pin = pins.get(square)
+            for move in self.pseudoMoves(square):
+                if move.flag == EN_PASSANT:
+                    # Taking en passant removes two pawns from the rank, so it is the one move still tried out
+                    self.makeMove(move)
+                    in_check = self.checkForCheck(team)
+                    self.unmakeMove()
+                    if not in_check: moves.append(move)
                     continue
-            if not checking and not self.test:
-                testBoard = self.duplicateBoard()
-                testBoard.test = True
-                testBoard.movePiece(pos, move)
-                if testBoard.checkForCheck(team):
-                    moves.remove(move)
-
-        if not special:   
+                if checkers and move.end not in check_mask: continue
+                if pin is not None and move.end not in pin: continue
+                moves.append(move)
+
+        return moves
+
+
+    def getPossibleMoves(self, pos, checking=False, special=False):
+        moves = []
+        specialMoves = []
+        start = toSquare(pos)
+        team = 1 if self.squares[start] > 0 else -1
+
+        if checking or self.test:
+            candidates = self.pseudoMoves(start)
+        elif self.move_cache is not None and team == self.turn:
+            candidates = [move for move in self.legalMoves() if move.start == start]
+        else:
+            candidates = self.generateLegalMoves(team, start)
+
+        for move in candidates:
+            # Only the queen promotion stands in for each promoting destination
+            if move.flag == PROMOTION and move.promotion != 2: continue
+
+            end = move.endPos
+            moves.append(end)
+            if move.flag == PROMOTION:
+                specialMoves.append({'type':'promotion','move':(pos, end)})
+            elif move.flag == CASTLE:
+                for (right, king_end, rook_start, rook_end, empty) in CASTLES[start]:
+                    if king_end == move.end:
+                        specialMoves.append({'type':'castle','move':(pos, end),'additionalMoves':[(toPos(rook_start), toPos(rook_end))]})
+            elif move.flag == EN_PASSANT:
+                specialMoves.append({'type':'en passant','move':(pos, end),'capture':toPos(move.end + 8*team)})
+
+        if not special:
             return moves
         else:
             return moves, specialMoves
 
 
-    def createMovePath(self, pos, direction):
+    def pseudoMoves(self, start):
+        # All moves for the piece on start, ignoring whether its own king is left in check
+        squares = self.squares
+        piece = squares[start]
+        team = 1 if piece > 0 else -1
+        kind = abs(piece)
         moves = []
-        (x, y) = pos
-        piece = self.board[y][x]
-
-        for i in range(1, 9):
-            neighbor_list = [(x-i, y-i), (x, y-i), (x+i, y-i), (x+i, y), (x+i, y+i), (x, y+i), (x-i, y+i), (x-i, y)]
-            moves.append(neighbor_list[direction-1])
-
-        path = []
-        for move in moves[:]:
-            if 0 > move[0] or move[0] > 7 or 0 > move[1] or move[1] > 7: break
-            movePiece = self.board[move[1]][move[0]]
-
-            if movePiece == 0:
-                path.append(move)
-            else:
-                if movePiece.team != piece.team:
-                    path.append(move)
-                break
 
-        return path
+        if kind == 6:
+            (x, y) = toPos(start)
+            forward = start - 8*team
+            last_rank = (team == 1 and y == 1) or (team == -1 and y == 6)
+            targets = []
+            if squares[forward] == 0:
+                targets.append(forward)
+                if ((team == 1 and y == 6) or (team == -1 and y == 1)) and squares[forward - 8*team] == 0:
+                    moves.append(Move(start, forward - 8*team, DOUBLE_PUSH))
+            for (dx, end) in [(1, forward+1), (-1, forward-1)]:
+                if not 0 <= x+dx < 8: continue
+                if squares[end] * team < 0:
+                    targets.append(end)
+                elif end == self.en_passant and y == (3 if team == 1 else 4):
+                    moves.append(Move(start, end, EN_PASSANT))
+            for end in targets:
+                if last_rank:
+                    moves += [Move(start, end, PROMOTION, promotion) for promotion in (2, 3, 4, 5)]
+                else:
+                    moves.append(Move(start, end))
+        elif kind == 4 or kind == 1:
+            for end in (KNIGHT_MOVES if kind == 4 else KING_MOVES)[start]:
+                if squares[end] * team <= 0: moves.append(Move(start, end))
+
+            if kind == 1 and start in CASTLES and piece == (1 if start == 60 else -1):
+                for (right, king_end, rook_start, rook_end, empty) in CASTLES[start]:
+                    if self.castling & right and squares[rook_start] == 5*team and all(squares[i] == 0 for i in empty):
+                        # The king may not castle out of or through check, landing in check is left to the legality test
+                        if not self.isSquareAttacked(start, -team) and not self.isSquareAttacked((start + king_end) // 2, -team):
+                            moves.append(Move(start, king_end, CASTLE))
+        else:
+            rays = RAYS[start]
+            directions = range(1, 8, 2) if kind == 5 else range(0, 8, 2) if kind == 3 else range(8)
+            for d in directions:
+                for end in rays[d]:
+                    value = squares[end]
+                    if value == 0:
+                        moves.append(Move(start, end))
+                    else:
+                        if value * team < 0: moves.append(Move(start, end))
+                        break
+
+        return moves
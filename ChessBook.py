@@ -0,0 +1,183 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessBook.py
+
+import argparse
+import heapq
+import mmap
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+from ChessBoard import ChessBoard
+from ChessNotation import NotationError, moveToSAN, parseSAN, readPGN, startBoard
+from ChessProtocol import encodeMove, moveFromCode
+
+
+# Book files are a flat array of these records sorted by (hash, move): the ChessBoard Zobrist hash of a position,
+# a move from it in the 16 bit protocol encoding, and its weight. Big-endian so byte order is numeric order.
+BOOK_RECORD = struct.Struct('>QHH')
+MAX_WEIGHT = 0xFFFF
+
+# Points a move earns for the side that played it, by game result
+RESULT_POINTS = {'1-0': (2, 0), '0-1': (0, 2), '1/2-1/2': (1, 1), '*': (1, 1)}
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Builds and probes opening books")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='build a book from a PGN archive')
+    build.add_argument('pgn', type=str, help='PGN file to read, - for standard input')
+    build.add_argument('book', type=str, help='book file to write')
+    build.add_argument('--plies', default=20, type=int, help='plies of each game that go into the book (default: 20)')
+    build.add_argument('--min-weight', default=2, type=int, help='drop moves with less weight than this, 2 points per win and 1 per draw (default: 2)')
+    build.add_argument('--run-size', default=1000000, type=int, help='positions counted in memory before a sorted run is spilled to disk (default: 1000000)')
+    probe = commands.add_parser('probe', help='list the book moves of a position')
+    probe.add_argument('book', type=str, help='book file to read')
+    probe.add_argument('--fen', default=None, type=str, help='position to look up (default: the start position)')
+
+    return parser.parse_args()
+
+
+class OpeningBook:
+
+    # A book file mapped read-only, so every process using it shares one copy in the page cache.
+    # Lookups binary search the records in place without reading the file in.
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.count = size // BOOK_RECORD.size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b''
+
+    def __len__(self): return self.count
+
+    def lookup(self, key):
+        # (move, weight) pairs stored for the position hash key, without checking the moves are legal
+        (low, high) = (0, self.count)
+        while low < high:
+            middle = (low + high) // 2
+            if BOOK_RECORD.unpack_from(self.data, middle * BOOK_RECORD.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        entries = []
+        for index in range(low, self.count):
+            (record_key, move, weight) = BOOK_RECORD.unpack_from(self.data, index * BOOK_RECORD.size)
+            if record_key != key: break
+            entries.append((moveFromCode(move), weight))
+        return entries
+
+    def moves(self, board):
+        # Book moves that are legal in board, a hash collision could otherwise name any move
+        (entries, legal) = ([], {})
+        for (move, weight) in self.lookup(board.hash):
+            if move.start not in legal: legal[move.start] = board.generateLegalMoves(board.turn, move.start)
+            if move in legal[move.start]: entries.append((move, weight))
+        return entries
+
+    def chooseMove(self, board, rng=random):
+        # A book move picked in proportion to its weight, or None once the game has left the book.
+        # Books built with --min-weight 0 can hold only weightless moves, which are picked evenly.
+        entries = self.moves(board)
+        if not entries: return None
+        weights = [weight for (move, weight) in entries]
+        return rng.choices([move for (move, weight) in entries], weights if sum(weights) else None)[0]
+
+    def close(self):
+        if self.count: self.data.close()
+        self.file.close()
+
+
+def bookEntries(games, plies):
+    # (hash, move code, points) for the opening plies of every game, up to its first illegal move
+    for game in games:
+        points = RESULT_POINTS.get(game.result, (1, 1))
+        try:
+            board = startBoard(game.headers)
+        except (ValueError, IndexError, KeyError):
+            continue
+        for san in game.moves[:plies]:
+            try:
+                move = parseSAN(board, san)
+            except NotationError:
+                break
+            code = int.from_bytes(encodeMove(move), 'big')
+            yield board.hash, code, points[0 if board.turn == 1 else 1]
+            board.makeMove(move)
+
+def writeRun(counts, directory):
+    run = tempfile.TemporaryFile(dir=directory)
+    for ((key, code), weight) in sorted(counts.items()):
+        run.write(BOOK_RECORD.pack(key, code, min(weight, MAX_WEIGHT)))
+    run.seek(0)
+    return run
+
+def readRun(run, chunk_records=4096):
+    while True:
+        data = run.read(BOOK_RECORD.size * chunk_records)
+        if not data: return
+        yield from BOOK_RECORD.iter_unpack(data)
+
+def buildBook(games, path, plies=20, min_weight=2, run_size=1000000):
+    # Counts moves in memory up to run_size positions, spills each batch to a sorted temporary run, then
+    # merges the runs into the book, so archives of any size build in bounded memory. Returns the record count.
+    directory = os.path.dirname(os.path.abspath(path))
+    (runs, counts) = ([], {})
+    for (key, code, points) in bookEntries(games, plies):
+        counts[(key, code)] = counts.get((key, code), 0) + points
+        if len(counts) >= run_size:
+            runs.append(writeRun(counts, directory))
+            counts = {}
+    runs.append(writeRun(counts, directory))
+
+    records = 0
+    with open(path + '.tmp', 'wb') as book:
+        (current, weight) = (None, 0)
+        for (key, code, run_weight) in heapq.merge(*[readRun(run) for run in runs]):
+            if (key, code) != current:
+                if current is not None and weight >= min_weight:
+                    book.write(BOOK_RECORD.pack(*current, min(weight, MAX_WEIGHT)))
+                    records += 1
+                (current, weight) = ((key, code), 0)
+            weight += run_weight
+        if current is not None and weight >= min_weight:
+            book.write(BOOK_RECORD.pack(*current, min(weight, MAX_WEIGHT)))
+            records += 1
+    for run in runs: run.close()
+    os.replace(path + '.tmp', path)
+    return records
+
+
+def main():
+    args = parseArgs()
+    if args.command == 'build':
+        start_time = time.perf_counter()
+        pgn_file = sys.stdin if args.pgn == '-' else open(args.pgn, encoding='utf-8', errors='replace')
+        with pgn_file:
+            records = buildBook(readPGN(pgn_file), args.book, args.plies, args.min_weight, args.run_size)
+        print(f'{records} book moves written to {args.book} in {time.perf_counter() - start_time:.2f}s')
+        return 0
+
+    book = OpeningBook(args.book)
+    board = ChessBoard()
+    if args.fen: board.setFEN(args.fen)
+    start_time = time.perf_counter()
+    for i in range(1000): book.lookup(board.hash)
+    elapsed = (time.perf_counter() - start_time) / 1000
+    entries = book.moves(board)
+    total = sum(weight for (move, weight) in entries) or 1
+    for (move, weight) in sorted(entries, key=lambda entry: -entry[1]):
+        print(f'{moveToSAN(board, move):<8} {weight:>6}  {100 * weight / total:5.1f}%')
+    print(f'{len(entries)} moves from {len(book)} records, {elapsed * 1e6:.1f} us per lookup')
+    book.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,179 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessClient.py
+
+import asyncio
+import struct
+import time
+
+from ChessBoard import ChessBoard, PROMOTION
+from ChessProtocol import *
+
+
+class HeadlessClient:
+
+    # A binary protocol player without pygame, for scripts and load tests. It keeps its own copy of the board
+    # from the server's SYNC and MOVE_MADE frames. on_response(name, seconds, ok) is told about every timed request.
+    # version is the protocol version asked for, below LEGAL_MOVES_VERSION the client asks the server for possible moves.
+    # From SESSION_VERSION on the server issues a session token, and resume() takes the seat back on a new connection.
+
+    def __init__(self, host, port, name=None, timeout=5.0, on_response=None, version=PROTOCOL_VERSION):
+        self.host, self.port, self.name = host, port, name
+        self.timeout = timeout
+        self.version = version
+        self.on_response = on_response or (lambda name, seconds, ok: None)
+        self.board = ChessBoard()
+        self.ply = 0
+        # The server's (ply, {start: [ends]}) map of the side to move's legal moves
+        self.legal_moves = (None, {})
+        self.game_id, self.team = None, None
+        self.token = None
+        # (white's score, reason) once the server ends the game
+        self.outcome = None
+        self.connected = False
+        self.pending = {}
+        self.game_started = asyncio.Event()
+        self.board_changed = asyncio.Event()
+        self.synced = asyncio.Event()
+        self.reader_task = None
+
+    async def connect(self):
+        (self.reader, self.writer) = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        self.connected = True
+        self.writer.write(helloFrame(self.version, self.name))
+        self.reader_task = asyncio.create_task(self.readFrames())
+
+    async def resume(self):
+        # Drops the current connection, if any, and reconnects to the same seat. True once the position has been resent,
+        # False if the server refused the token, as it does once the game is over
+        if self.token is None: raise ConnectionError('no session to resume')
+        if self.reader_task is not None: self.reader_task.cancel()
+        self.writer.transport.abort()
+        start_time = time.perf_counter()
+        (self.reader, self.writer) = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        self.connected = True
+        # The outcome stays: a game that ended while the client was away is still over
+        self.legal_moves = (None, {})
+        self.game_started.clear()
+        self.synced.clear()
+        self.writer.write(resumeFrame(self.token, self.version))
+        self.reader_task = asyncio.create_task(self.readFrames())
+        try:
+            await asyncio.wait_for(self.synced.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            self.on_response('RESUME', time.perf_counter() - start_time, False)
+            raise
+        self.on_response('RESUME', time.perf_counter() - start_time, True)
+        return self.connected
+
+    async def close(self):
+        if self.connected:
+            self.connected = False
+            try:
+                self.writer.write(encodeFrame(DISCONNECT))
+                self.writer.close()
+            except (OSError, RuntimeError):
+                pass
+        if self.reader_task is not None: self.reader_task.cancel()
+
+
+    async def readFrames(self):
+        frame_reader = FrameReader()
+        try:
+            while self.connected:
+                data = await self.reader.read(4096)
+                if not data: break
+                for (msg_type, payload) in frame_reader.feed(data):
+                    self.handleFrame(msg_type, payload)
+        except OSError:
+            pass
+        self.connected = False
+        for future in self.pending.values():
+            if not future.done(): future.set_exception(ConnectionError('server closed the connection'))
+        self.game_started.set()
+        self.board_changed.set()
+        self.synced.set()
+
+    def handleFrame(self, msg_type, payload):
+        if msg_type == WELCOME:
+            self.version = payload[0]
+        elif msg_type == GAME_START:
+            (self.game_id, self.team) = struct.unpack('>Ib', payload)
+            self.game_started.set()
+        elif msg_type == SYNC:
+            self.ply = struct.unpack('>H', payload[:2])[0]
+            self.board.unpack(payload[2:])
+            self.board_changed.set()
+            self.synced.set()
+        elif msg_type == MOVE_MADE:
+            ply = struct.unpack('>H', payload[:2])[0]
+            if ply <= self.ply: return
+            if ply != self.ply + 1:
+                self.writer.write(encodeFrame(SYNC_REQUEST))
+                return
+            self.board.makeMove(decodeMove(payload[2:]))
+            self.ply = ply
+            self.board_changed.set()
+        elif msg_type == SESSION:
+            self.token = payload
+        elif msg_type == LEGAL_MOVES:
+            self.legal_moves = parseLegalMoves(payload)
+        elif msg_type == GAME_OVER:
+            self.outcome = parseGameOver(payload)
+            self.board_changed.set()
+        elif msg_type in (POS_MOVES_LIST, RESULT):
+            future = self.pending.pop(msg_type, None)
+            if future is not None and not future.done(): future.set_result(payload)
+        elif msg_type == DISCONNECT:
+            self.connected = False
+
+
+    async def waitForGame(self):
+        await self.game_started.wait()
+        if not self.connected: raise ConnectionError('server closed the connection')
+        return self.game_id, self.team
+
+    async def waitForTurn(self):
+        # True once it is this client's move, False when the game or connection is over
+        while self.connected and self.outcome is None:
+            if self.board.turn == self.team: return True
+            self.board_changed.clear()
+            await self.board_changed.wait()
+        return False
+
+    async def request(self, name, data, response_type):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[response_type] = future
+        start_time = time.perf_counter()
+        self.writer.write(data)
+        try:
+            payload = await asyncio.wait_for(future, self.timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            self.on_response(name, time.perf_counter() - start_time, False)
+            raise
+        return payload, start_time
+
+    def knownMoves(self):
+        # The pushed legal move map if it is for the current position, else None
+        (ply, moves) = self.legal_moves
+        return moves if ply == self.ply else None
+
+    async def possibleMoves(self, square):
+        if self.knownMoves() is not None: return self.knownMoves().get(square, [])
+        (payload, start_time) = await self.request('POSSIBLE_MOVES', encodeFrame(POSSIBLE_MOVES, bytes([square])), POS_MOVES_LIST)
+        self.on_response('POSSIBLE_MOVES', time.perf_counter() - start_time, True)
+        return list(payload[1:])
+
+    async def makeMove(self, move):
+        # Moves the pushed map rules out are refused without asking the server
+        if self.knownMoves() is not None and move.end not in self.knownMoves().get(move.start, []): return False
+        ply = self.ply
+        promotion = move.promotion if move.flag == PROMOTION else 0
+        (payload, start_time) = await self.request('MAKE_MOVE', makeMoveFrame(move.start, move.end, promotion), RESULT)
+        success = bool(payload[0])
+        self.on_response('MAKE_MOVE', time.perf_counter() - start_time, success)
+        # The server follows a successful RESULT with the move itself, wait for the board to catch up
+        while success and self.connected and self.ply == ply:
+            self.board_changed.clear()
+            await asyncio.wait_for(self.board_changed.wait(), self.timeout)
+        return success
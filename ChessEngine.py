@@ -0,0 +1,199 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessEngine.py
+
+import time
+
+from ChessBoard import EN_PASSANT, PROMOTION
+from ChessEvaluation import PIECE_VALUES, evaluate, scoreMoves
+
+
+MATE_SCORE = 100000
+EXACT, LOWER, UPPER = 0, 1, 2
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def tablebaseScore(value, ply):
+    # A ChessTablebase value as a search score, mates counted from the root like the searched ones
+    if value > 0: return MATE_SCORE - ply - value
+    if value < 0: return -MATE_SCORE + ply - value - 1
+    return 0
+
+
+class ChessEngine:
+
+    def __init__(self, table_bits=16, tablebase=None):
+        self.table_mask = (1 << table_bits) - 1
+        self.tablebase = tablebase
+        self.table = [None] * (1 << table_bits)
+        self.killers = []
+        self.nodes = 0
+        self.info = {}
+
+    def bestMove(self, board, time_ms=1000, max_depth=64, root_moves=None):
+        # Searches a copy of board, deeper each iteration until time_ms runs out (or max_depth with no time limit),
+        # and returns a Move (None if there are no moves). root_moves limits the search to some of the legal moves.
+        board = board.duplicateBoard()
+        board.move_cache = None
+        moves = board.generateLegalMoves() if root_moves is None else list(root_moves)
+        if not moves: return None
+        if self.tablebase is not None and root_moves is None:
+            # Solved endgames are played straight from the tables
+            move = self.tablebase.bestMove(board)
+            if move is not None:
+                score = tablebaseScore(self.tablebase.probe(board), 0)
+                self.info = {'depth': 0, 'score': score, 'nodes': 0, 'time': 0, 'nps': 0}
+                return move
+        # Static scores of all the root moves in one batch give the first iteration a sensible order
+        scores = scoreMoves(board, moves)
+        moves = [moves[i] for i in sorted(range(len(moves)), key=lambda i: -scores[i])]
+
+        start_time = time.perf_counter()
+        self.deadline = start_time + time_ms / 1000 if time_ms is not None else float('inf')
+        self.nodes = 0
+        self.partial_root = root_moves is not None
+        self.killers = [[None, None] for ply in range(max_depth + 1)]
+        best_move, best_score, completed = moves[0], 0, 0
+        # (score, move) of every completed iteration, so searches of different root moves can be compared at one depth
+        iterations = []
+
+        for depth in range(1, max_depth + 1):
+            # The first iteration always finishes so there is a searched move to fall back on
+            self.can_stop = depth > 1
+            try:
+                best_score, best_move = self.searchRoot(board, moves, depth)
+            except SearchTimeout:
+                break
+            completed = depth
+            iterations.append((best_score, best_move))
+            if abs(best_score) >= MATE_SCORE - 1000: break
+            if time.perf_counter() >= self.deadline: break
+
+        elapsed = time.perf_counter() - start_time
+        self.info = {'depth': completed, 'score': best_score, 'nodes': self.nodes, 'time': elapsed,
+                     'nps': self.nodes / elapsed if elapsed > 0 else 0, 'iterations': iterations}
+        return best_move
+
+    def clearTable(self):
+        self.table = [None] * len(self.table)
+
+
+    def searchRoot(self, board, moves, depth):
+        alpha, beta = -MATE_SCORE - 1, MATE_SCORE + 1
+        entry = self.table[board.hash & self.table_mask]
+        tt_move = entry[4] if entry is not None and entry[0] == board.hash else None
+
+        best_move = None
+        for move in self.orderMoves(board, moves, tt_move, 0):
+            board.makeMove(move)
+            score = -self.negamax(board, depth-1, -beta, -alpha, 1)
+            board.unmakeMove()
+            if score > alpha or best_move is None:
+                alpha, best_move = max(alpha, score), move
+
+        # A search over only some root moves gives a lower bound on the position's score
+        self.table[board.hash & self.table_mask] = (board.hash, depth, alpha, LOWER if self.partial_root else EXACT, best_move)
+        return alpha, best_move
+
+    def negamax(self, board, depth, alpha, beta, ply):
+        self.nodes += 1
+        if self.can_stop and self.nodes & 1023 == 0 and time.perf_counter() >= self.deadline:
+            raise SearchTimeout()
+        if board.repetitionCount() > 1: return 0
+        if self.tablebase is not None and board.squares.count(0) >= 61:
+            value = self.tablebase.probe(board)
+            if value is not None: return tablebaseScore(value, ply)
+
+        index = board.hash & self.table_mask
+        entry = self.table[index]
+        tt_move = None
+        if entry is not None and entry[0] == board.hash:
+            tt_move = entry[4]
+            if entry[1] >= depth:
+                score = self.scoreFromTable(entry[2], ply)
+                if entry[3] == EXACT: return score
+                if entry[3] == LOWER: alpha = max(alpha, score)
+                elif entry[3] == UPPER: beta = min(beta, score)
+                if alpha >= beta: return score
+
+        in_check = board.checkForCheck(board.turn)
+        if in_check: depth += 1
+        if depth <= 0: return self.quiesce(board, alpha, beta)
+
+        moves = board.generateLegalMoves()
+        if not moves: return -MATE_SCORE + ply if in_check else 0
+
+        original_alpha = alpha
+        best_score, best_move = -MATE_SCORE - 1, None
+        for move in self.orderMoves(board, moves, tt_move, ply):
+            quiet = board.squares[move.end] == 0 and move.flag != EN_PASSANT and move.flag != PROMOTION
+            board.makeMove(move)
+            score = -self.negamax(board, depth-1, -beta, -alpha, ply+1)
+            board.unmakeMove()
+
+            if score > best_score: best_score, best_move = score, move
+            if score > alpha: alpha = score
+            if alpha >= beta:
+                if quiet and ply < len(self.killers) and self.killers[ply][0] != move:
+                    self.killers[ply] = [move, self.killers[ply][0]]
+                break
+
+        flag = UPPER if best_score <= original_alpha else LOWER if best_score >= beta else EXACT
+        self.table[index] = (board.hash, depth, self.scoreToTable(best_score, ply), flag, best_move)
+        return best_score
+
+    def quiesce(self, board, alpha, beta):
+        # Only captures and promotions are searched past the horizon, standing pat on the static score
+        self.nodes += 1
+        if self.can_stop and self.nodes & 1023 == 0 and time.perf_counter() >= self.deadline:
+            raise SearchTimeout()
+
+        stand_pat = evaluate(board)
+        if stand_pat >= beta: return stand_pat
+        if stand_pat > alpha: alpha = stand_pat
+
+        squares = board.squares
+        captures = [move for move in board.generateLegalMoves() if squares[move.end] != 0 or move.flag == EN_PASSANT or move.flag == PROMOTION]
+        for move in self.orderMoves(board, captures, None, None):
+            board.makeMove(move)
+            score = -self.quiesce(board, -beta, -alpha)
+            board.unmakeMove()
+            if score >= beta: return score
+            if score > alpha: alpha = score
+
+        return alpha
+
+
+    def orderMoves(self, board, moves, tt_move, ply):
+        # Table move first, then captures by most valuable victim / least valuable attacker, promotions, killers
+        squares = board.squares
+        killers = self.killers[ply] if ply is not None and ply < len(self.killers) else ()
+
+        def priority(move):
+            if move == tt_move: return 1000000
+            victim = squares[move.end]
+            if victim != 0: return 100000 + 10*PIECE_VALUES[abs(victim)] - abs(squares[move.start])
+            if move.flag == EN_PASSANT: return 100000 + 10*PIECE_VALUES[6] - 6
+            if move.flag == PROMOTION: return 90000 + PIECE_VALUES[move.promotion]
+            if move in killers: return 80000 - killers.index(move)
+            return 0
+
+        return sorted(moves, key=priority, reverse=True)
+
+    def scoreToTable(self, score, ply):
+        # Mate scores are stored relative to the node so they stay correct at other depths
+        if score >= MATE_SCORE - 1000: return score + ply
+        if score <= -MATE_SCORE + 1000: return score - ply
+        return score
+
+    def scoreFromTable(self, score, ply):
+        if score >= MATE_SCORE - 1000: return score - ply
+        if score <= -MATE_SCORE + 1000: return score + ply
+        return score
+
+
+def bestMove(board, time_ms=1000):
+    return ChessEngine().bestMove(board, time_ms)
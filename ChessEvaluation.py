@@ -0,0 +1,173 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessEvaluation.py
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from ChessBoard import ChessBoard, CASTLES, CASTLE, EN_PASSANT, PROMOTION
+
+
+PIECE_VALUES = {1: 0, 2: 900, 3: 330, 4: 320, 5: 500, 6: 100}
+
+# Piece-square tables from white's side of the board, row 0 is the eighth rank like ChessBoard.squares
+PIECE_SQUARE_TABLES = {
+    6: [  0,   0,   0,   0,   0,   0,   0,   0,
+         50,  50,  50,  50,  50,  50,  50,  50,
+         10,  10,  20,  30,  30,  20,  10,  10,
+          5,   5,  10,  25,  25,  10,   5,   5,
+          0,   0,   0,  20,  20,   0,   0,   0,
+          5,  -5, -10,   0,   0, -10,  -5,   5,
+          5,  10,  10, -20, -20,  10,  10,   5,
+          0,   0,   0,   0,   0,   0,   0,   0],
+    4: [-50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20,   0,   0,   0,   0, -20, -40,
+        -30,   0,  10,  15,  15,  10,   0, -30,
+        -30,   5,  15,  20,  20,  15,   5, -30,
+        -30,   0,  15,  20,  20,  15,   0, -30,
+        -30,   5,  10,  15,  15,  10,   5, -30,
+        -40, -20,   0,   5,   5,   0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50],
+    3: [-20, -10, -10, -10, -10, -10, -10, -20,
+        -10,   0,   0,   0,   0,   0,   0, -10,
+        -10,   0,   5,  10,  10,   5,   0, -10,
+        -10,   5,   5,  10,  10,   5,   5, -10,
+        -10,   0,  10,  10,  10,  10,   0, -10,
+        -10,  10,  10,  10,  10,  10,  10, -10,
+        -10,   5,   0,   0,   0,   0,   5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20],
+    5: [  0,   0,   0,   0,   0,   0,   0,   0,
+          5,  10,  10,  10,  10,  10,  10,   5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+         -5,   0,   0,   0,   0,   0,   0,  -5,
+          0,   0,   0,   5,   5,   0,   0,   0],
+    2: [-20, -10, -10,  -5,  -5, -10, -10, -20,
+        -10,   0,   0,   0,   0,   0,   0, -10,
+        -10,   0,   5,   5,   5,   5,   0, -10,
+         -5,   0,   5,   5,   5,   5,   0,  -5,
+          0,   0,   5,   5,   5,   5,   0,  -5,
+        -10,   5,   5,   5,   5,   5,   0, -10,
+        -10,   0,   5,   0,   0,   0,   0, -10,
+        -20, -10, -10,  -5,  -5, -10, -10, -20],
+    1: [-30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+         20,  20,   0,   0,   0,   0,  20,  20,
+         20,  30,  10,   0,   0,  10,  30,  20],
+}
+
+# Material plus position for every piece value on every square, from white's point of view.
+# Black pieces read the table mirrored top to bottom (square ^ 56). Indexed by value + 6 like the Zobrist keys.
+SQUARE_SCORES = tuple(
+    tuple(0 if value == 0 else
+          (PIECE_VALUES[value] + PIECE_SQUARE_TABLES[value][square]) if value > 0 else
+          -(PIECE_VALUES[-value] + PIECE_SQUARE_TABLES[-value][square ^ 56])
+          for square in range(64))
+    for value in range(-6, 7))
+
+# (13, 64) lookup of material plus piece-square score for value + 6 on each square, from white's point of view
+SCORE_TABLE = np.array(SQUARE_SCORES, np.int32)
+SQUARE_INDEX = np.arange(64)
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Benchmarks batch evaluation against evaluating boards one at a time")
+    parser.add_argument('-n', '--positions', default=10000, type=int, help='number of random positions to score (default: 10000)')
+
+    return parser.parse_args()
+
+
+def evaluate(board):
+    # Score of the position for the side to move
+    score = 0
+    for square, value in enumerate(board.squares):
+        if value != 0: score += SQUARE_SCORES[value+6][square]
+    return score * board.turn
+
+
+def evaluateBatch(boards, turns=None):
+    # Scores an (N, 8, 8) stack of getBoardValues arrays with one table lookup.
+    # Scores are for white unless turns (N values of 1 or -1) asks for the side to move.
+    values = np.asarray(boards).reshape(-1, 64)
+    scores = SCORE_TABLE[values + 6, SQUARE_INDEX].sum(axis=1)
+    if turns is not None: scores *= np.asarray(turns)
+    return scores
+
+
+def stackBoards(boards):
+    # (N, 8, 8) values of many ChessBoards, read straight from their compact squares
+    data = b''.join(board.squares.tobytes() for board in boards)
+    return np.frombuffer(data, np.int8).reshape(-1, 8, 8)
+
+
+def childBoards(board, moves):
+    # (N, 8, 8) positions after each move, built from copies of the parent instead of playing the moves
+    parent = np.frombuffer(board.squares.tobytes(), np.int8)
+    children = np.tile(parent, (len(moves), 1))
+    rows = np.arange(len(moves))
+    starts = np.array([move.start for move in moves], np.intp)
+    ends = np.array([move.end for move in moves], np.intp)
+    children[rows, ends] = parent[starts]
+    children[rows, starts] = 0
+
+    # Only the few special moves touch more than two squares
+    for i, move in enumerate(moves):
+        team = 1 if parent[move.start] > 0 else -1
+        if move.flag == PROMOTION:
+            children[i, move.end] = team * move.promotion
+        elif move.flag == EN_PASSANT:
+            children[i, move.end + 8*team] = 0
+        elif move.flag == CASTLE:
+            for (right, king_end, rook_start, rook_end, empty) in CASTLES[move.start]:
+                if king_end == move.end:
+                    children[i, rook_end] = children[i, rook_start]
+                    children[i, rook_start] = 0
+
+    return children.reshape(-1, 8, 8)
+
+def scoreMoves(board, moves):
+    # Static score of every move for the side making it, in one batch
+    if not moves: return np.zeros(0, np.int32)
+    return evaluateBatch(childBoards(board, moves)) * board.turn
+
+
+def randomPositions(count, seed=0):
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < count:
+        board = ChessBoard()
+        for ply in range(rng.randint(0, 60)):
+            moves = board.generateLegalMoves()
+            if not moves: break
+            board.makeMove(rng.choice(moves))
+        boards.append(board)
+    return boards
+
+
+def main():
+    args = parseArgs()
+    boards = randomPositions(args.positions)
+
+    start_time = time.perf_counter()
+    single = [evaluate(board) * board.turn for board in boards]
+    single_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    batch = evaluateBatch(stackBoards(boards))
+    batch_time = time.perf_counter() - start_time
+
+    print(f'{len(boards)} positions: one at a time {single_time:.4f}s, batch {batch_time:.4f}s, speedup {single_time / batch_time:.1f}x')
+    print('scores match' if list(batch) == single else 'SCORES DIFFER')
+
+
+if __name__ == '__main__':
+    main()
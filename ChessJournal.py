@@ -0,0 +1,187 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessJournal.py
+
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from ChessBoard import FIFTY_MOVE_PLIES
+from ChessProtocol import encodeMove, decodeMove
+
+
+ACTIVE, FINISHED = 1, 2
+
+# The index is a list of (game id, status) records. A game only ever moves from ACTIVE to FINISHED,
+# so its latest status is the highest one recorded, in whichever shard's index that was
+INDEX_RECORD = struct.Struct('>IB')
+
+# A game's journal is a sequence of records: b'M' and a 2 byte move,
+# b'S', the 2 byte ply number and a 67 byte ChessBoard.pack() snapshot,
+# or b'I' first of all, the computer's team (0 for none), the players' names, each a length byte and UTF-8,
+# and the 16 byte secrets of the two seats' session tokens, white's first
+MOVE_RECORD, SNAPSHOT_RECORD, INFO_RECORD = b'M', b'S', b'I'
+SNAPSHOT_INTERVAL = 32
+SEAT_SECRET_SIZE = 16
+
+
+def readIndex(data_dir):
+    # Game statuses from every index in the directory, one per shard when the server is sharded. A game can appear in
+    # several when the number of shards changed between runs, and file order says nothing about which record is newer.
+    statuses = {}
+    names = sorted(name for name in os.listdir(data_dir) if name == 'index' or name.startswith('index.')) if os.path.isdir(data_dir) else []
+    for name in names:
+        with open(os.path.join(data_dir, name), 'rb') as f:
+            data = f.read()
+        # A crash can leave a partly written last record, which is ignored
+        for offset in range(0, len(data) - len(data) % INDEX_RECORD.size, INDEX_RECORD.size):
+            (game_id, status) = INDEX_RECORD.unpack_from(data, offset)
+            statuses[game_id] = max(status, statuses.get(game_id, 0))
+    return statuses
+
+
+class GameStore:
+
+    # Append-only game persistence. Moves are queued and a writer thread appends them in groups,
+    # fsyncing each touched file once per group. Games are only read back when asked for.
+
+    def __init__(self, data_dir='saved_games', flush_interval=0.05, max_open_files=256, shard=None):
+        self.data_dir = data_dir
+        self.games_dir = os.path.join(data_dir, 'games')
+        os.makedirs(self.games_dir, exist_ok=True)
+        self.flush_interval, self.max_open_files = flush_interval, max_open_files
+
+        self.index_path = os.path.join(data_dir, 'index' if shard is None else f'index.{shard}')
+        self.statuses = readIndex(data_dir)
+        self.index_file = open(self.index_path, 'ab')
+        self.files = OrderedDict()
+
+        self.pending = []
+        self.pending_lock = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.writer_thread = threading.Thread(target=self.writeLoop, daemon=True)
+        self.writer_thread.start()
+
+    def journalPath(self, game_id):
+        return os.path.join(self.games_dir, f'{game_id}.journal')
+
+    def nextGameId(self):
+        return max(self.statuses, default=-1) + 1
+
+
+    def createGame(self, game_id, names=None, bot_team=None, seats=None):
+        self.setStatus(game_id, ACTIVE)
+        (names, seats) = (names or {}, seats or {})
+        data = INFO_RECORD + struct.pack('>b', bot_team or 0)
+        for team in (1, -1):
+            name = (names.get(team) or '').encode()[:255]
+            data += bytes([len(name)]) + name
+        for team in (1, -1):
+            data += seats.get(team, bytes(SEAT_SECRET_SIZE))
+        self.queueWrite(game_id, data)
+
+    def setStatus(self, game_id, status):
+        self.statuses[game_id] = status
+        self.queueWrite(None, INDEX_RECORD.pack(game_id, status))
+
+    def appendMove(self, game_id, board, move):
+        data = MOVE_RECORD + encodeMove(move)
+        ply = board.plyCount()
+        if ply % SNAPSHOT_INTERVAL == 0:
+            data += SNAPSHOT_RECORD + struct.pack('>H', ply) + board.pack()
+        self.queueWrite(game_id, data)
+
+    def loadGame(self, game_id, board):
+        # Returns (board, names, bot_team, seats) with seats mapping each team to its secret. The board starts from the last snapshot at least FIFTY_MOVE_PLIES before
+        # the end and replays the moves after it, so its halfmove clock and repetition history come out right.
+        self.flush()
+        path = self.journalPath(game_id)
+        data = open(path, 'rb').read() if os.path.exists(path) else b''
+
+        (snapshots, moves, names, bot_team, seats, offset) = ([], [], {1: None, -1: None}, None, {}, 0)
+        while offset < len(data):
+            kind = data[offset:offset+1]
+            if kind == MOVE_RECORD and offset + 3 <= len(data):
+                moves.append(data[offset+1:offset+3])
+                offset += 3
+            elif kind == SNAPSHOT_RECORD and offset + 70 <= len(data):
+                snapshots.append((struct.unpack('>H', data[offset+1:offset+3])[0], data[offset+3:offset+70], len(moves)))
+                offset += 70
+            elif kind == INFO_RECORD and offset + 2 <= len(data):
+                bot_team = struct.unpack('>b', data[offset+1:offset+2])[0] or None
+                offset += 2
+                for team in (1, -1):
+                    length = data[offset] if offset < len(data) else 0
+                    names[team] = data[offset+1:offset+1+length].decode(errors='replace') or None
+                    offset += 1 + length
+                for team in (1, -1):
+                    seats[team] = data[offset:offset+SEAT_SECRET_SIZE]
+                    offset += SEAT_SECRET_SIZE
+            else:
+                break
+
+        (ply, packed, first_move) = (0, None, 0)
+        last_ply = snapshots[-1][0] + len(moves) - snapshots[-1][2] if snapshots else len(moves)
+        for snapshot in snapshots:
+            if snapshot[0] <= last_ply - FIFTY_MOVE_PLIES: (ply, packed, first_move) = snapshot
+        if packed is not None:
+            board.unpack(packed)
+            board.start_ply = ply
+        for move in moves[first_move:]:
+            board.makeMove(decodeMove(move))
+        return board, names, bot_team, seats
+
+
+    def queueWrite(self, game_id, data):
+        with self.pending_lock:
+            self.pending.append((game_id, data))
+            self.pending_lock.notify()
+
+    def writeLoop(self):
+        while True:
+            with self.pending_lock:
+                while not self.pending: self.pending_lock.wait()
+            # Let a group of writes gather so they share one fsync per file
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def releaseGame(self, game_id):
+        # Writes out a game leaving memory and closes its journal, which is all it needs to be loaded again
+        self.flush()
+        with self.flush_lock:
+            f = self.files.pop(game_id, None)
+            if f is not None: f.close()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.pending_lock:
+                (batch, self.pending) = (self.pending, [])
+
+            touched = {}
+            for (game_id, data) in batch:
+                f = self.getFile(game_id)
+                f.write(data)
+                touched[id(f)] = f
+            for f in touched.values():
+                f.flush()
+                os.fsync(f.fileno())
+
+    def getFile(self, game_id):
+        if game_id is None: return self.index_file
+        if game_id in self.files:
+            self.files.move_to_end(game_id)
+            return self.files[game_id]
+
+        if len(self.files) >= self.max_open_files:
+            (old_id, old_file) = self.files.popitem(last=False)
+            old_file.flush(); os.fsync(old_file.fileno()); old_file.close()
+        self.files[game_id] = open(self.journalPath(game_id), 'ab')
+        return self.files[game_id]
+
+    def close(self):
+        self.flush()
+        with self.flush_lock:
+            for f in [self.index_file, *self.files.values()]: f.close()
+            self.files.clear()
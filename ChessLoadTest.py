@@ -0,0 +1,150 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessLoadTest.py
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+
+from ChessClient import HeadlessClient
+from ChessEngine import ChessEngine
+from ChessProtocol import PROTOCOL_VERSION
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Plays many headless games against a chess server and reports its latency")
+    parser.add_argument('host', default='127.0.0.1', type=str, help='Server host ip (default: localhost)')
+    parser.add_argument('port', default=8080, type=int, help='Server port (default: 8080)')
+    parser.add_argument('-n', '--clients', default=10, type=int, help='concurrent connections, paired with each other by the server (default: 10)')
+    parser.add_argument('-d', '--duration', default=30, type=float, help='seconds to run for (default: 30)')
+    parser.add_argument('-r', '--rate', default=1, type=float, help='moves per second each client makes on its turn, 0 for as fast as possible (default: 1)')
+    parser.add_argument('--ramp', default=0, type=float, help='seconds over which the connections are opened (default: all at once)')
+    parser.add_argument('--engine', default=0, type=int, help='choose moves with the engine, thinking this many ms each (default: random legal moves)')
+    parser.add_argument('--max-plies', default=200, type=int, help='leave a game and queue for a new one after this many plies (default: 200)')
+    parser.add_argument('--timeout', default=5, type=float, help='seconds to wait for a response before counting an error (default: 5)')
+    parser.add_argument('--interval', default=5, type=float, help='seconds between progress lines, 0 for only the summary (default: 5)')
+    parser.add_argument('--name', default=None, type=str, help='play rated games as <name><client number> (default: unrated)')
+    parser.add_argument('--protocol', default=PROTOCOL_VERSION, type=int, help=f'protocol version to ask for, 1 to request possible moves per selection instead of taking them from board updates (default: {PROTOCOL_VERSION})')
+    parser.add_argument('--reconnect', default=0, type=float, help='chance after each move of dropping the connection and resuming the game with the session token (default: 0)')
+    parser.add_argument('--seed', default=None, type=int, help='random seed for repeatable move choices')
+
+    return parser.parse_args()
+
+
+class LoadStats:
+
+    # Response latencies by request name and error counts by kind, for the whole run and since the last progress line
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.outcomes = Counter()
+        self.moves = self.games = self.connected = 0
+        self.mark = (self.start_time, 0, 0)
+
+    def record(self, name, seconds, ok):
+        self.latencies[name].append(seconds)
+        if not ok: self.errors[f'{name} failed'] += 1
+
+    def error(self, kind):
+        self.errors[kind] += 1
+
+    def requests(self):
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    def progress(self):
+        now = time.perf_counter()
+        (mark_time, mark_moves, mark_requests) = self.mark
+        self.mark = (now, self.moves, self.requests())
+        elapsed = max(now - mark_time, 1e-9)
+        return (f'{now - self.start_time:6.1f}s  connected {self.connected}  moves/s {(self.moves - mark_moves) / elapsed:.1f}  '
+                f'requests/s {(self.requests() - mark_requests) / elapsed:.1f}  errors {sum(self.errors.values())}')
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        lines = [f'{elapsed:.1f}s, {self.moves} moves in {self.games} finished games, '
+                 f'{self.moves / elapsed:.1f} moves/s, {self.requests() / elapsed:.1f} requests/s']
+        for (name, latencies) in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+            lines.append(f'{name:<16} {len(latencies):>8} requests  p50 {percentile(0.5):7.2f}ms  p99 {percentile(0.99):7.2f}ms  max {latencies[-1] * 1000:7.2f}ms')
+        if self.outcomes:
+            lines.append('game endings: ' + ', '.join(f'{reason} {count}' for (reason, count) in self.outcomes.most_common()))
+        if self.errors:
+            lines.append('errors: ' + ', '.join(f'{kind} {count}' for (kind, count) in self.errors.most_common()))
+        else:
+            lines.append('errors: none')
+        return '\n'.join(lines)
+
+
+async def chooseMove(client, engine, think_ms, rng):
+    if engine is None:
+        return rng.choice(list(client.board.legalMoves()))
+    board = client.board.duplicateBoard()
+    return await asyncio.get_running_loop().run_in_executor(None, engine.bestMove, board, think_ms)
+
+async def playGame(client, args, stats, engine, rng, deadline):
+    await client.connect()
+    stats.connected += 1
+    try:
+        await asyncio.wait_for(client.waitForGame(), max(deadline - time.monotonic(), 0))
+        while time.monotonic() < deadline and client.ply < args.max_plies:
+            if not await asyncio.wait_for(client.waitForTurn(), max(deadline - time.monotonic(), 0)): break
+            turn_start = time.monotonic()
+            move = await chooseMove(client, engine, args.engine, rng)
+
+            # Select the piece first like a human player would, then check the server agrees on the move
+            destinations = await client.possibleMoves(move.start)
+            if move.end not in destinations: stats.error('possible moves disagree')
+            if not await client.makeMove(move): continue
+            stats.moves += 1
+            if client.token is not None and rng.random() < args.reconnect and not await client.resume(): break
+
+            if args.rate > 0:
+                await asyncio.sleep(max(0, 1 / args.rate - (time.monotonic() - turn_start)))
+        if client.outcome is not None: stats.outcomes[client.outcome[1]] += 1
+        if (client.connected or client.outcome is not None) and time.monotonic() < deadline: stats.games += 1
+    finally:
+        stats.connected -= 1
+        await client.close()
+
+async def runClient(index, args, stats, deadline):
+    rng = random.Random(None if args.seed is None else args.seed + index)
+    engine = ChessEngine(table_bits=14) if args.engine else None
+    if args.ramp > 0: await asyncio.sleep(args.ramp * index / args.clients)
+
+    while time.monotonic() < deadline:
+        name = None if args.name is None else f'{args.name}{index}'
+        client = HeadlessClient(args.host, args.port, name, args.timeout, stats.record, args.protocol)
+        try:
+            await playGame(client, args, stats, engine, rng, deadline)
+        except asyncio.TimeoutError:
+            if time.monotonic() < deadline: stats.error('timeout')
+        except (OSError, ConnectionError) as error:
+            stats.error(type(error).__name__)
+            await asyncio.sleep(0.5)
+
+async def runLoadTest(args):
+    stats = LoadStats()
+    deadline = time.monotonic() + args.duration
+    clients = [asyncio.create_task(runClient(index, args, stats, deadline)) for index in range(args.clients)]
+
+    while time.monotonic() < deadline:
+        await asyncio.sleep(min(args.interval or args.duration, max(deadline - time.monotonic(), 0)))
+        if args.interval > 0: print(stats.progress(), flush=True)
+
+    # Clients blocked on a response get until the timeout to finish
+    await asyncio.wait(clients, timeout=args.timeout)
+    for client in clients: client.cancel()
+    return stats
+
+
+if __name__ == '__main__':
+    args = parseArgs()
+    stats = asyncio.run(runLoadTest(args))
+    print(stats.summary())
+    sys.exit(1 if stats.errors else 0)
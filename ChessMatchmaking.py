@@ -0,0 +1,171 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessMatchmaking.py
+
+import bisect
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+DEFAULT_RATING = 1200
+K_FACTOR = 32
+
+# The rating gap a waiting player accepts starts at BASE_WINDOW and grows by WINDOW_GROWTH per second waited
+BASE_WINDOW = 50
+WINDOW_GROWTH = 25
+MAX_WINDOW = 1000
+
+
+class Ratings:
+
+    # Elo ratings by player name, kept in a JSON file that is replaced whole on every update.
+    # Players without a name (old text clients) play at DEFAULT_RATING and are never updated.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.players = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.players = json.load(f)
+
+    def get(self, name):
+        if name is None or name not in self.players: return DEFAULT_RATING
+        return self.players[name]['rating']
+
+    def recordResult(self, white, black, score):
+        # score is 1 for a white win, 0.5 for a draw and 0 for a black win
+        with self.lock:
+            (white_rating, black_rating) = (self.get(white), self.get(black))
+            expected = 1 / (1 + 10 ** ((black_rating - white_rating) / 400))
+            change = K_FACTOR * (score - expected)
+            for (name, rating, delta) in [(white, white_rating, change), (black, black_rating, -change)]:
+                if name is None: continue
+                player = self.players.setdefault(name, {'rating': DEFAULT_RATING, 'games': 0})
+                player['rating'] = round(rating + delta, 1)
+                player['games'] += 1
+            self.save()
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.players, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class Ticket:
+
+    # A player waiting in the queue. player is whatever the server needs to start the game,
+    # alive is called to check that the connection has not gone away while waiting.
+
+    def __init__(self, player, name, rating, alive, joined):
+        self.player, self.name, self.rating = player, name, rating
+        self.alive, self.joined = alive, joined
+
+    def window(self, now):
+        return min(MAX_WINDOW, BASE_WINDOW + WINDOW_GROWTH * (now - self.joined))
+
+
+class Matchmaker:
+
+    # Waiting players sorted by rating, so the nearest rated opponent is a bisect away.
+    # A ticker thread retries pairing as windows widen, evicts dead connections (telling on_evict) and hands
+    # anyone waiting longer than timeout to on_timeout (the computer opponent). The callbacks talk to clients,
+    # so they are collected under the lock and called once it is released.
+
+    def __init__(self, on_pair, on_timeout=None, timeout=0, on_evict=None, tick=0.5, history=1000):
+        self.on_pair, self.on_timeout, self.timeout = on_pair, on_timeout, timeout
+        self.on_evict = on_evict
+        self.lock = threading.RLock()
+        self.queue = []
+        self.counter = itertools.count()
+        self.waits = deque(maxlen=history)
+        self.evicted = 0
+        self.tick = tick
+        threading.Thread(target=self.tickLoop, daemon=True).start()
+
+    def join(self, player, name, rating, alive=lambda: True):
+        ticket = Ticket(player, name, rating, alive, time.monotonic())
+        callbacks = []
+        with self.lock:
+            if not self.tryPair(ticket, ticket.joined, callbacks):
+                bisect.insort(self.queue, (ticket.rating, next(self.counter), ticket))
+        self.runCallbacks(callbacks)
+        return ticket
+
+    def remove(self, ticket):
+        with self.lock:
+            index = self.find(ticket)
+            if index is None: return False
+            del self.queue[index]
+            return True
+
+    def find(self, ticket):
+        index = bisect.bisect_left(self.queue, (ticket.rating,))
+        while index < len(self.queue) and self.queue[index][0] == ticket.rating:
+            if self.queue[index][2] is ticket: return index
+            index += 1
+        return None
+
+    def tryPair(self, ticket, now, callbacks):
+        # Nearest rated neighbours on each side of the ticket, whichever is closer and within either player's window
+        index = bisect.bisect_left(self.queue, (ticket.rating,))
+        candidates = []
+        for i in (index - 1, index, index + 1):
+            if 0 <= i < len(self.queue) and self.queue[i][2] is not ticket:
+                candidates.append(i)
+        if not candidates: return False
+
+        best = min(candidates, key=lambda i: abs(self.queue[i][0] - ticket.rating))
+        opponent = self.queue[best][2]
+        if abs(opponent.rating - ticket.rating) > max(ticket.window(now), opponent.window(now)): return False
+
+        del self.queue[best]
+        if not opponent.alive():
+            self.evict(opponent, callbacks)
+            return self.tryPair(ticket, now, callbacks)
+        existing = self.find(ticket)
+        if existing is not None: del self.queue[existing]
+
+        # The longer waiting player takes white
+        (first, second) = sorted([ticket, opponent], key=lambda t: t.joined)
+        self.waits.extend([now - first.joined, now - second.joined])
+        callbacks.append((self.on_pair, (first, second)))
+        return True
+
+    def tickLoop(self):
+        while True:
+            time.sleep(self.tick)
+            now = time.monotonic()
+            callbacks = []
+            with self.lock:
+                for (rating, count, ticket) in sorted(self.queue, key=lambda entry: entry[2].joined):
+                    if self.find(ticket) is None: continue
+                    if not ticket.alive():
+                        self.remove(ticket)
+                        self.evict(ticket, callbacks)
+                    elif self.on_timeout is not None and self.timeout > 0 and now - ticket.joined >= self.timeout:
+                        self.remove(ticket)
+                        self.waits.append(now - ticket.joined)
+                        callbacks.append((self.on_timeout, (ticket,)))
+                    else:
+                        self.tryPair(ticket, now, callbacks)
+            self.runCallbacks(callbacks)
+
+    def evict(self, ticket, callbacks):
+        self.evicted += 1
+        if self.on_evict is not None: callbacks.append((self.on_evict, (ticket,)))
+
+    def runCallbacks(self, callbacks):
+        for (callback, args) in callbacks: callback(*args)
+
+    def stats(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            depth, evicted = len(self.queue), self.evicted
+        percentile = lambda p: round(waits[min(len(waits) - 1, int(p * len(waits)))], 3) if waits else 0
+        return {'depth': depth, 'evicted': evicted, 'paired': len(waits),
+                'wait_p50': percentile(0.5), 'wait_p90': percentile(0.9), 'wait_p99': percentile(0.99)}
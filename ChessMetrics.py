@@ -0,0 +1,140 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessMetrics.py
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket (+Inf) is implied
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Metrics:
+
+    # Counters, latency histograms and scrape-time gauges for one process, rendered in the Prometheus text format.
+    # Series are keyed by name and a sorted tuple of label pairs.
+
+    def __init__(self, prefix='chess_'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.help = {}
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def timed(self, name, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def gauge(self, name, function, help_text=None):
+        # function is called at scrape time and returns a number, or a dict of label tuples to numbers
+        self.gauges[name] = function
+        if help_text: self.help[name] = help_text
+
+    def describe(self, name, help_text):
+        self.help[name] = help_text
+
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(buckets), total, count) for (key, (buckets, total, count)) in self.histograms.items()}
+
+        for name in sorted({name for (name, labels) in counters}):
+            self.header(lines, name, 'counter')
+            for ((series, labels), value) in sorted(counters.items()):
+                if series == name: lines.append(f'{self.prefix}{name}{formatLabels(labels)} {value}')
+
+        for name in sorted({name for (name, labels) in histograms}):
+            self.header(lines, name, 'histogram')
+            for ((series, labels), (buckets, total, count)) in sorted(histograms.items()):
+                if series != name: continue
+                cumulative = 0
+                for (bound, bucket) in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                    cumulative += bucket
+                    lines.append(f'{self.prefix}{name}_bucket{formatLabels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{self.prefix}{name}_sum{formatLabels(labels)} {total:.6f}')
+                lines.append(f'{self.prefix}{name}_count{formatLabels(labels)} {count}')
+
+        for (name, function) in sorted(self.gauges.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            self.header(lines, name, 'gauge')
+            if isinstance(value, dict):
+                for (labels, series_value) in sorted(value.items()):
+                    lines.append(f'{self.prefix}{name}{formatLabels(labels)} {series_value}')
+            else:
+                lines.append(f'{self.prefix}{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def header(self, lines, name, kind):
+        if name in self.help: lines.append(f'# HELP {self.prefix}{name} {self.help[name]}')
+        lines.append(f'# TYPE {self.prefix}{name} {kind}')
+
+
+def formatLabels(labels):
+    if not labels: return ''
+    return '{' + ','.join(f'{key}="{value}"' for (key, value) in labels) + '}'
+
+
+# The metrics of this process, shared by everything the server runs
+METRICS = Metrics()
+METRICS.describe('requests_total', 'client requests handled, by message type and protocol')
+METRICS.describe('request_seconds', 'time to handle a client request, by message type and protocol')
+METRICS.describe('board_seconds', 'time spent in ChessBoard calls made for clients, by method')
+METRICS.describe('bytes_received_total', 'bytes read from client connections')
+METRICS.describe('bytes_sent_total', 'bytes written to client connections')
+METRICS.describe('connections_total', 'client connections accepted')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serveMetrics(port, host='127.0.0.1', metrics=METRICS):
+    # Serves /metrics from a daemon thread and returns the HTTP server
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
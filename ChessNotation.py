@@ -0,0 +1,251 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessNotation.py
+
+import argparse
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from ChessBoard import ChessBoard, CASTLE, EN_PASSANT, PROMOTION, toSquare
+
+
+FILES = 'abcdefgh'
+SAN_PIECES = {'K': 1, 'Q': 2, 'B': 3, 'N': 4, 'R': 5}
+PIECE_LETTERS = {value: letter for (letter, value) in SAN_PIECES.items()}
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+
+SAN_PATTERN = re.compile(r'([KQBNR])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([QBNR]))?')
+TAG_PATTERN = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+# Comments (possibly running past the end of the line), NAGs, variation brackets and everything else up to whitespace
+TOKEN_PATTERN = re.compile(r'\{[^}]*\}?|;.*|\$\d+|[()]|[^\s(){};]+')
+MOVE_NUMBER = re.compile(r'^\d+\.*')
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Replays every game of a PGN archive and reports illegal or unreadable moves")
+    parser.add_argument('pgn', type=str, help='PGN file to check, - for standard input')
+    parser.add_argument('-w', '--workers', default=os.cpu_count(), type=int, help='number of worker processes (default: one per core)')
+    parser.add_argument('--batch-size', default=200, type=int, help='games sent to a worker at a time (default: 200)')
+    parser.add_argument('--show', default=20, type=int, help='number of illegal games to print (default: 20)')
+
+    return parser.parse_args()
+
+
+class NotationError(ValueError):
+    pass
+
+
+def squareName(square):
+    return FILES[square % 8] + str(8 - square // 8)
+
+def parseSquare(name):
+    return toSquare((FILES.index(name[0]), 8 - int(name[1])))
+
+
+def parseSAN(board, san):
+    # The legal move of the side to move that the SAN text names, ignoring check marks and annotations
+    text = san.rstrip('+#!?')
+    if text in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        (queenside, king) = (len(text) == 5, board.kings[board.turn])
+        for move in (board.generateLegalMoves(board.turn, king) if king is not None else []):
+            if move.flag == CASTLE and (move.end % 8 == 2) == queenside: return move
+        raise NotationError(f'{san} is not legal here')
+
+    match = SAN_PATTERN.fullmatch(text)
+    if match is None: raise NotationError(f'{san} is not a SAN move')
+    (piece, from_file, from_rank, target, promotion) = match.groups()
+    kind = SAN_PIECES[piece] if piece else 6
+    end = parseSquare(target)
+    promotion = SAN_PIECES[promotion] if promotion else 0
+
+    # Only the pieces that could be the one named are generated for, which is most of the cost of a replay
+    starts = [start for start in range(64) if board.squares[start] == kind * board.turn
+              and (from_file is None or FILES[start % 8] == from_file)
+              and (from_rank is None or str(8 - start // 8) == from_rank)]
+    candidates = [move for start in starts for move in board.generateLegalMoves(board.turn, start)
+                  if move.end == end and move.promotion == promotion]
+    if len(candidates) == 1: return candidates[0]
+    raise NotationError(f'{san} is {"ambiguous" if candidates else "not legal"} here')
+
+def moveToSAN(board, move):
+    if move.flag == CASTLE:
+        san = 'O-O' if move.end % 8 == 6 else 'O-O-O'
+    else:
+        piece = board.squares[move.start]
+        capture = board.squares[move.end] != 0 or move.flag == EN_PASSANT
+        if abs(piece) == 6:
+            san = (FILES[move.start % 8] + 'x' if capture else '') + squareName(move.end)
+            if move.flag == PROMOTION: san += '=' + PIECE_LETTERS[move.promotion]
+        else:
+            # Name the file, else the rank, else both when another piece of the same kind could also move there
+            others = {other.start for other in board.legalMoves() if other.end == move.end and other.start != move.start and board.squares[other.start] == piece}
+            qualifier = ''
+            if others and all(start % 8 != move.start % 8 for start in others):
+                qualifier = FILES[move.start % 8]
+            elif others and all(start // 8 != move.start // 8 for start in others):
+                qualifier = str(8 - move.start // 8)
+            elif others:
+                qualifier = squareName(move.start)
+            san = PIECE_LETTERS[abs(piece)] + qualifier + ('x' if capture else '') + squareName(move.end)
+
+    board.makeMove(move)
+    if board.checkForCheck(board.turn): san += '+' if board.legalMoves() else '#'
+    board.unmakeMove()
+    return san
+
+
+PGNGame = namedtuple('PGNGame', ['headers', 'moves', 'result'])
+
+def startBoard(headers):
+    board = ChessBoard()
+    if 'FEN' in headers: board.setFEN(headers['FEN'])
+    return board
+
+def readPGN(lines):
+    # Yields PGNGame tuples one at a time from any iterable of lines, so archives never have to fit in memory.
+    # Moves stay SAN strings; comments, NAGs and variations are dropped.
+    headers, moves = {}, []
+    depth, in_comment = 0, False
+    for line in lines:
+        if in_comment:
+            if '}' not in line: continue
+            (line, in_comment) = (line[line.index('}')+1:], False)
+
+        stripped = line.strip()
+        if depth == 0 and stripped.startswith('['):
+            if moves:
+                # Movetext that never reached a result token
+                yield PGNGame(headers, moves, headers.get('Result', '*'))
+                (headers, moves) = ({}, [])
+            match = TAG_PATTERN.match(stripped)
+            if match: headers[match.group(1)] = re.sub(r'\\(.)', r'\1', match.group(2))
+            continue
+        if stripped.startswith('%'): continue
+
+        for token in TOKEN_PATTERN.findall(line):
+            if token[0] == '{':
+                in_comment = not token.endswith('}')
+            elif token == '(':
+                depth += 1
+            elif token == ')':
+                depth = max(depth - 1, 0)
+            elif depth > 0 or token[0] in ';$':
+                continue
+            elif token in RESULTS:
+                yield PGNGame(headers, moves, token)
+                (headers, moves) = ({}, [])
+            else:
+                token = MOVE_NUMBER.sub('', token)
+                if token: moves.append(token)
+
+    if headers or moves: yield PGNGame(headers, moves, headers.get('Result', '*'))
+
+def formatPGN(board, moves, headers=None, result='*', width=80):
+    # PGN text for moves played from board's position, which is left unchanged
+    board = board.duplicateBoard()
+    headers = dict(headers or {})
+    headers.setdefault('Result', result)
+    if board.getFEN().split()[:4] != ChessBoard().getFEN().split()[:4]:
+        headers.setdefault('SetUp', '1')
+        headers.setdefault('FEN', board.getFEN())
+
+    tokens = []
+    for move in moves:
+        if board.turn == 1 or not tokens:
+            tokens.append(f'{board.plyCount() // 2 + 1}.' + ('' if board.turn == 1 else '..'))
+        tokens.append(moveToSAN(board, move))
+        board.makeMove(move)
+    tokens.append(result)
+
+    lines, line = [], ''
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > width:
+            lines.append(line)
+            line = token
+        else:
+            line = f'{line} {token}' if line else token
+    lines.append(line)
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"')
+    tags = ''.join(f'[{key} "{escape(value)}"]\n' for (key, value) in headers.items())
+    return tags + '\n' + '\n'.join(lines) + '\n'
+
+
+def validateGame(game):
+    # (plies replayed, None) for a legal game, or (ply, (ply, move text, reason)) at the first bad move
+    try:
+        board = startBoard(game.headers)
+    except (ValueError, IndexError, KeyError) as error:
+        return 0, (0, game.headers.get('FEN', ''), f'bad FEN: {error}')
+    for (ply, san) in enumerate(game.moves):
+        try:
+            board.makeMove(parseSAN(board, san))
+        except NotationError as error:
+            return ply, (ply, san, str(error))
+    return len(game.moves), None
+
+def validateBatch(first_index, games):
+    # Only the illegal games come back whole, so a batch costs the workers little to report
+    plies, errors = 0, []
+    for (offset, game) in enumerate(games):
+        (game_plies, error) = validateGame(game)
+        plies += game_plies
+        if error is not None: errors.append((first_index + offset, gameLabel(game.headers), *error))
+    return len(games), plies, errors
+
+def gameLabel(headers):
+    return f"{headers.get('White', '?')} - {headers.get('Black', '?')}, {headers.get('Event', '?')} {headers.get('Date', '')}".strip()
+
+def batches(games, batch_size):
+    (batch, first_index) = ([], 0)
+    for (index, game) in enumerate(games):
+        if not batch: first_index = index
+        batch.append(game)
+        if len(batch) == batch_size:
+            yield first_index, batch
+            batch = []
+    if batch: yield first_index, batch
+
+def validateGames(games, workers=None, batch_size=200):
+    # Yields validateBatch results as batches finish, with at most two batches per worker read ahead of the pool
+    workers = workers or os.cpu_count()
+    if workers <= 1:
+        for (first_index, batch) in batches(games, batch_size):
+            yield validateBatch(first_index, batch)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for (first_index, batch) in batches(games, batch_size):
+            pending.add(executor.submit(validateBatch, first_index, batch))
+            if len(pending) >= workers * 2:
+                (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done: yield future.result()
+        for future in pending:
+            yield future.result()
+
+
+def main():
+    args = parseArgs()
+    pgn_file = sys.stdin if args.pgn == '-' else open(args.pgn, encoding='utf-8', errors='replace')
+
+    start_time = time.perf_counter()
+    (games, plies, illegal) = (0, 0, 0)
+    with pgn_file:
+        for (batch_games, batch_plies, errors) in validateGames(readPGN(pgn_file), args.workers, args.batch_size):
+            games += batch_games
+            plies += batch_plies
+            for (index, label, ply, san, reason) in errors:
+                illegal += 1
+                if illegal <= args.show: print(f'game {index + 1} ({label}): ply {ply + 1} {san}: {reason}')
+    elapsed = time.perf_counter() - start_time
+
+    print(f'{games} games, {plies} plies, {illegal} illegal in {elapsed:.2f}s ({games / elapsed if elapsed > 0 else 0:.0f} games/s)')
+    return 1 if illegal else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessParallelSearch.py
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from ChessBoard import ChessBoard, Move
+from ChessEngine import ChessEngine
+from ChessPerft import POSITIONS, moveName
+from ChessTablebase import Tablebase
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Benchmarks parallel root-split search against single-process search")
+    parser.add_argument('-w', '--workers', default=os.cpu_count(), type=int, help='number of worker processes (default: one per core)')
+    parser.add_argument('-d', '--depth', default=3, type=int, help='fixed search depth for every position (default: 3)')
+    parser.add_argument('-p', '--position', action='append', choices=[name for (name, fen, counts) in POSITIONS], help='position to run, can be repeated (default: all)')
+
+    return parser.parse_args()
+
+
+# Each worker process keeps one engine so its transposition table carries over between searches
+worker_engine = None
+
+def initWorker(table_bits, tablebases):
+    global worker_engine
+    worker_engine = ChessEngine(table_bits, Tablebase(tablebases) if tablebases else None)
+
+def searchRootMoves(packed_board, moves, time_ms, max_depth, clear_table=False):
+    board = ChessBoard()
+    board.unpack(packed_board)
+    if clear_table: worker_engine.clearTable()
+    worker_engine.bestMove(board, time_ms, max_depth, [Move(*move) for move in moves])
+    info = dict(worker_engine.info)
+    info['iterations'] = [(score, tuple(move)) for (score, move) in info['iterations']]
+    return info
+
+
+class ParallelSearch:
+
+    # Splits the root moves of a position across worker processes, each searching its share with its own engine.
+    # Positions are sent as ChessBoard.pack() bytes and moves as plain tuples. Each worker maps the tablebases itself.
+
+    def __init__(self, workers=None, table_bits=16, tablebases=None):
+        self.workers = workers or os.cpu_count()
+        self.engine = ChessEngine(table_bits, Tablebase(tablebases) if tablebases else None)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=initWorker, initargs=(table_bits, tablebases)) if self.workers > 1 else None
+        self.info = {}
+
+    def bestMove(self, board, time_ms=1000, max_depth=64, clear_table=False):
+        # clear_table starts every engine searching this position with an empty transposition table
+        if clear_table: self.engine.clearTable()
+        if self.executor is None:
+            move = self.engine.bestMove(board, time_ms, max_depth)
+            self.info = self.engine.info
+            return move
+
+        # Moves are generated on a copy, the caller may be drawing its board meanwhile
+        board = board.duplicateBoard()
+        moves = board.generateLegalMoves()
+        if len(moves) <= 1:
+            self.info = {'depth': 0, 'score': 0, 'nodes': 0, 'time': 0, 'nps': 0}
+            return moves[0] if moves else None
+        if self.engine.tablebase is not None and self.engine.tablebase.probe(board) is not None:
+            move = self.engine.bestMove(board, time_ms, max_depth)
+            self.info = self.engine.info
+            return move
+
+        # Deal the ordered moves out in turn so every worker gets some of the promising ones
+        ordered = self.engine.orderMoves(board, moves, None, None)
+        shares = [ordered[i::self.workers] for i in range(min(self.workers, len(ordered)))]
+
+        start_time = time.perf_counter()
+        packed_board = board.pack()
+        futures = [self.executor.submit(searchRootMoves, packed_board, [tuple(move) for move in share], time_ms, max_depth, clear_table)
+                   for share in shares]
+        results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start_time
+
+        # Workers reach different depths in the time, and a deeper search of worse moves says nothing about the
+        # better ones, so the shares are compared at the deepest depth every worker completed
+        depth = min(info['depth'] for info in results)
+        (score, move) = max((info['iterations'][depth - 1] for info in results), key=lambda iteration: iteration[0])
+        nodes = sum(info['nodes'] for info in results)
+        self.info = {'depth': depth, 'score': score, 'nodes': nodes, 'time': elapsed,
+                     'nps': nodes / elapsed if elapsed > 0 else 0}
+        return Move(*move)
+
+    def shutdown(self):
+        if self.executor is not None: self.executor.shutdown()
+
+
+def main():
+    args = parseArgs()
+    selected = args.position or [name for (name, fen, counts) in POSITIONS]
+    parallel = ParallelSearch(args.workers)
+
+    serial_total, parallel_total = 0, 0
+    for (name, fen, counts) in POSITIONS:
+        if name not in selected: continue
+        board = ChessBoard()
+        board.setFEN(fen)
+
+        # Fresh single-process engine each time, and the workers' tables cleared, so neither side starts with a warm table
+        serial = ChessEngine()
+        serial_move = serial.bestMove(board, None, args.depth)
+        parallel_move = parallel.bestMove(board, None, args.depth, clear_table=True)
+        serial_total += serial.info['time']
+        parallel_total += parallel.info['time']
+
+        print(f"{name:<12} serial {moveName(serial_move)} {serial.info['time']:7.3f}s {serial.info['nodes']:>8} nodes   "
+              f"parallel {moveName(parallel_move)} {parallel.info['time']:7.3f}s {parallel.info['nodes']:>8} nodes   "
+              f"speedup {serial.info['time'] / parallel.info['time']:.2f}x")
+
+    parallel.shutdown()
+    print(f'{args.workers} workers, depth {args.depth}: total speedup {serial_total / parallel_total:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessPerft.py
+
+import argparse
+import sys
+import time
+
+from ChessBoard import ChessBoard, START_FEN, toPos
+
+
+# (name, FEN, leaf node counts for depth 1, 2, 3...) from the standard perft reference positions
+POSITIONS = [
+    ('start', START_FEN,
+        [20, 400, 8902, 197281, 4865609]),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+        [48, 2039, 97862, 4085603]),
+    ('endgame', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+        [14, 191, 2812, 43238, 674624]),
+    ('promotion', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+        [6, 264, 9467, 422333]),
+    ('checks', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+        [44, 1486, 62379, 2103487]),
+    ('middlegame', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+        [46, 2079, 89890, 3894594]),
+]
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Counts move generator leaf nodes and checks them against reference values")
+    parser.add_argument('-d', '--depth', default=3, type=int, help='search depth in plies (default: 3)')
+    parser.add_argument('-p', '--position', action='append', choices=[name for (name, fen, counts) in POSITIONS], help='position to run, can be repeated (default: all)')
+    parser.add_argument('--fen', type=str, help='run a custom FEN instead of the reference positions')
+    parser.add_argument('--divide', action='store_true', help='print the node count below each root move')
+    parser.add_argument('--min-nps', default=0, type=int, help='fail if any position runs slower than this many nodes/second')
+
+    return parser.parse_args()
+
+
+def perft(board, depth):
+    moves = board.generateLegalMoves()
+    if depth == 1: return len(moves)
+
+    nodes = 0
+    for move in moves:
+        board.makeMove(move)
+        nodes += perft(board, depth-1)
+        board.unmakeMove()
+    return nodes
+
+def divide(board, depth):
+    results = {}
+    for move in board.generateLegalMoves():
+        board.makeMove(move)
+        results[move] = perft(board, depth-1) if depth > 1 else 1
+        board.unmakeMove()
+    return results
+
+def moveName(move):
+    name = ''.join('abcdefgh'[x] + str(8-y) for (x, y) in [toPos(move.start), toPos(move.end)])
+    return name + ('', '', 'q', 'b', 'n', 'r')[move.promotion]
+
+
+def runPosition(name, fen, depth, expected=None, show_divide=False):
+    board = ChessBoard()
+    board.setFEN(fen)
+
+    start_time = time.perf_counter()
+    if show_divide:
+        results = divide(board, depth)
+        nodes = sum(results.values())
+    else:
+        nodes = perft(board, depth)
+    elapsed = time.perf_counter() - start_time
+    nps = nodes / elapsed if elapsed > 0 else float('inf')
+
+    if show_divide:
+        for move, count in sorted(results.items(), key=lambda item: moveName(item[0])):
+            print(f'  {moveName(move)}: {count}')
+    status = '' if expected is None else ' OK' if nodes == expected else f' MISMATCH (expected {expected})'
+    print(f'{name:<12} depth {depth}  {nodes:>10} nodes  {elapsed:8.3f}s  {nps:>10.0f} nps{status}')
+
+    return (expected is None or nodes == expected), nps
+
+
+def main():
+    args = parseArgs()
+
+    if args.fen:
+        runs = [('custom', args.fen, None)]
+    else:
+        selected = args.position or [name for (name, fen, counts) in POSITIONS]
+        runs = [(name, fen, counts[args.depth-1] if args.depth <= len(counts) else None) for (name, fen, counts) in POSITIONS if name in selected]
+
+    passed = True
+    for (name, fen, expected) in runs:
+        correct, nps = runPosition(name, fen, args.depth, expected, args.divide)
+        if not correct: passed = False
+        if nps < args.min_nps:
+            print(f'{name:<12} too slow: {nps:.0f} nps is below {args.min_nps}')
+            passed = False
+
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
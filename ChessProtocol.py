@@ -0,0 +1,188 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessProtocol.py
+
+import struct
+
+from ChessBoard import GAME_OVER_REASONS, Move, NORMAL, PROMOTION
+
+
+# Frames are a 2 byte big-endian length, then a type byte and the payload the length covers.
+# The first byte of a frame is always 0 for these sizes, which no text message starts with,
+# so the server can tell a binary client's HELLO from an old text client.
+# Version 2 adds the LEGAL_MOVES map to every position sent, so clients no longer ask for POSSIBLE_MOVES.
+# Version 3 gives players a SESSION token they can RESUME their seat with after losing the connection.
+PROTOCOL_VERSION = 3
+LEGAL_MOVES_VERSION = 2
+SESSION_VERSION = 3
+TEXT_PROTOCOL = 0
+HELLO_MAGIC = b'CHESS'
+
+(HELLO, WELCOME, WAITING, GAME_START, SYNC, MOVE_MADE, POSSIBLE_MOVES, POS_MOVES_LIST,
+ MAKE_MOVE, RESULT, SYNC_REQUEST, DISCONNECT, SPECTATE, GAME_OVER, LEGAL_MOVES, SESSION, RESUME) = range(1, 18)
+
+# A full position is sent every this many plies even when deltas are arriving in order
+SYNC_INTERVAL = 16
+
+
+def encodeFrame(msg_type, payload=b''):
+    return struct.pack('>HB', len(payload) + 1, msg_type) + payload
+
+
+class FrameReader:
+
+    # Reassembles frames from stream data that may arrive split or coalesced
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= 2:
+            length = int.from_bytes(self.buffer[:2], 'big')
+            if len(self.buffer) < length + 2: break
+            frames.append((self.buffer[2], bytes(self.buffer[3:length+2])))
+            del self.buffer[:length+2]
+        return frames
+
+
+# Moves fit in 16 bits: start square, end square, then a 3 bit kind that folds the four promotions in with the flags
+def encodeMove(move):
+    kind = 4 + move.promotion - 2 if move.flag == PROMOTION else move.flag
+    return struct.pack('>H', move.start | move.end << 6 | kind << 12)
+
+def decodeMove(data):
+    return moveFromCode(struct.unpack('>H', data[:2])[0])
+
+def moveFromCode(code):
+    (start, end, kind) = (code & 63, code >> 6 & 63, code >> 12)
+    if kind >= 4: return Move(start, end, PROMOTION, kind - 4 + 2)
+    return Move(start, end, kind)
+
+
+def helloFrame(version=PROTOCOL_VERSION, name=None):
+    # The player name, if any, follows the version and is what ratings are kept under
+    return encodeFrame(HELLO, HELLO_MAGIC + bytes([version]) + (name.encode()[:64] if name else b''))
+
+def parseHello(payload):
+    if payload[:len(HELLO_MAGIC)] != HELLO_MAGIC or len(payload) <= len(HELLO_MAGIC): return None
+    return payload[len(HELLO_MAGIC)]
+
+def helloName(payload):
+    name = payload[len(HELLO_MAGIC)+1:].decode(errors='replace')
+    return name or None
+
+def spectateFrame(game_id, version=PROTOCOL_VERSION):
+    # Opens a connection like HELLO, but to watch a game instead of joining the queue
+    return encodeFrame(SPECTATE, HELLO_MAGIC + bytes([version]) + struct.pack('>I', game_id))
+
+def spectateId(payload):
+    return struct.unpack('>I', payload[len(HELLO_MAGIC)+1:len(HELLO_MAGIC)+5])[0]
+
+# Session tokens are the game id and team, so any process can tell where the seat is, then a random secret
+SESSION_TOKEN = struct.Struct('>Ib16s')
+
+def sessionFrame(token):
+    return encodeFrame(SESSION, token)
+
+def resumeFrame(token, version=PROTOCOL_VERSION):
+    # Opens a connection like HELLO, but to take back the seat token was issued for
+    return encodeFrame(RESUME, HELLO_MAGIC + bytes([version]) + token)
+
+def resumeToken(payload):
+    return payload[len(HELLO_MAGIC)+1:len(HELLO_MAGIC)+1+SESSION_TOKEN.size]
+
+def waitingMsg(version):
+    return encodeFrame(WAITING) if version else b'WAITING'
+
+# Spectators are told they entered the game as team 0
+def enteringMsg(version, game_id, team):
+    if version: return encodeFrame(GAME_START, struct.pack('>Ib', game_id, team))
+    return b'ENTERING GAME ' + str(game_id).encode() + b' ' + str(team).encode()
+
+def syncFrame(board):
+    # Full state: the ply number the position follows, then ChessBoard.pack()
+    return encodeFrame(SYNC, struct.pack('>H', board.plyCount()) + board.pack())
+
+def legalMovesFrame(board):
+    # The side to move's legal moves: the ply they are for, then per piece its square, a count and the squares it reaches.
+    # The four promotions of a pawn share one entry, the piece is chosen in MAKE_MOVE.
+    targets = {}
+    for move in board.legalMoves():
+        ends = targets.setdefault(move.start, [])
+        if move.end not in ends: ends.append(move.end)
+    payload = bytearray(struct.pack('>H', board.plyCount()))
+    for (start, ends) in targets.items(): payload += bytes([start, len(ends), *ends])
+    return encodeFrame(LEGAL_MOVES, bytes(payload))
+
+def parseLegalMoves(payload):
+    # (ply, {start square: [end squares]})
+    (ply, moves, offset) = (struct.unpack('>H', payload[:2])[0], {}, 2)
+    while offset + 2 <= len(payload):
+        count = payload[offset+1]
+        moves[payload[offset]] = list(payload[offset+2:offset+2+count])
+        offset += 2 + count
+    return ply, moves
+
+def moveMadeFrame(ply, move):
+    # Delta: the ply number the move leads to and the move itself
+    return encodeFrame(MOVE_MADE, struct.pack('>H', ply) + encodeMove(move))
+
+def makeMoveFrame(start, end, promotion=0):
+    return encodeFrame(MAKE_MOVE, encodeMove(Move(start, end, PROMOTION if promotion else NORMAL, promotion)))
+
+# Results as PGN writes them, keyed by white's score
+RESULT_TEXT = {1: '1-0', 0.5: '1/2-1/2', 0: '0-1'}
+
+def gameOverFrame(outcome):
+    # ChessBoard.gameResult()'s (score, reason) as twice white's score and the reason's index
+    (score, reason) = outcome
+    return encodeFrame(GAME_OVER, bytes([int(score * 2), GAME_OVER_REASONS.index(reason)]))
+
+def parseGameOver(payload):
+    return payload[0] / 2, GAME_OVER_REASONS[payload[1]]
+
+def gameOverText(outcome):
+    return RESULT_TEXT[outcome[0]] + ' ' + outcome[1]
+
+
+# Text protocol forms of the board and of a list of (x, y) positions
+def boardText(board):
+    return ' '.join(str(item) for item in board.squares)
+
+def positionsText(positions):
+    return ' '.join(','.join(str(i) for i in pos) for pos in positions)
+
+def boardUpdate(version, board):
+    # The whole position, for a client joining or catching up
+    if version >= LEGAL_MOVES_VERSION: return syncFrame(board) + legalMovesFrame(board)
+    if version: return syncFrame(board)
+    return ('BOARD:' + boardText(board)).encode()
+
+
+class MoveUpdate:
+
+    # A move as sent to players and spectators, encoded once per protocol version however many connections it goes to.
+    # outcome is the board's gameResult() after the move, sent along as GAME_OVER when the move ended the game,
+    # and otherwise clients that take them are sent the legal moves of the new position.
+
+    def __init__(self, board, move, versions=(TEXT_PROTOCOL, PROTOCOL_VERSION), outcome=None):
+        self.move, self.ply, self.outcome = move, board.plyCount(), outcome
+        self.data = {}
+        legal_moves = None
+        for version in set(versions):
+            if version:
+                data = moveMadeFrame(self.ply, move)
+                # Binary clients get the whole position every SYNC_INTERVAL plies as well
+                if self.ply % SYNC_INTERVAL == 0: data += syncFrame(board)
+                if outcome is not None:
+                    data += gameOverFrame(outcome)
+                elif version >= LEGAL_MOVES_VERSION:
+                    legal_moves = legal_moves or legalMovesFrame(board)
+                    data += legal_moves
+            else:
+                data = 'MOVE_MADE:' + positionsText([move.startPos, move.endPos]) + '&BOARD:' + boardText(board)
+                if outcome is not None: data += '&GAME_OVER:' + gameOverText(outcome)
+                data = data.encode()
+            self.data[version] = data
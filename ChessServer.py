@@ -3,14 +3,30 @@
 # ChessServer.py
 
 import argparse
+import logging
 import os
-import pickle
+import queue
+import random
+import secrets
+import select
 import socket
+import struct
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import numpy as np
 
-from ChessBoard import ChessBoard
+from ChessBoard import ChessBoard, MoveCache, toPos, toSquare
+from ChessBook import OpeningBook
+from ChessEngine import ChessEngine
+from ChessJournal import GameStore, FINISHED, SEAT_SECRET_SIZE
+from ChessMatchmaking import Matchmaker, Ratings
+from ChessMetrics import METRICS, serveMetrics
+from ChessProtocol import *
+from ChessTablebase import Tablebase
 
 
 def parseArgs():
@@ -18,15 +34,132 @@ def parseArgs():
     parser.add_argument('--host', default='127.0.0.1', type=str, help='host ip of your server (default: localhost)')
     parser.add_argument('--port', default=8080, type=int, help='port to host listen on (default: 8080)')
     parser.add_argument('-c', required=False, default=20, type=int, help='max number of concurrent connections (default: 20)')
+    parser.add_argument('--mode', choices=['thread', 'async', 'sharded'], default='thread', help='one thread per client, one asyncio event loop for all clients, or games split across worker processes (default: thread)')
+    parser.add_argument('--shards', default=None, type=int, help='worker processes for the sharded server (default: one per core)')
+    parser.add_argument('--workers', default=4, type=int, help='threads validating moves for the asyncio server (default: 4)')
+    parser.add_argument('--hello-timeout', default=0.5, type=float, help='seconds to wait for a binary protocol HELLO before treating a client as text (default: 0.5)')
+    parser.add_argument('--move-cache', default=10000, type=int, help='number of positions kept in the legal move cache (default: 10000)')
+    parser.add_argument('--bot-wait', default=0, type=float, help='seconds a player waits alone before playing the computer, 0 disables bots (default: 0)')
+    parser.add_argument('--bot-time', default=500, type=int, help='computer thinking time per move in ms (default: 500)')
+    parser.add_argument('--data-dir', default='saved_games', type=str, help='directory holding the game index and move journals (default: saved_games)')
+    parser.add_argument('--idle-timeout', default=300, type=float, help='seconds a game with nobody connected stays in memory before it is hibernated to disk, 0 keeps it (default: 300)')
+    parser.add_argument('--max-resident-games', default=0, type=int, help='games held in memory (per worker when sharded) before the least recently used idle ones are hibernated, 0 for no limit (default: 0)')
+    parser.add_argument('--fsync-interval', default=50, type=int, help='ms of journal writes grouped into one fsync (default: 50)')
+    parser.add_argument('--book', default=None, type=str, help='opening book file the computer plays from before it starts searching (default: none)')
+    parser.add_argument('--tablebases', default=None, type=str, help='directory of endgame tables the computer plays solved endgames from (default: none)')
+    parser.add_argument('--bot-threads', default=2, type=int, help='number of computer moves searched at once (default: 2)')
+    parser.add_argument('--metrics-port', default=0, type=int, help='local port serving Prometheus metrics at /metrics, 0 disables it (default: 0)')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='DEBUG also logs every client message (default: INFO)')
 
     return parser.parse_args()
 
 
+log = logging.getLogger('ChessServer')
+
+# Updates a spectator can fall behind by before its backlog is replaced with the whole position
+SPECTATOR_QUEUE = 64
+
+# A game just created, loaded or resumed stays in memory at least this many seconds, so its connections can attach first
+EVICTION_GRACE = 2.0
+HIBERNATE_INTERVAL = 1.0
+
+
+def negotiateProtocol(client_socket, timeout):
+    # Binary clients open with a HELLO, SPECTATE or RESUME frame, old text clients send nothing until the game starts
+    # unless they are spectating. Returns the version, the frame reader, the player name, the game to watch
+    # and the session token to resume.
+    reader = FrameReader()
+    client_socket.settimeout(timeout)
+    try:
+        data = client_socket.recv(64)
+        if data.startswith(b'SPECTATE:') and data[9:].strip().isdigit():
+            return TEXT_PROTOCOL, None, None, int(data[9:]), None
+        if data[:1] == b'\x00':
+            # A frame can arrive over several reads, only the first of which starts with the length's high byte
+            frames = reader.feed(data)
+            while not frames and data:
+                data = client_socket.recv(64)
+                frames = reader.feed(data)
+            version = parseHello(frames[0][1]) if frames and frames[0][0] in (HELLO, SPECTATE, RESUME) else None
+            if version is not None:
+                version = min(version, PROTOCOL_VERSION)
+                client_socket.sendall(encodeFrame(WELCOME, bytes([version])))
+                if frames[0][0] == SPECTATE: return version, reader, None, spectateId(frames[0][1]), None
+                if frames[0][0] == RESUME: return version, reader, None, None, resumeToken(frames[0][1])
+                return version, reader, helloName(frames[0][1]), None, None
+    except (socket.timeout, OSError, struct.error):
+        pass
+    finally:
+        client_socket.settimeout(None)
+    return TEXT_PROTOCOL, None, None, None, None
+
+def socketAlive(client_socket):
+    # Waiting clients send nothing, so a readable socket with nothing to peek at has been closed
+    try:
+        if not select.select([client_socket], [], [], 0)[0]: return True
+        return client_socket.recv(1, socket.MSG_PEEK) != b''
+    except (OSError, ValueError):
+        return False
+
+def logMatch(game_id, tickets, matchmaker):
+    players = ' vs '.join(f'{ticket.name or "anonymous"} ({ticket.rating})' for (team, ticket) in sorted(tickets, key=lambda entry: -entry[0]))
+    stats = matchmaker.stats()
+    log.info(f"[MATCH] Game {game_id}: {players}, queue depth {stats['depth']}, wait p50 {stats['wait_p50']}s p99 {stats['wait_p99']}s")
+
+FRAME_NAMES = {POSSIBLE_MOVES: 'POSSIBLE_MOVES', MAKE_MOVE: 'MAKE_MOVE', SYNC_REQUEST: 'SYNC_REQUEST'}
+
+@contextmanager
+def measureRequest(msg_type, protocol):
+    METRICS.count('requests_total', type=msg_type, protocol=protocol)
+    with METRICS.timed('request_seconds', type=msg_type, protocol=protocol):
+        yield
+
+def registerGauges(server):
+    # Scrape-time gauges of a server's connections, games and matchmaking queue
+    METRICS.gauge('active_connections', lambda: sum(client.active for client in server.clients) + server.matchmaker.stats()['depth'],
+                  'open client connections, waiting players included')
+    METRICS.gauge('active_games', lambda: len(server.chess_games.games), 'games held in memory')
+    METRICS.gauge('matchmaking_queue_depth', lambda: server.matchmaker.stats()['depth'], 'players waiting for an opponent')
+    METRICS.gauge('matchmaking_wait_seconds', lambda: {(('quantile', quantile),): server.matchmaker.stats()[f'wait_p{name}']
+                                                       for (quantile, name) in [(0.5, 50), (0.9, 90), (0.99, 99)]},
+                  'time recent players waited to be paired')
+
+def getStrBoard(board):
+    return {'BOARD' : boardText(board)}
+
+def recordResult(ratings, game_id, names, outcome):
+    # ChessGamesObject's on_finish for a server: logs the result and updates the players' ratings
+    (score, reason) = outcome
+    log.info(f'[RESULT] Game {game_id}: {RESULT_TEXT[score]} by {reason}')
+    if names.get(1) is not None or names.get(-1) is not None:
+        ratings.recordResult(names.get(1), names.get(-1), score)
+
+def pruneClients(clients):
+    # Drops sessions whose connection has ended, so finished games do not leave their players behind
+    clients[:] = [client for client in clients if client.active]
+
+
 class ChessGamesObject:
 
-    def __init__(self, games={}):
+    # on_finish(game_id, names, outcome) is called once per game that ends, with outcome as ChessBoard.gameResult() gives it.
+    # Each game's board is only read or moved under that game's lock: even generating its legal moves changes it for a moment.
+    # Games nobody is connected to are hibernated: dropped from memory once idle for idle_timeout seconds, and least recently
+    # used first while more than max_resident are held. Their journal is all they need to be loaded again, when a player
+    # resumes or someone spectates, and bot_factory(game_id, team) then seats the computer again if it was playing.
+
+    def __init__(self, games={}, move_cache_size=10000, store=None, on_finish=None, idle_timeout=0, max_resident=0, bot_factory=None):
         self.lock = threading.Lock()
         self.__games = games
+        self.move_cache = MoveCache(move_cache_size)
+        self.store = store
+        self.on_finish = on_finish
+        self.idle_timeout, self.max_resident = idle_timeout, max_resident
+        self.bot_factory = bot_factory
+        # Game ids from least to most recently used
+        self.last_used = OrderedDict()
+        self.reserved_id = -1
+        if store is not None and (idle_timeout or max_resident):
+            threading.Thread(target=self.hibernateLoop, daemon=True).start()
 
     @property
     def games(self): return self.__games
@@ -38,86 +171,291 @@ class ChessGamesObject:
         with self.lock:
             if delete:
                 del self.games[game_id]
+                self.last_used.pop(game_id, None)
                 return
             self.games[game_id] = new_data
+            self.touch(game_id)
 
+    def touch(self, game_id):
+        # Called with the lock held
+        self.last_used[game_id] = time.monotonic()
+        self.last_used.move_to_end(game_id)
+
+
+    def nextGameId(self):
+        # Reserves the id it returns, since games can be started from several threads at once
+        with self.lock:
+            saved_id = self.store.nextGameId() if self.store is not None else 0
+            self.reserved_id = max(saved_id, max(self.games, default=-1) + 1, self.reserved_id + 1)
+            return self.reserved_id
 
-    def createGame(self, game_id, p1, p2):
+    def createGame(self, game_id, p1, p2, names=None, bot_team=None):
         game = {
             'player 1' : p1,
             'player -1' : p2,
-            'board' : ChessBoard()
+            'board' : ChessBoard(move_cache=self.move_cache),
+            'names' : names or {1: None, -1: None},
+            'bot_team' : bot_team,
+            'spectators' : [],
+            'outcome' : None,
+            'lock' : threading.RLock(),
+            # The secrets of the seats' session tokens, journaled with the game so they outlive hibernation and restarts
+            'seats' : {team: secrets.token_bytes(SEAT_SECRET_SIZE) for team in (1, -1)}
         }
         self.__editGames(game_id, game)
+        if self.store is not None: self.store.createGame(game_id, game['names'], bot_team, game['seats'])
 
+    def getGame(self, game_id):
+        # Games from earlier runs and hibernated games stay on disk until something asks for them
+        with self.lock:
+            if game_id in self.games:
+                self.touch(game_id)
+                return self.games[game_id]
+            if self.store is None or game_id not in self.store.statuses: return None
+            (board, names, bot_team, seats) = self.store.loadGame(game_id, ChessBoard(move_cache=self.move_cache))
+            game = {'player 1' : None, 'player -1' : None, 'board' : board, 'names' : names, 'bot_team' : bot_team, 'spectators' : [],
+                    'outcome' : board.gameResult(), 'lock' : threading.RLock(), 'seats' : seats}
+            self.games[game_id] = game
+            self.touch(game_id)
+        METRICS.count('games_loaded_total')
+        if bot_team is not None and game['outcome'] is None and self.bot_factory is not None: self.bot_factory(game_id, bot_team)
+        return game
+
+    def recordMove(self, game_id, move):
+        with self.lock: self.touch(game_id)
+        if self.store is not None: self.store.appendMove(game_id, self.games[game_id]['board'], move)
+
+    def seatToken(self, game_id, team):
+        # The session token for a seat, the same one however often the seat is resumed
+        return SESSION_TOKEN.pack(game_id, team, self.games[game_id]['seats'][team])
+
+    def resumeSeat(self, token):
+        # (game_id, team) for a valid token of a game still being played, which is loaded again if it was hibernated
+        # or left unfinished by an earlier run. A connection still holding the seat is closed.
+        if len(token) != SESSION_TOKEN.size: return None
+        (game_id, team, secret) = SESSION_TOKEN.unpack(token)
+        if team not in (1, -1) or (self.store is not None and self.store.statuses.get(game_id) == FINISHED): return None
+        game = self.getGame(game_id)
+        if game is None or game['outcome'] is not None: return None
+        # Journals from before seats were saved have no secrets, and those seats cannot be resumed
+        known = game['seats'].get(team, b'')
+        if not any(known) or not secrets.compare_digest(known, secret): return None
+        previous = game[f'player {team}']
+        if previous is not None and previous.active: previous.endConnection()
+        return game_id, team
+
+    def isIdle(self, game):
+        # Nobody is connected to the game, the computer does not count
+        receivers = [game['player 1'], game['player -1'], *game['spectators']]
+        return not any(receiver.active for receiver in receivers if receiver is not None and not isinstance(receiver, BotPlayer))
+
+    def hibernateIdle(self):
+        # Drops idle games past the idle timeout, then the least recently used idle games while over max_resident
+        now = time.monotonic()
+        evicted = []
+        with self.lock:
+            excess = len(self.games) - self.max_resident if self.max_resident else 0
+            for (game_id, used) in list(self.last_used.items()):
+                # Ordered by last use, so the rest are newer still
+                if now - used < EVICTION_GRACE: break
+                expired = self.idle_timeout and now - used >= self.idle_timeout
+                if not expired and excess <= 0: break
+                game = self.games.get(game_id)
+                if game is None or not self.isIdle(game): continue
+                # A game whose lock is held is being moved in, by the computer since nobody else is connected.
+                # Under its lock the computer is stopped, so a search finishing later is never played into a released game.
+                if not game['lock'].acquire(blocking=False): continue
+                bot = game[f"player {game['bot_team']}"] if game['bot_team'] is not None else None
+                if bot is not None: bot.endConnection()
+                game['lock'].release()
+                del self.games[game_id]
+                del self.last_used[game_id]
+                evicted.append((game_id, game, now - used))
+                excess -= 1
 
+        for (game_id, game, idle) in evicted:
+            self.store.releaseGame(game_id)
+            METRICS.count('games_hibernated_total')
+            log.debug(f'[HIBERNATE] Game {game_id} left memory after {idle:.0f}s unused')
+        return len(evicted)
 
-class ClientThread:
+    def hibernateLoop(self):
+        while True:
+            time.sleep(HIBERNATE_INTERVAL)
+            self.hibernateIdle()
+
+    def broadcastMove(self, game_id, team, move):
+        # Encodes the move once per protocol in use and hands the same bytes to the opponent and every spectator.
+        # Whether the move ended the game is worked out first, so it goes out with the move. Returns that outcome.
+        game = self.games[game_id]
+        other_player = game[f'player {-team}']
+        # Spectators are queued their update under the game's lock, in order with any whole positions taken for them
+        with game['lock']:
+            with self.lock: spectators = list(game['spectators'])
+            with METRICS.timed('board_seconds', method='gameResult'):
+                game['outcome'] = game['board'].gameResult()
+            versions = [receiver.version for receiver in spectators + [other_player] if hasattr(receiver, 'version')]
+            update = MoveUpdate(game['board'], move, versions, game['outcome'])
+            for spectator in spectators: spectator.push(update.data[spectator.version])
+        if other_player is not None: other_player.sendMoveMade(update)
+        return game['outcome']
+
+    def finishGame(self, game_id):
+        # Called by whoever made the last move once its own response is sent: marks the game finished, reports the result,
+        # then closes every connection to the game and releases it
+        with self.lock:
+            game = self.games.pop(game_id, None)
+            self.last_used.pop(game_id, None)
+        if game is None: return
+        METRICS.count('games_finished_total', reason=game['outcome'][1])
+        if self.store is not None:
+            self.store.setStatus(game_id, FINISHED)
+            self.store.releaseGame(game_id)
+        if self.on_finish is not None: self.on_finish(game_id, game['names'], game['outcome'])
+        for receiver in [game['player 1'], game['player -1'], *game['spectators']]:
+            if receiver is not None and receiver.active: receiver.endConnection()
+
+    def addSpectator(self, game_id, spectator):
+        with self.lock: self.games[game_id]['spectators'].append(spectator)
+
+    def removeSpectator(self, game_id, spectator):
+        with self.lock:
+            game = self.games.get(game_id)
+            if game is not None and spectator in game['spectators']: game['spectators'].remove(spectator)
 
-    def __init__(self, client_socket, client_address, game_object, game_id, team):
-        self.client_socket, self.client_address = client_socket, client_address
+
+
+class ClientSession:
+
+    # A player's seat in a game and the handling of their requests, shared by the threaded and asyncio servers.
+    # version is the negotiated ChessProtocol version, TEXT_PROTOCOL for old clients. Subclasses deliver bytes with sendBytes.
+    # Clients that can resume are sent the seat's session token first; the seat outlives the connection until the game ends.
+
+    def __init__(self, game_object, game_id, team, version=TEXT_PROTOCOL):
         self.game_object, self.game_id, self.team = game_object, game_id, team
-        self.game_object.games[game_id][f'player {team}'] = self
+        self.version = version
+        self.game = self.game_object.games[game_id]
+        self.game[f'player {team}'] = self
         self.active = True
-        self.get_board = lambda: game_object.games[game_id]['board']
+        self.get_board = lambda: self.game['board']
         self.board = self.get_board()
-        
-        initial_msg = lambda: self.sendMsg(self.getStrBoard())
-        t = threading.Timer(1.0, initial_msg)
-        t.start()
+        self.outcome = None
+        if version >= SESSION_VERSION: self.sendBytes(sessionFrame(game_object.seatToken(game_id, team)))
 
-        handler_thread = threading.Thread(target=self.handleClient)
-        handler_thread.start()
-
-    def handleClient(self):
-        while self.active:
-            msg = self.client_socket.recv(64).decode()
-            print(msg)
-            if msg == '!DISCONNECT': break
-            
-            self.handleMsg(msg)
+    def sendBytes(self, data):
+        raise NotImplementedError
 
     def sendMsg(self, data):
+        self.sendBytes(self.formatMsg(data))
+
+    def formatMsg(self, data):
         if isinstance(data, dict):
             data = '&'.join(key+':'+val for key, val in data.items())
-        self.client_socket.send(data.encode())
-
-    def endConnection(self):
-        self.sendMsg('!DISCONNECT')
-        self.active = False
-        self.client_socket.close()
+        return data.encode()
 
     def getStrBoard(self):
-        board = self.get_board().getBoardValues()
-        new_board = []
-        for row in board: new_board += [item for item in row]
-        return {'BOARD' : ' '.join(str(item) for item in new_board)}
+        with self.game['lock']: return getStrBoard(self.get_board())
+
+    def sendBoard(self):
+        with self.game['lock']: data = boardUpdate(self.version, self.board)
+        self.sendBytes(data)
+
+    def sendStartingBoard(self):
+        # Timed to follow GAME_START, by when a short game may already have ended
+        if self.active: self.sendBoard()
+
+    def sendMoveMade(self, update):
+        # A player who lost the connection catches up with the whole position on resuming
+        if self.active: self.sendBytes(update.data[self.version])
+
+    def legalTargets(self, square):
+        # Squares the piece on square can reach, read from the position's cached legal moves rather than generated per request
+        targets = []
+        with self.game['lock']: moves = self.board.legalMoves()
+        for move in moves:
+            if move.start == square and move.end not in targets: targets.append(move.end)
+        return targets
+
+    def tryMove(self, start, end, promotion=2):
+        with self.game['lock']:
+            if self.board.turn != self.team or self.game['outcome'] is not None: return None
+            with METRICS.timed('board_seconds', method='legalMoves'):
+                moves = [move for move in self.board.legalMoves() if move.start == start and move.end == end]
+            if not moves: return None
+
+            move = next((move for move in moves if move.promotion == promotion), moves[0])
+            with METRICS.timed('board_seconds', method='makeMove'):
+                self.board.makeMove(move)
+            self.game_object.recordMove(self.game_id, move)
+            self.outcome = self.game_object.broadcastMove(self.game_id, self.team, move)
+            return move
 
     def handleMsg(self, msg):
         responses = {}
         reqs = msg.split('&')
         for req in reqs:
             sub_reqs = req.split(':')
-            if sub_reqs[0] == 'POSSIBLE_MOVES':
+            try:
+                self.handleTextRequest(sub_reqs, responses)
+            except (ValueError, IndexError):
+                log.warning(f'[MESSAGE] Game {self.game_id} team {self.team}: unreadable request {req!r}')
+                responses['MSG'] = 'FAILURE'
+
+        self.sendMsg(responses)
+        if self.outcome is not None: self.game_object.finishGame(self.game_id)
+
+    def handleTextRequest(self, sub_reqs, responses):
+        if sub_reqs[0] == 'POSSIBLE_MOVES':
+            with measureRequest('POSSIBLE_MOVES', 'text'):
                 (x, y) = tuple([int(item) for item in sub_reqs[1].split(',')])
                 if 0 <= x < 8 and 0 <= y < 8:
-                    if self.board.board[y][x] != 0 and self.board.board[y][x].team == self.team and self.team == self.board.turn:
-                        pos_moves = self.getPosList(self.board.getPossibleMoves((x, y)), self.team)
+                    with self.game['lock']: piece = self.board.board[y][x]
+                    if piece != 0 and piece.team == self.team and self.team == self.board.turn:
+                        with METRICS.timed('board_seconds', method='legalMoves'):
+                            pos_moves = self.getPosList([toPos(end) for end in self.legalTargets(toSquare((x, y)))], self.team)
                         responses['POS_MOVES_LIST'] = pos_moves
-            if sub_reqs[0] == 'MAKE_MOVE':
+        if sub_reqs[0] == 'MAKE_MOVE':
+            with measureRequest('MAKE_MOVE', 'text'):
                 moves = self.getPosList(sub_reqs[1], self.team)
-                if self.board.turn == self.team and moves[1] in self.board.getPossibleMoves(moves[0]):
-                    self.board.movePiece(*moves)
-                    str_board = self.getStrBoard()
-                    other_player = self.game_object.games[self.game_id][f'player {-self.team}']
-                    other_msg = {'MOVE_MADE':self.getPosList(moves, -self.team,), 'BOARD':other_player.getStrBoard()['BOARD']}
-                    other_player.sendMsg(other_msg)
-                    responses['MSG'] = 'SUCCESS'
-                    responses['BOARD'] = str_board['BOARD']
-                else:
-                    responses['MSG'] = 'FAILURE'
-
-        self.sendMsg(responses)
+                # The board sent back is the one the move made, even if the computer is quick to answer it
+                with self.game['lock']:
+                    if self.tryMove(toSquare(moves[0]), toSquare(moves[1])) is not None:
+                        responses['MSG'] = 'SUCCESS'
+                        responses['BOARD'] = self.getStrBoard()['BOARD']
+                        if self.outcome is not None: responses['GAME_OVER'] = gameOverText(self.outcome)
+                    else:
+                        responses['MSG'] = 'FAILURE'
+
+    def handleFrame(self, msg_type, payload):
+        # A frame too short for its type means the client is not speaking the protocol, so it is disconnected
+        try:
+            with measureRequest(FRAME_NAMES.get(msg_type, 'OTHER'), 'binary'):
+                self.handleRequest(msg_type, payload)
+        except (ValueError, IndexError, struct.error):
+            log.warning(f'[MESSAGE] Game {self.game_id} team {self.team}: malformed frame {msg_type} {payload.hex()}')
+            self.endConnection()
+
+    def handleRequest(self, msg_type, payload):
+        if msg_type == POSSIBLE_MOVES:
+            square = payload[0]
+            moves = []
+            with self.game['lock']: own_turn = square < 64 and self.board.squares[square]*self.team > 0 and self.team == self.board.turn
+            if own_turn:
+                with METRICS.timed('board_seconds', method='legalMoves'):
+                    moves = self.legalTargets(square)
+            self.sendBytes(encodeFrame(POS_MOVES_LIST, bytes([square] + moves)))
+        elif msg_type == MAKE_MOVE:
+            request = decodeMove(payload)
+            with self.game['lock']:
+                move = self.tryMove(request.start, request.end, request.promotion or 2)
+                ply = self.board.plyCount()
+            data = encodeFrame(RESULT, bytes([move is not None]))
+            if move is not None: data += moveMadeFrame(ply, move)
+            if move is not None and self.outcome is not None: data += gameOverFrame(self.outcome)
+            self.sendBytes(data)
+            if self.outcome is not None: self.game_object.finishGame(self.game_id)
+        elif msg_type == SYNC_REQUEST:
+            self.sendBoard()
 
     def getPosList(self, in_list, team):
         if isinstance(in_list, str):
@@ -130,18 +468,221 @@ class ClientThread:
             return str_list
 
 
+class ClientThread(ClientSession):
+
+    # The board follows GAME_START after board_delay seconds, which keeps the two apart for text clients.
+    # The player's thread, the opponent's and the board timer all write to the socket, one whole frame at a time.
+
+    def __init__(self, client_socket, client_address, game_object, game_id, team, version=TEXT_PROTOCOL, reader=None, board_delay=1.0):
+        self.client_socket, self.client_address = client_socket, client_address
+        self.reader = reader or FrameReader()
+        self.send_lock = threading.Lock()
+        super().__init__(game_object, game_id, team, version)
+        
+        t = threading.Timer(board_delay, self.sendStartingBoard)
+        t.start()
+
+        handler_thread = threading.Thread(target=self.handleClient)
+        handler_thread.start()
+
+    def handleClient(self):
+        # However the loop ends the seat is left, so the game can be hibernated and the seat resumed
+        try:
+            while self.active:
+                try:
+                    data = self.client_socket.recv(4096 if self.version else 64)
+                except OSError:
+                    break
+                METRICS.count('bytes_received_total', len(data))
+                if self.version:
+                    if not data: break
+                    for (msg_type, payload) in self.reader.feed(data):
+                        if msg_type == DISCONNECT or not self.active: self.active = False; break
+                        self.handleFrame(msg_type, payload)
+                    continue
+
+                msg = data.decode(errors='replace')
+                log.debug(f'[MESSAGE] Game {self.game_id} team {self.team}: {msg}')
+                if not msg or msg == '!DISCONNECT': break
+
+                self.handleMsg(msg)
+        finally:
+            self.active = False
+
+    def sendBytes(self, data):
+        METRICS.count('bytes_sent_total', len(data))
+        try:
+            with self.send_lock: self.client_socket.sendall(data)
+        except OSError:
+            self.active = False
+
+    def endConnection(self):
+        self.active = False
+        try:
+            self.sendBytes(encodeFrame(DISCONNECT) if self.version else b'!DISCONNECT')
+        except OSError:
+            pass
+        self.client_socket.close()
+
+
+class SpectatorSession:
+
+    # Watches a game without a seat. Subclasses deliver with push, where None stands for the whole current position.
+    # Spectators can only ask for the position again or leave.
+
+    def __init__(self, game_object, game_id, version=TEXT_PROTOCOL):
+        self.game_object, self.game_id, self.version = game_object, game_id, version
+        self.game = game_object.games[game_id]
+        self.board = self.game['board']
+        self.active = True
+
+    def push(self, data):
+        raise NotImplementedError
+
+    def fullUpdate(self):
+        with self.game['lock']: return boardUpdate(self.version, self.board)
+
+    def watch(self):
+        # The first whole position and joining the game's spectators happen together, so no move falls between them
+        with self.game['lock']:
+            self.push(None)
+            self.game_object.addSpectator(self.game_id, self)
+
+    def resync(self):
+        self.push(None)
+
+    def handleData(self, data):
+        # False once the spectator has left
+        if not data: return False
+        if not self.version: return data != b'!DISCONNECT'
+        for (msg_type, payload) in self.reader.feed(data):
+            if msg_type == SYNC_REQUEST: self.resync()
+            elif msg_type == DISCONNECT: return False
+        return True
+
+
+class SpectatorThread(SpectatorSession):
+
+    # Updates wait in a bounded queue drained by the spectator's own sender thread, so a slow connection
+    # only holds up itself. A full queue is replaced by a single full position. Whole positions are taken
+    # when they are queued, so they always fall between the same moves they would have when sent.
+
+    def __init__(self, client_socket, client_address, game_object, game_id, version=TEXT_PROTOCOL, reader=None):
+        self.client_socket, self.client_address = client_socket, client_address
+        self.reader = reader or FrameReader()
+        super().__init__(game_object, game_id, version)
+        self.queue = queue.Queue(SPECTATOR_QUEUE)
+        self.watch()
+
+        threading.Thread(target=self.sendLoop).start()
+        threading.Thread(target=self.handleClient).start()
+
+    def push(self, data):
+        try:
+            self.queue.put_nowait(self.fullUpdate() if data is None else data)
+        except queue.Full:
+            with self.queue.mutex: self.queue.queue.clear()
+            self.queue.put_nowait(self.fullUpdate())
+
+    def sendLoop(self):
+        while True:
+            data = self.queue.get()
+            if not self.active: break
+            try:
+                self.client_socket.sendall(data)
+            except OSError:
+                break
+            METRICS.count('bytes_sent_total', len(data))
+        self.endConnection()
+
+    def handleClient(self):
+        while self.active:
+            try:
+                data = self.client_socket.recv(4096)
+            except OSError:
+                break
+            METRICS.count('bytes_received_total', len(data))
+            if not self.handleData(data): break
+        self.endConnection()
+
+    def endConnection(self):
+        if not self.active: return
+        self.active = False
+        self.game_object.removeSpectator(self.game_id, self)
+        self.push(b'')
+        try:
+            self.client_socket.sendall(encodeFrame(DISCONNECT) if self.version else b'!DISCONNECT')
+        except OSError:
+            pass
+        self.client_socket.close()
+
+
+class BotPlayer:
+
+    # Takes a player seat in a game and answers every move with a book move while it has one, then an engine move,
+    # searched on a shared executor
+
+    def __init__(self, game_object, game_id, team, executor, think_time, book=None, tablebase=None):
+        self.game_object, self.game_id, self.team = game_object, game_id, team
+        self.game = self.game_object.games[game_id]
+        self.game[f'player {team}'] = self
+        self.board = self.game['board']
+        self.engine = ChessEngine(table_bits=14, tablebase=tablebase)
+        self.executor, self.think_time = executor, think_time
+        self.book = book
+        self.active = True
+
+        # Give the opponent time to receive the starting board before a first move as white
+        threading.Timer(1.5, self.requestMove).start()
+
+    def requestMove(self):
+        if self.active and self.board.turn == self.team:
+            self.executor.submit(self.playMove)
+
+    def playMove(self):
+        # Thinks on a copy so the game's board is only held for taking it and for the move
+        with self.game['lock']: board = self.board.duplicateBoard()
+        move = self.book.chooseMove(board) if self.book is not None else None
+        if move is None: move = self.engine.bestMove(board, self.think_time)
+        with self.game['lock']:
+            # Hibernation stops the computer under this lock, and the game may have left memory while it thought
+            if move is None or not self.active or self.board.turn != self.team: return
+            self.board.makeMove(move)
+            self.game_object.recordMove(self.game_id, move)
+            outcome = self.game_object.broadcastMove(self.game_id, self.team, move)
+        if outcome is not None: self.game_object.finishGame(self.game_id)
+
+    def sendMoveMade(self, update):
+        if update.outcome is None: self.requestMove()
+
+    def endConnection(self):
+        self.active = False
+
+
+
 class ChessServer:
 
-    def __init__(self, host, port, max_conns):
+    def __init__(self, host, port, max_conns, move_cache_size=10000, bot_wait=0, bot_time=500, bot_threads=2, hello_timeout=0.5,
+                 data_dir='saved_games', fsync_interval=50, metrics_port=0, book=None, tablebases=None, idle_timeout=300, max_resident_games=0):
         self.host, self.port, self.max_conns = host, port, max_conns
-
-        games = {}
-        with open('saved_chess_games.txt', 'rb') as f:
-            games = pickle.load(f)
-        print(f'Starting with {len(games)} active sessions')
-        self.chess_games = ChessGamesObject(games=games)
+        self.bot_wait, self.bot_time = bot_wait, bot_time
+        self.hello_timeout = hello_timeout
+        self.bot_executor = ThreadPoolExecutor(max_workers=bot_threads)
+        self.book = OpeningBook(book) if book else None
+        self.tablebase = Tablebase(tablebases) if tablebases else None
+
+        store = GameStore(data_dir, fsync_interval / 1000)
+        log.info(f'Starting with {len(store.statuses)} saved games')
+        self.chess_games = ChessGamesObject(games={}, move_cache_size=move_cache_size, store=store,
+                                            on_finish=lambda *result: recordResult(self.ratings, *result),
+                                            idle_timeout=idle_timeout, max_resident=max_resident_games, bot_factory=self.startBot)
         self.clients = []
-        self.waiting_room = []
+        self.ratings = Ratings(os.path.join(data_dir, 'ratings.json'))
+        self.matchmaker = Matchmaker(self.pairPlayers, self.pairWithBot, bot_wait, self.evictPlayer)
+        registerGauges(self)
+        if metrics_port:
+            serveMetrics(metrics_port)
+            log.info(f'Serving metrics on 127.0.0.1 at port {metrics_port}')
 
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.bind((self.host, self.port))
@@ -150,33 +691,112 @@ class ChessServer:
 
     def listenForClients(self):
         self.server.listen(self.max_conns)
-        print(f'Accepting clients on {self.host} at port {self.port}')
+        log.info(f'Accepting clients on {self.host} at port {self.port}')
         while True:
             try:
                 client_socket, client_address = self.server.accept()
             except KeyboardInterrupt:
-                print('\nExiting...')
-                self.server.close()
+                log.info('Exiting...')
+                self.close()
                 return
 
-            print(f'[CONNECTION] New connection to {client_address[0]}')
-            self.handleClient(client_socket, client_address)
+            # Moves go out as frames of a few bytes, which Nagle's algorithm would hold back waiting for an ACK
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            METRICS.count('connections_total')
+            log.info(f'[CONNECTION] New connection to {client_address[0]}')
+            threading.Thread(target=self.handleClient, args=(client_socket, client_address)).start()
 
-    def handleClient(self, client_socket, client_address):
-        self.waiting_room.append((client_socket, client_address))
-        client_socket.send(b'WAITING')
+    def close(self):
+        self.server.close()
+        self.chess_games.store.close()
 
-        if len(self.waiting_room) >= 2:
-            game_id = len(self.chess_games.games)
-            self.chess_games.createGame(game_id, None, None)
-            for team in [1, -1]:
-                player = self.waiting_room.pop(0)
-                player[0].send(b''); player[0].send(b'ENTERING GAME ' + str(game_id).encode() + b' ' + str(team).encode())
-                client_thread = ClientThread(*player, self.chess_games, game_id, team)
-                self.clients.append(client_thread)
+    def handleClient(self, client_socket, client_address):
+        (version, reader, name, spectate, resume) = negotiateProtocol(client_socket, self.hello_timeout)
+        if spectate is not None:
+            self.startSpectating(spectate, (client_socket, client_address, version, reader))
+            return
+        if resume is not None:
+            self.resumeGame(resume, (client_socket, client_address, version, reader))
+            return
+        client_socket.sendall(waitingMsg(version))
+        self.matchmaker.join((client_socket, client_address, version, reader), name, self.ratings.get(name),
+                             lambda: socketAlive(client_socket))
+
+    def pairPlayers(self, first, second):
+        self.startGame([(1, first), (-1, second)])
+
+    def pairWithBot(self, ticket):
+        team = random.choice([1, -1])
+        self.startGame([(team, ticket)], bot_team=-team)
+
+    def evictPlayer(self, ticket):
+        log.info(f'[MATCH] Dropped {ticket.name or ticket.player[1][0]} from the queue after it disconnected')
+        ticket.player[0].close()
+
+    def startSpectating(self, game_id, player):
+        (client_socket, client_address, version, reader) = player
+        if self.chess_games.getGame(game_id) is None:
+            client_socket.sendall(encodeFrame(DISCONNECT) if version else b'!DISCONNECT')
+            client_socket.close()
+            return
+        log.info(f'[SPECTATE] {client_address[0]} watching game {game_id}')
+        client_socket.sendall(enteringMsg(version, game_id, 0))
+        pruneClients(self.clients)
+        self.clients.append(SpectatorThread(client_socket, client_address, self.chess_games, game_id, version, reader))
+
+    def resumeGame(self, token, player):
+        (client_socket, client_address, version, reader) = player
+        seat = self.chess_games.resumeSeat(token)
+        if seat is None:
+            client_socket.sendall(encodeFrame(DISCONNECT))
+            client_socket.close()
+            return
+        (game_id, team) = seat
+        log.info(f'[RESUME] {client_address[0]} back in game {game_id} as team {team}')
+        client_socket.sendall(enteringMsg(version, game_id, team))
+        pruneClients(self.clients)
+        self.clients.append(ClientThread(client_socket, client_address, self.chess_games, game_id, team, version, reader, board_delay=0))
+
+    def startBot(self, game_id, team):
+        return BotPlayer(self.chess_games, game_id, team, self.bot_executor, self.bot_time, self.book, self.tablebase)
+
+    def startGame(self, tickets, bot_team=None):
+        # tickets are (team, matchmaking ticket) pairs, called by the matchmaker once its lock is released
+        game_id = self.chess_games.nextGameId()
+        self.chess_games.createGame(game_id, None, None, {team: ticket.name for (team, ticket) in tickets}, bot_team)
+        logMatch(game_id, tickets, self.matchmaker)
+        if bot_team is not None:
+            log.info(f'[BOT] Game {game_id} against the computer')
+            self.startBot(game_id, bot_team)
+        for (team, ticket) in tickets:
+            (player_socket, player_address, version, reader) = ticket.player
+            player_socket.sendall(enteringMsg(version, game_id, team))
+            client_thread = ClientThread(player_socket, player_address, self.chess_games, game_id, team, version, reader)
+            pruneClients(self.clients)
+            self.clients.append(client_thread)
 
 
 
 if __name__ == "__main__":
     args = parseArgs()
-    server = ChessServer(host=args.host, port=args.port, max_conns=args.c)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+    if args.mode == 'async':
+        from AsyncChessServer import AsyncChessServer
+        server = AsyncChessServer(host=args.host, port=args.port, max_conns=args.c, move_cache_size=args.move_cache,
+                                  bot_wait=args.bot_wait, bot_time=args.bot_time, bot_threads=args.bot_threads, workers=args.workers,
+                                  hello_timeout=args.hello_timeout, data_dir=args.data_dir, fsync_interval=args.fsync_interval,
+                                  metrics_port=args.metrics_port, book=args.book, tablebases=args.tablebases,
+                                  idle_timeout=args.idle_timeout, max_resident_games=args.max_resident_games)
+    elif args.mode == 'sharded':
+        from ShardedChessServer import ShardedChessServer
+        server = ShardedChessServer(host=args.host, port=args.port, max_conns=args.c, move_cache_size=args.move_cache,
+                                    bot_wait=args.bot_wait, bot_time=args.bot_time, bot_threads=args.bot_threads,
+                                    hello_timeout=args.hello_timeout, data_dir=args.data_dir, fsync_interval=args.fsync_interval,
+                                    shards=args.shards, metrics_port=args.metrics_port, book=args.book, tablebases=args.tablebases,
+                                    idle_timeout=args.idle_timeout, max_resident_games=args.max_resident_games)
+    else:
+        server = ChessServer(host=args.host, port=args.port, max_conns=args.c, move_cache_size=args.move_cache,
+                             bot_wait=args.bot_wait, bot_time=args.bot_time, bot_threads=args.bot_threads,
+                             hello_timeout=args.hello_timeout, data_dir=args.data_dir, fsync_interval=args.fsync_interval,
+                             metrics_port=args.metrics_port, book=args.book, tablebases=args.tablebases,
+                             idle_timeout=args.idle_timeout, max_resident_games=args.max_resident_games)
@@ -0,0 +1,44 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessSprites.py
+
+import os
+
+import pygame
+
+
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images')
+PIECE_VALUES = [*range(-6, 0), *range(1, 7)]
+
+
+def imagePath(value, image_dir=IMAGE_DIR):
+    return os.path.join(image_dir, f'Chess_{value}.png')
+
+
+class SpriteAtlas:
+
+    # The piece images of the process, read from disk once and converted for fast blits on first use
+    # (which needs the display mode to be set). Scaled copies are made once per square size and kept.
+
+    def __init__(self, image_dir=IMAGE_DIR):
+        self.image_dir = image_dir
+        self.originals = None
+        self.scaled = {}
+
+    def load(self):
+        if self.originals is None:
+            self.originals = {value: pygame.image.load(imagePath(value, self.image_dir)).convert_alpha() for value in PIECE_VALUES}
+        return self.originals
+
+    def pieces(self, square_size):
+        images = self.scaled.get(square_size)
+        if images is None:
+            images = {value: pygame.transform.smoothscale(image, (square_size, square_size)) for (value, image) in self.load().items()}
+            self.scaled[square_size] = images
+        return images
+
+    def icon(self):
+        return pygame.image.load(imagePath(-6, self.image_dir))
+
+
+SPRITES = SpriteAtlas()
@@ -0,0 +1,253 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ChessTablebase.py
+
+import argparse
+import mmap
+import os
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ChessBoard import ChessBoard, FEN_PIECES, KING_MOVES, PROMOTION
+
+
+# Every table has the stronger side as white with king, king and one piece, indexed by
+# side to move (white first), white king square, black king square and the piece's square: 2*64*64*64 entries.
+# Entries are signed bytes: plies to mate when the side to move wins, -(plies to mate + 1) when it loses, 0 for a draw.
+TABLES = ('KQK', 'KRK', 'KPK')
+TABLE_SIZE = 2 * 64 * 64 * 64
+HEADER = b'CTB1'
+# Material with a lone minor piece can never be won, so it needs no table
+DRAWN_MATERIAL = ('KBK', 'KNK')
+# Promotions play into these tables, which have to be generated first
+PROMOTION_TABLES = {2: 'KQK', 5: 'KRK'}
+
+ILLEGAL = 255
+# Successors outside the table (captures and promotions) point at constant nodes after the positions, one per stored value
+CONSTANT_NODES = 256
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Generates and probes endgame tablebases")
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', help='generate tables by retrograde analysis')
+    generate.add_argument('--dir', default='tablebases', type=str, help='directory the tables are written to (default: tablebases)')
+    generate.add_argument('-t', '--table', action='append', choices=TABLES, help='table to generate, can be repeated (default: all)')
+    generate.add_argument('-w', '--workers', default=1, type=int, help='processes generating moves (default: 1)')
+    probe = commands.add_parser('probe', help='look a position up')
+    probe.add_argument('fen', type=str, help='position to look up')
+    probe.add_argument('--dir', default='tablebases', type=str, help='directory holding the tables (default: tablebases)')
+
+    return parser.parse_args()
+
+
+def tableIndex(turn, white_king, black_king, piece):
+    return (0 if turn == 1 else 1) << 18 | white_king << 12 | black_king << 6 | piece
+
+def splitIndex(index):
+    return (1 if index >> 18 == 0 else -1), index >> 12 & 63, index >> 6 & 63, index & 63
+
+def tablePath(directory, name):
+    return os.path.join(directory, f'{name}.tb')
+
+
+class Tablebase:
+
+    # The tables found in a directory, mapped read-only so probes cost an index calculation and one byte read
+
+    def __init__(self, directory='tablebases'):
+        self.directory = directory
+        self.files, self.tables = [], {}
+        for name in TABLES:
+            if not os.path.exists(tablePath(directory, name)): continue
+            table_file = open(tablePath(directory, name), 'rb')
+            data = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if data[:len(HEADER)] != HEADER or len(data) != len(HEADER) + TABLE_SIZE:
+                raise ValueError(f'{tablePath(directory, name)} is not a tablebase')
+            self.files.append(table_file)
+            self.tables[name] = data
+
+    def __contains__(self, name): return name in self.tables
+
+    def value(self, name, index):
+        value = self.tables[name][len(HEADER) + index]
+        return value - 256 if value > 127 else value
+
+    def probe(self, board):
+        # The stored value for board from its side to move, or None when no table covers the position
+        if board.castling: return None
+        pieces = [(square, value) for (square, value) in enumerate(board.squares) if value != 0]
+        if len(pieces) == 2: return 0
+        if len(pieces) != 3: return None
+
+        (square, value) = next((square, value) for (square, value) in pieces if abs(value) != 1)
+        name = 'K' + 'KQBNRP'[abs(value) - 1] + 'K'
+        if name in DRAWN_MATERIAL: return 0
+        if name not in self.tables: return None
+        (white_king, black_king, turn) = (board.kings[1], board.kings[-1], board.turn)
+        if value < 0:
+            # Black has the piece, so look up the mirrored position with colours swapped
+            (white_king, black_king, square, turn) = (black_king ^ 56, white_king ^ 56, square ^ 56, -turn)
+        return self.value(name, tableIndex(turn, white_king, black_king, square))
+
+    def bestMove(self, board):
+        # The legal move that wins fastest, else draws, else loses slowest, or None when board is not covered
+        if self.probe(board) is None: return None
+        (best_move, best_key) = (None, None)
+        for move in board.generateLegalMoves():
+            board.makeMove(move)
+            value = self.probe(board)
+            board.unmakeMove()
+            if value is None: return None
+            key = (2, value) if value < 0 else (1, 0) if value == 0 else (0, value)
+            if best_key is None or key > best_key: (best_move, best_key) = (move, key)
+        return best_move
+
+    def close(self):
+        for data in self.tables.values(): data.close()
+        for table_file in self.files: table_file.close()
+
+
+def successorChunk(name, start, stop, directory):
+    # Move generation for the table entries start..stop: a move count per entry (ILLEGAL for impossible placements,
+    # with 0 meaning mate or stalemate), whether the side to move is in check, and the successor node of every move
+    piece_value = FEN_PIECES[name[1].lower()]
+    tablebase = Tablebase(directory) if piece_value == 6 else None
+    board = ChessBoard()
+    board.castling, board.en_passant, board.hash = 0, None, 0
+    (degrees, checks, targets) = (array('B'), array('B'), array('I'))
+
+    for index in range(start, stop):
+        (turn, white_king, black_king, piece) = splitIndex(index)
+        if len({white_king, black_king, piece}) < 3 or black_king in KING_MOVES[white_king] or (piece_value == 6 and not 8 <= piece < 56):
+            degrees.append(ILLEGAL)
+            checks.append(0)
+            continue
+
+        board.squares = array('b', [0] * 64)
+        board.squares[white_king], board.squares[black_king], board.squares[piece] = 1, -1, piece_value
+        board.kings = {1: white_king, -1: black_king}
+        board.turn = turn
+        board.history = []
+        if board.checkForCheck(-turn):
+            degrees.append(ILLEGAL)
+            checks.append(0)
+            continue
+
+        moves = board.generateLegalMoves()
+        degrees.append(len(moves))
+        checks.append(board.checkForCheck(turn))
+        for move in moves:
+            if move.end == piece:
+                # The lone king takes the piece, leaving a draw
+                targets.append(TABLE_SIZE + 128)
+            elif move.flag == PROMOTION:
+                promoted = PROMOTION_TABLES.get(move.promotion)
+                value = 0 if promoted is None else tablebase.value(promoted, tableIndex(-1, white_king, black_king, move.end))
+                targets.append(TABLE_SIZE + 128 + value)
+            elif move.start == piece:
+                targets.append(tableIndex(-turn, white_king, black_king, move.end))
+            elif turn == 1:
+                targets.append(tableIndex(-turn, move.end, black_king, piece))
+            else:
+                targets.append(tableIndex(-turn, white_king, move.end, piece))
+
+    return degrees.tobytes(), checks.tobytes(), targets.tobytes()
+
+
+def solve(degrees, checks, targets):
+    # Retrograde analysis over the successor graph, one ply of distance per pass: a position is won in k plies once
+    # a successor is lost in k-1, and lost in k once every successor is won in at most k-1 (and one in exactly k-1)
+    values = np.zeros(TABLE_SIZE + CONSTANT_NODES, np.int16)
+    values[TABLE_SIZE:] = np.arange(-128, 128)
+    plies = np.full(TABLE_SIZE + CONSTANT_NODES, -1, np.int16)
+    constants = values[TABLE_SIZE:]
+    plies[TABLE_SIZE:] = np.where(constants > 0, constants, np.where(constants < 0, -constants - 1, -1))
+
+    legal = degrees != ILLEGAL
+    mated = legal & (degrees == 0) & (checks == 1)
+    values[:TABLE_SIZE][mated] = -1
+    plies[:TABLE_SIZE][mated] = 0
+
+    movers = np.flatnonzero(legal & (degrees > 0))
+    starts = np.concatenate(([0], np.cumsum(np.where(legal, degrees, 0).astype(np.int64))))[movers]
+    open_movers = np.ones(len(movers), bool)
+    last_constant = int(plies[TABLE_SIZE:].max())
+
+    for ply in range(1, 128):
+        child_values = values[targets]
+        child_plies = plies[targets]
+        known = (child_plies >= 0) & (child_plies <= ply - 1)
+        child_lost = known & (child_values < 0)
+        child_won = known & (child_values > 0)
+
+        wins = open_movers & np.logical_or.reduceat(child_lost, starts)
+        losses = open_movers & ~wins & np.logical_and.reduceat(child_won, starts)
+        if not wins.any() and not losses.any():
+            if ply > last_constant: break
+            continue
+        values[movers[wins]] = ply
+        values[movers[losses]] = -ply - 1
+        plies[movers[wins | losses]] = ply
+        open_movers &= ~(wins | losses)
+
+    return values[:TABLE_SIZE].astype(np.int8)
+
+def generateTable(name, directory='tablebases', workers=1, chunks=64):
+    # Builds one table and writes it to directory, splitting move generation over worker processes if asked
+    os.makedirs(directory, exist_ok=True)
+    if name == 'KPK':
+        missing = [table for table in PROMOTION_TABLES.values() if not os.path.exists(tablePath(directory, table))]
+        if missing: raise ValueError(f'KPK needs {", ".join(missing)} generated first')
+
+    bounds = [(TABLE_SIZE * i // chunks, TABLE_SIZE * (i + 1) // chunks) for i in range(chunks)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(successorChunk, [name] * chunks, *zip(*bounds), [directory] * chunks))
+    else:
+        results = [successorChunk(name, start, stop, directory) for (start, stop) in bounds]
+
+    degrees = np.frombuffer(b''.join(result[0] for result in results), np.uint8)
+    checks = np.frombuffer(b''.join(result[1] for result in results), np.uint8)
+    targets = np.frombuffer(b''.join(result[2] for result in results), np.uint32).astype(np.int64)
+    values = solve(degrees, checks, targets)
+
+    with open(tablePath(directory, name) + '.tmp', 'wb') as table_file:
+        table_file.write(HEADER + values.tobytes())
+    os.replace(tablePath(directory, name) + '.tmp', tablePath(directory, name))
+    return values
+
+
+def describe(value):
+    if value is None: return 'not in the tablebases'
+    if value == 0: return 'draw'
+    if value > 0: return f'win, mate in {value} plies'
+    return f'loss, mated in {-value - 1} plies'
+
+def main():
+    args = parseArgs()
+    if args.command == 'generate':
+        for name in (args.table or TABLES):
+            start_time = time.perf_counter()
+            values = generateTable(name, args.dir, args.workers)
+            print(f'{name}: {np.count_nonzero(values > 0)} wins, {np.count_nonzero(values < 0)} losses, '
+                  f'longest mate {int(values.max())} plies, {time.perf_counter() - start_time:.1f}s')
+        return 0
+
+    tablebase = Tablebase(args.dir)
+    board = ChessBoard()
+    board.setFEN(args.fen)
+    print(describe(tablebase.probe(board)))
+    move = tablebase.bestMove(board)
+    if move is not None:
+        from ChessNotation import moveToSAN
+        print(f'best move {moveToSAN(board, move)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
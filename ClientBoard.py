@@ -4,6 +4,7 @@
 
 import sys
 import socket
+import struct
 import threading
 import argparse
 
@@ -11,73 +12,97 @@ import pygame
 from pygame.locals import *
 import numpy as np
 
+from ChessBoard import ChessBoard, toPos, toSquare
+from ChessProtocol import *
+from ChessSprites import SPRITES
+from PygameChessBoard import BoardSurface
+
+
+# Posted from the network thread to wake the event loop when the board or highlights change
+BOARD_CHANGED = pygame.USEREVENT + 1
+
 
 def parseArgs():
     parser = argparse.ArgumentParser(description="Client instance of Chess")
     parser.add_argument('host', default='127.0.0.1', type=str, help='Server host ip (default: localhost)')
     parser.add_argument('port', default=8080, type=int, help='Server port (default: 8080)')
+    parser.add_argument('--name', default=None, type=str, help='player name your rating is kept under (default: play unrated)')
+    parser.add_argument('--spectate', default=None, type=int, help='watch the game with this id instead of playing')
 
     return parser.parse_args()
 
 
 class ClientPygameRenderer():
 
-    def __init__(self, host, port):
-        self.host, self.port = host, port
+    def __init__(self, host, port, name=None, spectate=None):
+        self.host, self.port, self.name, self.spectate = host, port, name, spectate
         pygame.init()
         pygame.font.init()
 
         self.board_size = (400, 400)
         self.canvas = pygame.display.set_mode((self.board_size[0]+100, self.board_size[1]+100))
         pygame.display.set_caption('Pygame Chess')
-        icon_surface = pygame.image.load('images/Chess_-6.png')
-        pygame.display.set_icon(icon_surface)
-
-        self.clock = pygame.time.Clock()
+        pygame.display.set_icon(SPRITES.icon())
 
         self.setupGame()
 
+        # The network thread posts BOARD_CHANGED, so the loop only wakes for clicks, server messages and repaints
+        pygame.event.set_blocked(MOUSEMOTION)
+        self.canvas.fill((230, 230, 230))
+        pygame.display.update()
+
         while True:
-            self.update()
+            self.draw()
+            for event in [pygame.event.wait()] + pygame.event.get():
+                self.handleEvent(event)
+
+    def handleEvent(self, event):
+        if event.type == QUIT:
+            pygame.quit()
+            self.board_object.disconnect()
+            sys.exit()
+        elif event.type == MOUSEBUTTONUP:
+            (x, y) = event.pos
+            if 50 <= x < 450 and 50 <= y < 450:
+                self.board_object.handleClick((x-50, y-50))
+        elif event.type == VIDEOEXPOSE:
             pygame.display.update()
-            self.clock.tick(60)
-
-    def update(self):
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                self.board_object.disconnect()
-                sys.exit()
-            elif event.type == MOUSEBUTTONUP:
-                (x, y) = event.pos
-                if 50 <= x < 450 and 50 <= y < 450:
-                    self.board_object.handleClick((x-50, y-50))
 
-        self.canvas.fill((230, 230, 230))
-        self.canvas.blit(self.board_object.render(), (50, 50))
+    def draw(self):
+        dirty = []
+        for rect in self.board_object.render():
+            dirty.append(self.canvas.blit(self.board_object.surface, rect.move(50, 50), rect))
+        if dirty: pygame.display.update(dirty)
 
     
     def setupGame(self):
-        self.board_object = ClientBoard(self.host, self.port)
+        self.board_object = ClientBoard(self.host, self.port, self.name, self.spectate)
 
 
 
 
 class ClientBoard():
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, name=None, spectate=None):
 
+        self.address = (host, port)
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((host, port))
+        self.client_socket.connect(self.address)
+        self.client_socket.sendall(helloFrame(name=name) if spectate is None else spectateFrame(spectate))
+        self.reader = FrameReader()
         self.is_active = True
         self.game_is_active = False
-        self.images = self.createImages()
         self.setupGame()
         self.size = 400
         self.square_size = self.size // 8
+        self.images = SPRITES.pieces(self.square_size)
+        self.board_surface = BoardSurface(self.square_size, self.images)
+        self.surface = self.board_surface.surface
 
         self.team = None
         self.turn = 1
+        # Given by the server to take the seat back if the connection drops
+        self.token = None
 
 
         handler_thread = threading.Thread(target=self.handleConnection)
@@ -85,88 +110,115 @@ class ClientBoard():
 
     def handleConnection(self):
         while self.is_active:
-            msg = self.client_socket.recv(512).decode()
-            if self.game_is_active: self.handleMsg(msg)
-            if 'ENTERING' in msg: self.startGame(msg); print('Match Starting')
-            
+            try:
+                data = self.client_socket.recv(4096)
+            except OSError:
+                data = b''
+            if not data:
+                if self.reconnect(): continue
+                break
+            for (msg_type, payload) in self.reader.feed(data):
+                self.handleMsg(msg_type, payload)
+            self.notifyRenderer()
+
+    def reconnect(self):
+        # Resumes the seat on a new connection when the old one drops mid-game, if the server issued a session token
+        if not self.is_active or not self.game_is_active or self.token is None: return False
+        try:
+            self.client_socket = socket.create_connection(self.address, timeout=5)
+            self.client_socket.settimeout(None)
+            self.client_socket.sendall(resumeFrame(self.token))
+        except OSError:
+            return False
+        print('Connection lost, resuming the game')
+        self.reader = FrameReader()
+        return True
+
+    def notifyRenderer(self):
+        try:
+            pygame.event.post(pygame.event.Event(BOARD_CHANGED))
+        except pygame.error:
+            # The window has already been closed
+            pass
 
     def disconnect(self):
         print('disconnecting')
-        self.sendMsg('!DISCONNECT')
+        self.sendMsg(DISCONNECT)
         self.is_active = False
         self.client_socket.shutdown(socket.SHUT_RDWR)
 
-    def startGame(self, msg):
-        self.team = int(msg.encode()[-2:])
+    def startGame(self, team):
+        self.team = team
         self.game_is_active = True
 
-    def handleMsg(self, msg):
-        if '&' in msg: sub_reqs = msg.split('&')
-        else: sub_reqs = [msg]
-
-        for sub_req in sub_reqs:
-            item = sub_req.split(':')
-            if item[0] == 'BOARD':
-                num_list = [int(num) for num in item[1].split(' ')]
-                new_board = np.reshape(num_list, (8, 8))
-                self.board = new_board
-            elif item[0] == 'POS_MOVES_LIST':
-                if item[1] != '':
-                    str_moves = item[1].split(' ')
-                    self.possible_moves = [tuple([int(i) for i in str_pos.split(',')]) for str_pos in str_moves]
-                else: self.possible_moves = []
-            elif item[0] == 'MOVE_MADE':
-                str_moves = item[1].split(' ')
-                self.previous_moves = [tuple([int(i) for i in str_pos.split(',')]) for str_pos in str_moves]
-                self.possible_moves = []
-                self.turn *= -1
+    def handleMsg(self, msg_type, payload):
+        if msg_type == GAME_START:
+            (game_id, team) = struct.unpack('>Ib', payload)
+            self.startGame(team); print('Match Starting')
+        elif msg_type == SYNC:
+            self.ply = struct.unpack('>H', payload[:2])[0]
+            self.chess_board.unpack(payload[2:])
+            self.updateBoard()
+        elif msg_type == MOVE_MADE:
+            ply = struct.unpack('>H', payload[:2])[0]
+            # Already covered by a full position that overtook it
+            if ply <= self.ply: return
+            if ply != self.ply + 1:
+                # A delta was missed, so ask for the whole position again
+                self.sendMsg(SYNC_REQUEST)
+                return
+            move = decodeMove(payload[2:])
+            self.chess_board.makeMove(move)
+            self.ply = ply
+            self.previous_moves = [move.startPos, move.endPos]
+            self.possible_moves = []
+            self.updateBoard()
+        elif msg_type == SESSION:
+            self.token = payload
+        elif msg_type == LEGAL_MOVES:
+            self.legal_moves = parseLegalMoves(payload)
+        elif msg_type == POS_MOVES_LIST:
+            if payload and toPos(payload[0]) == self.selected_piece:
+                self.possible_moves = [toPos(square) for square in payload[1:]]
+        elif msg_type == RESULT:
+            if not payload[0]: self.turn = self.chess_board.turn
+        elif msg_type == GAME_OVER:
+            (score, reason) = parseGameOver(payload)
+            print(f'Game over: {RESULT_TEXT[score]} by {reason}')
+            self.game_is_active = False
+            self.turn = None
+        elif msg_type == DISCONNECT:
+            self.is_active = False
+
+    def updateBoard(self):
+        self.board = self.chess_board.getBoardValues()
+        if self.game_is_active: self.turn = self.chess_board.turn
             
         
-    def sendMsg(self, data):
-        if isinstance(data, dict):
-            data = '&'.join(key+':'+val for key, val in data.items())
-        self.client_socket.send(data.encode())
+    def sendMsg(self, msg_type, payload=b''):
+        self.client_socket.sendall(encodeFrame(msg_type, payload))
 
     def setupGame(self):
 
+        self.chess_board = ChessBoard()
+        self.ply = 0
         self.board = np.zeros((8, 8), int)
         self.turn = 1
         self.selected_piece = None
         self.previous_moves = []
         self.possible_moves = []
-
-    def createImages(self):
-        images = {}
-        for i in range(1, 7):
-            images[i] = pygame.image.load(f'Images/Chess_{i}.png')
-            images[-i] = pygame.image.load(f'Images/Chess_{-i}.png')
-        
-        return images
+        # Legal moves pushed with the position as (ply, {start: [ends]}), older servers leave it empty
+        self.legal_moves = (None, {})
 
     def render(self):
-        game_surface = pygame.Surface((self.size,)*2)
-        get_color = lambda x, y: [(222, 188, 153), (106, 78, 66)][int((x+y)%2 == 0)]
-
-        for y in range(len(self.board)):
-            for x in range(len(self.board[0])):
-                board_pos = (x*self.square_size, y*self.square_size)
-                col = get_color(x, y)
-                if (x, y) in self.previous_moves: col = (col[0]//1.5, col[1]//1.5, col[2])
-                if (x, y) in self.possible_moves: col = (col[0]//2, col[1], col[2]//2)
-                pygame.draw.rect(game_surface, col, pygame.Rect(*board_pos, self.square_size, self.square_size))
-
-                item = self.board[y][x]
-                if item != 0:
-                    game_surface.blit(self.images[item], (x*self.square_size+(self.square_size/2 - 30), y*self.square_size+(self.square_size/2 - 30)))
-
-        return game_surface
+        # Brings self.surface up to date and returns the rects that changed
+        return self.board_surface.draw(self.board.ravel().tolist(), self.previous_moves, self.possible_moves)
 
     def handleClick(self, pos):
         if self.turn != self.team: return
         (x, y) = new_pos = (pos[0]// 50, pos[1] // 50)
         if new_pos in self.possible_moves:
-            send_msg = {'MAKE_MOVE' : ','.join(str(i) for i in self.selected_piece)+' '+','.join(str(i) for i in new_pos)}
-            self.sendMsg(send_msg)
+            self.client_socket.sendall(makeMoveFrame(toSquare(self.selected_piece), toSquare(new_pos)))
             self.turn *= -1
             self.previous_moves = [self.selected_piece, new_pos]
             self.possible_moves = []
@@ -175,12 +227,16 @@ class ClientBoard():
             self.possible_moves = []
             self.selected_piece = None
         if self.board[y][x] != 0 and self.board[y][x] / abs(self.board[y][x]) == self.team:
-            send_msg = {'POSSIBLE_MOVES' : ','.join(str(i) for i in new_pos)}
             self.selected_piece = (x, y)
-            self.sendMsg(send_msg)
+            (ply, moves) = self.legal_moves
+            if ply == self.ply:
+                # Highlight straight away from the moves that came with the position
+                self.possible_moves = [toPos(square) for square in moves.get(toSquare(new_pos), [])]
+            else:
+                self.sendMsg(POSSIBLE_MOVES, bytes([toSquare(new_pos)]))
 
         
 
 if __name__ == '__main__':
     args = parseArgs()
-    game = ClientPygameRenderer(args.host, args.port)
+    game = ClientPygameRenderer(args.host, args.port, args.name, args.spectate)
@@ -3,53 +3,117 @@
 # PygameChess.py
 
 import sys
-import numpy
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
 import pygame
 from pygame.locals import *
 
 from ChessBoard import ChessBoard
-from ClientBoard import ClientBoard
+from ChessSprites import SPRITES
 from PygameChessBoard import PygameChessBoard
 
+
+# Posted from the engine thread to wake the event loop when a search finishes
+ENGINE_DONE = pygame.USEREVENT
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Local game of Chess")
+    parser.add_argument('--computer', choices=['white', 'black'], help='let the computer play this side')
+    parser.add_argument('--think-time', default=1000, type=int, help='computer thinking time per move in ms (default: 1000)')
+    parser.add_argument('--workers', default=1, type=int, help='processes the computer searches with (default: 1)')
+    parser.add_argument('--tablebases', default=None, type=str, help='directory of endgame tables the computer plays solved endgames from')
+    parser.add_argument('--book', default=None, type=str, help='opening book file the computer plays from before it starts searching')
+
+    return parser.parse_args()
+
+
 class PygameChess:
 
-    def __init__(self):
+    def __init__(self, computer_team=None, think_time=1000, workers=1, book=None, tablebases=None):
+        self.computer_team, self.think_time = computer_team, think_time
+        self.book = None
+        if computer_team and book:
+            from ChessBook import OpeningBook
+            self.book = OpeningBook(book)
+        self.engine = None
+        if computer_team and workers > 1:
+            # Only multi-process search needs multiprocessing and the perft positions loaded
+            from ChessParallelSearch import ParallelSearch
+            self.engine = ParallelSearch(workers, tablebases=tablebases)
+        elif computer_team:
+            # The engine brings numpy with its evaluation, which a game between two people never needs
+            from ChessEngine import ChessEngine
+            tablebase = None
+            if tablebases:
+                from ChessTablebase import Tablebase
+                tablebase = Tablebase(tablebases)
+            self.engine = ChessEngine(tablebase=tablebase)
+        self.engine_executor = ThreadPoolExecutor(max_workers=1)
+        self.engine_future = None
+
         pygame.init()
         pygame.font.init()
 
         self.board_size = (400, 400)
         self.canvas = pygame.display.set_mode((self.board_size[0]+100, self.board_size[1]+100))
         pygame.display.set_caption('Pygame Chess')
-        icon_surface = pygame.image.load('images/Chess_-6.png')
-        pygame.display.set_icon(icon_surface)
-
-        self.clock = pygame.time.Clock()
+        pygame.display.set_icon(SPRITES.icon())
 
         self.setupGame()
 
+        # Nothing is drawn between events: the loop sleeps in event.wait until a click, a finished search or the window needing a repaint
+        pygame.event.set_blocked(MOUSEMOTION)
+        self.canvas.fill((230, 230, 230))
+        pygame.display.update()
+
         while True:
-            self.update()
+            self.updateComputer()
+            self.draw()
+            for event in [pygame.event.wait()] + pygame.event.get():
+                self.handleEvent(event)
+
+    def handleEvent(self, event):
+        if event.type == QUIT:
+            pygame.quit()
+            sys.exit()
+        elif event.type == MOUSEBUTTONUP:
+            (x, y) = event.pos
+            if 50 <= x < 450 and 50 <= y < 450:
+                self.board_object.handleClick((x-50, y-50))
+        elif event.type == VIDEOEXPOSE:
             pygame.display.update()
-            self.clock.tick(60)
-
-    def update(self):
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == MOUSEBUTTONUP:
-                (x, y) = event.pos
-                if 50 <= x < 450 and 50 <= y < 450:
-                    self.board_object.handleClick((x-50, y-50))
 
-        self.canvas.fill((230, 230, 230))
-        self.canvas.blit(self.board_object.render(), (50, 50))
+    def draw(self):
+        dirty = []
+        for rect in self.board_object.render():
+            dirty.append(self.canvas.blit(self.board_object.surface, rect.move(50, 50), rect))
+        if dirty: pygame.display.update(dirty)
+
+    
+    def updateComputer(self):
+        # The search runs on a worker thread so the window keeps drawing while the computer thinks
+        if self.engine is None or self.board_object.turn != self.computer_team: return
+
+        if self.engine_future is None:
+            move = self.book.chooseMove(self.board_object.chess_board) if self.book is not None else None
+            if move is not None:
+                self.board_object.applyMove(move)
+                return
+            self.engine_future = self.engine_executor.submit(self.engine.bestMove, self.board_object.chess_board, self.think_time)
+            self.engine_future.add_done_callback(lambda future: pygame.event.post(pygame.event.Event(ENGINE_DONE)))
+        elif self.engine_future.done():
+            move = self.engine_future.result()
+            self.engine_future = None
+            if move is not None: self.board_object.applyMove(move)
 
     
     def setupGame(self):
-        self.board_object = PygameChessBoard(ChessBoard(), self.board_size[0])
+        human_teams = [team for team in (1, -1) if team != self.computer_team]
+        self.board_object = PygameChessBoard(ChessBoard(), self.board_size[0], human_teams)
 
 
 
 if __name__ == '__main__':
-    game = PygameChess()
\ No newline at end of file
+    args = parseArgs()
+    game = PygameChess(computer_team={'white': 1, 'black': -1}.get(args.computer), think_time=args.think_time, workers=args.workers, book=args.book, tablebases=args.tablebases)
\ No newline at end of file
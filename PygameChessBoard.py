@@ -2,19 +2,75 @@
 # Pygame Chess Project
 # PygameChessBoard.py
 
-import numpy
 import pygame
 
-from ChessBoard import ChessBoard
+from ChessBoard import ChessBoard, toPos
+from ChessSprites import SPRITES
+
+
+LIGHT_SQUARE, DARK_SQUARE = (222, 188, 153), (106, 78, 66)
+
+
+def squareColor(pos, previous=False, possible=False):
+    col = [LIGHT_SQUARE, DARK_SQUARE][int((pos[0]+pos[1])%2 == 0)]
+    if previous: col = (int(col[0]//1.5), int(col[1]//1.5), col[2])
+    if possible: col = (col[0]//2, col[1], col[2]//2)
+    return col
+
+
+class BoardSurface:
+
+    # The board as last drawn, kept between frames over a pre-rendered background of plain squares.
+    # draw() repaints only the squares whose piece or highlight changed since the previous call and returns their rects.
+
+    def __init__(self, square_size, images=None):
+        self.square_size = square_size
+        self.size = square_size * 8
+        self.images = SPRITES.pieces(square_size) if images is None else images
+        self.background = pygame.Surface((self.size,)*2)
+        for square in range(64):
+            self.background.fill(squareColor(toPos(square)), self.squareRect(square))
+        self.surface = self.background.copy()
+        self.invalidate()
+
+    def squareRect(self, square):
+        (x, y) = toPos(square)
+        return pygame.Rect(x*self.square_size, y*self.square_size, self.square_size, self.square_size)
+
+    def invalidate(self):
+        self.drawn = [None] * 64
+
+    def draw(self, pieces, previous_moves, possible_moves):
+        # pieces holds the 64 piece values from rank 8 down, as in ChessBoard.squares
+        dirty = []
+        for (square, value) in enumerate(pieces):
+            pos = toPos(square)
+            state = (value, pos in previous_moves, pos in possible_moves)
+            if state == self.drawn[square]: continue
+            self.drawn[square] = state
+
+            rect = self.squareRect(square)
+            if state[1] or state[2]:
+                self.surface.fill(squareColor(pos, state[1], state[2]), rect)
+            else:
+                self.surface.blit(self.background, rect, rect)
+            if value != 0:
+                self.surface.blit(self.images[value], rect)
+            dirty.append(rect)
+        return dirty
+
 
 class PygameChessBoard:
 
-    def __init__(self, board:ChessBoard, side_len):
+    def __init__(self, board:ChessBoard, side_len, human_teams=(1, -1)):
         self.chess_board = board
+        self.human_teams = human_teams
         self.square_size = side_len // 8
         self.size = self.square_size * 8
 
-        self.images = self.createImages()
+        self.images = SPRITES.pieces(self.square_size)
+        self.board_surface = BoardSurface(self.square_size, self.images)
+        self.surface = self.board_surface.surface
 
         self.turn = 1
         self.selected_piece = None
@@ -22,33 +78,19 @@ class PygameChessBoard:
         self.previous_moves = []
 
     def render(self):
-        game_surface = pygame.Surface((self.size,)*2)
-        get_color = lambda x, y: [(222, 188, 153), (106, 78, 66)][int((x+y)%2 == 0)]
-
-        for y in range(len(self.chess_board.board)):
-            for x in range(len(self.chess_board.board[0])):
-                board_pos = (x*self.square_size, y*self.square_size)
-                col = get_color(x, y)
-                if (x, y) in self.previous_moves: col = (col[0]//1.5, col[1]//1.5, col[2])
-                if (x, y) in self.possible_moves: col = (col[0]//2, col[1], col[2]//2)
-                pygame.draw.rect(game_surface, col, pygame.Rect(*board_pos, self.square_size, self.square_size))
-
-                item = self.chess_board.board[y][x]
-                if item != 0:
-                    game_surface.blit(self.images[item.value], (x*self.square_size+(self.square_size/2 - 30), y*self.square_size+(self.square_size/2 - 30)))
+        # Brings self.surface up to date and returns the rects that changed
+        return self.board_surface.draw(self.chess_board.squares, self.previous_moves, self.possible_moves)
 
-        return game_surface
 
-
-    def createImages(self):
-        images = {}
-        for i in range(1, 7):
-            images[i] = pygame.image.load(f'Images/Chess_{i}.png')
-            images[-i] = pygame.image.load(f'Images/Chess_{-i}.png')
-        
-        return images
+    def applyMove(self, move):
+        self.chess_board.makeMove(move)
+        self.possible_moves = []
+        self.previous_moves = [move.startPos, move.endPos]
+        self.selected_piece = None
+        self.turn *= -1
 
     def handleClick(self, pos):
+        if self.turn not in self.human_teams: return
         grid_pos = (pos[0] // self.square_size, pos[1] // self.square_size)
 
         if grid_pos in self.possible_moves:
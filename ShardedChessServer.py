@@ -0,0 +1,294 @@
+# Jack O'Connor
+# Pygame Chess Project
+# ShardedChessServer.py
+
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ChessBook import OpeningBook
+from ChessJournal import GameStore, readIndex
+from ChessMatchmaking import Matchmaker, Ratings
+from ChessMetrics import METRICS, serveMetrics
+from ChessProtocol import *
+from ChessServer import (BotPlayer, ChessGamesObject, ChessServer, ClientThread, SpectatorThread, log, logMatch, pruneClients,
+                         recordResult, registerGauges)
+from ChessTablebase import Tablebase
+
+
+# A worker that misses heartbeats for this many seconds is restarted like one that died
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 5.0
+
+
+def runShard(shard, control, options):
+    # Worker process: owns the games sent to it and serves their players with ClientThreads.
+    # With metrics on, each worker serves its own at the acceptor's metrics port + 1 + shard.
+    # Results go back over the control socket, since the acceptor keeps the ratings.
+    logging.basicConfig(level=options['log_level'], format=f'%(asctime)s %(levelname)s [shard {shard}] %(message)s')
+    store = GameStore(options['data_dir'], options['fsync_interval'] / 1000, shard=shard)
+    def reportResult(game_id, names, outcome):
+        try:
+            control.send(json.dumps({'result': [game_id, names, *outcome]}).encode())
+        except OSError:
+            pass
+    bot_executor = ThreadPoolExecutor(max_workers=options['bot_threads'])
+    # Every worker maps the same book and table files, so the page cache holds one copy for all of them
+    book = OpeningBook(options['book']) if options['book'] else None
+    tablebase = Tablebase(options['tablebases']) if options['tablebases'] else None
+    startBot = lambda game_id, team: BotPlayer(chess_games, game_id, team, bot_executor, options['bot_time'], book, tablebase)
+    chess_games = ChessGamesObject(games={}, move_cache_size=options['move_cache_size'], store=store, on_finish=reportResult,
+                                   idle_timeout=options['idle_timeout'], max_resident=options['max_resident_games'], bot_factory=startBot)
+    clients = []
+
+    if options['metrics_port']:
+        METRICS.gauge('active_connections', lambda: sum(client.active for client in clients), 'open client connections')
+        METRICS.gauge('active_games', lambda: len(chess_games.games), 'games held in memory')
+        serveMetrics(options['metrics_port'] + 1 + shard)
+
+    def stop(signum, frame):
+        for client in clients:
+            if client.active: client.endConnection()
+        store.close()
+        os._exit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    def heartbeat():
+        while True:
+            status = {'games': len(chess_games.games), 'clients': sum(client.active for client in clients)}
+            try:
+                control.send(json.dumps(status).encode())
+            except OSError:
+                os._exit(1)
+            time.sleep(HEARTBEAT_INTERVAL)
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    while True:
+        (data, fds, flags, address) = socket.recv_fds(control, 4096, 2)
+        if not data: break
+        game = json.loads(data)
+
+        if game.get('spectate') is not None:
+            watchGame(chess_games, game, fds[0], clients)
+            continue
+        if game.get('resume') is not None:
+            resumeGame(chess_games, game, fds[0], clients)
+            continue
+        chess_games.createGame(game['game_id'], None, None, {int(team): name for (team, name) in game['names'].items()}, game['bot_team'])
+        if game['bot_team'] is not None: startBot(game['game_id'], game['bot_team'])
+        pruneClients(clients)
+        for ((team, version, buffered), fd) in zip(game['players'], fds):
+            player_socket = clientSocket(fd)
+            reader = FrameReader()
+            reader.buffer += bytes.fromhex(buffered)
+            clients.append(ClientThread(player_socket, player_socket.getpeername(), chess_games, game['game_id'], team, version, reader))
+    stop(None, None)
+
+
+def clientSocket(fd):
+    # Handed-off sockets send small frames straight away too, see ChessServer.listenForClients
+    client_socket = socket.socket(fileno=fd)
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client_socket
+
+
+def watchGame(chess_games, game, fd, clients):
+    (team, version, buffered) = game['players'][0]
+    spectator_socket = clientSocket(fd)
+    if chess_games.getGame(game['spectate']) is None:
+        spectator_socket.sendall(encodeFrame(DISCONNECT) if version else b'!DISCONNECT')
+        spectator_socket.close()
+        return
+    reader = FrameReader()
+    reader.buffer += bytes.fromhex(buffered)
+    spectator_socket.sendall(enteringMsg(version, game['spectate'], 0))
+    clients.append(SpectatorThread(spectator_socket, spectator_socket.getpeername(), chess_games, game['spectate'], version, reader))
+
+
+def resumeGame(chess_games, game, fd, clients):
+    (team, version, buffered) = game['players'][0]
+    player_socket = clientSocket(fd)
+    seat = chess_games.resumeSeat(bytes.fromhex(game['resume']))
+    if seat is None:
+        player_socket.sendall(encodeFrame(DISCONNECT))
+        player_socket.close()
+        return
+    (game_id, team) = seat
+    reader = FrameReader()
+    reader.buffer += bytes.fromhex(buffered)
+    log.info(f'[RESUME] {player_socket.getpeername()[0]} back in game {game_id} as team {team}')
+    player_socket.sendall(enteringMsg(version, game_id, team))
+    pruneClients(clients)
+    clients.append(ClientThread(player_socket, player_socket.getpeername(), chess_games, game_id, team, version, reader, board_delay=0))
+
+
+class Shard:
+
+    # The acceptor's handle on one worker process and the health it last reported.
+    # on_result(game_id, names, outcome) is called with the results of the worker's finished games.
+
+    def __init__(self, index, options, on_result=None):
+        self.index, self.options = index, options
+        self.on_result = on_result
+        self.restarts = -1
+        self.process = None
+        self.start()
+
+    def start(self):
+        (self.control, worker_control) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        # Spawned rather than forked so a worker never inherits other workers' pipes or client sockets
+        self.process = multiprocessing.get_context('spawn').Process(target=runShard, args=(self.index, worker_control, self.options), daemon=True)
+        self.process.start()
+        worker_control.close()
+        self.restarts += 1
+        self.status, self.last_heartbeat = {'games': 0, 'clients': 0}, time.monotonic()
+        threading.Thread(target=self.readHeartbeats, args=(self.control,), daemon=True).start()
+
+    def readHeartbeats(self, control):
+        while True:
+            try:
+                data = control.recv(4096)
+            except OSError:
+                return
+            if not data: return
+            message = json.loads(data)
+            if 'result' in message:
+                (game_id, names, score, reason) = message['result']
+                if self.on_result is not None: self.on_result(game_id, {int(team): name for (team, name) in names.items()}, (score, reason))
+                continue
+            self.status, self.last_heartbeat = message, time.monotonic()
+
+    def healthy(self):
+        return self.process.is_alive() and time.monotonic() - self.last_heartbeat < HEARTBEAT_TIMEOUT
+
+    def restart(self):
+        log.warning(f'[SHARD] Restarting shard {self.index} (pid {self.process.pid})')
+        self.stop()
+        self.start()
+
+    def stop(self):
+        # SIGTERM lets the worker flush its journal and disconnect its players first
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(2.0)
+            if self.process.is_alive(): self.process.kill()
+        self.process.join()
+        self.control.close()
+
+    def handOff(self, game, sockets):
+        socket.send_fds(self.control, [json.dumps(game).encode()], [s.fileno() for s in sockets])
+
+    def info(self):
+        return {'pid': self.process.pid, 'healthy': self.healthy(), 'restarts': self.restarts,
+                'heartbeat_age': round(time.monotonic() - self.last_heartbeat, 2), **self.status}
+
+
+class ShardedChessServer(ChessServer):
+
+    # Accepts and pairs every client in one process, then passes each game's sockets to the worker owning game_id % shards.
+    # The shard map and worker health are written to shards.json in the data directory.
+
+    def __init__(self, host, port, max_conns, move_cache_size=10000, bot_wait=0, bot_time=500, bot_threads=2, hello_timeout=0.5,
+                 data_dir='saved_games', fsync_interval=50, shards=None, metrics_port=0, book=None, tablebases=None, idle_timeout=300,
+                 max_resident_games=0):
+        # Not calling ChessServer.__init__, the acceptor holds no games of its own
+        self.host, self.port, self.max_conns = host, port, max_conns
+        self.bot_wait = bot_wait
+        self.hello_timeout = hello_timeout
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+
+        statuses = readIndex(data_dir)
+        log.info(f'Starting with {len(statuses)} saved games')
+        self.next_game_id = max(statuses, default=-1) + 1
+        options = {'data_dir': data_dir, 'fsync_interval': fsync_interval, 'move_cache_size': move_cache_size,
+                   'bot_threads': bot_threads, 'bot_time': bot_time, 'metrics_port': metrics_port, 'book': book,
+                   'tablebases': tablebases, 'idle_timeout': idle_timeout, 'max_resident_games': max_resident_games,
+                   'log_level': logging.getLogger().getEffectiveLevel()}
+        self.ratings = Ratings(os.path.join(data_dir, 'ratings.json'))
+        self.shards = [Shard(i, options, lambda *result: recordResult(self.ratings, *result)) for i in range(shards or os.cpu_count())]
+        self.shard_lock = threading.Lock()
+        self.clients = []
+        self.matchmaker = Matchmaker(self.pairPlayers, self.pairWithBot, bot_wait, self.evictPlayer)
+        threading.Thread(target=self.monitorShards, daemon=True).start()
+        registerGauges(self)
+        for (name, key) in [('shard_healthy', 'healthy'), ('shard_games', 'games'), ('shard_clients', 'clients'), ('shard_restarts', 'restarts')]:
+            METRICS.gauge(name, lambda key=key: {(('shard', shard.index),): int(shard.info()[key]) for shard in self.shards})
+        if metrics_port:
+            serveMetrics(metrics_port)
+            log.info(f'Serving metrics on 127.0.0.1 at port {metrics_port}, shards from port {metrics_port + 1}')
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind((self.host, self.port))
+        self.listenForClients()
+
+
+    def close(self):
+        self.server.close()
+        with self.shard_lock:
+            for shard in self.shards: shard.stop()
+
+    def startSpectating(self, game_id, player):
+        (spectator_socket, address, version, reader) = player
+        game = {'spectate': game_id, 'players': [(0, version, bytes(reader.buffer).hex() if reader else '')]}
+        self.handOff(game_id, game, [spectator_socket])
+        spectator_socket.close()
+
+    def resumeGame(self, token, player):
+        # The token starts with the game id, which says which worker holds the seat
+        (player_socket, address, version, reader) = player
+        game_id = SESSION_TOKEN.unpack(token)[0] if len(token) == SESSION_TOKEN.size else 0
+        game = {'resume': token.hex(), 'players': [(0, version, bytes(reader.buffer).hex() if reader else '')]}
+        self.handOff(game_id, game, [player_socket])
+        player_socket.close()
+
+    def startGame(self, tickets, bot_team=None):
+        with self.shard_lock:
+            game_id = self.next_game_id
+            self.next_game_id += 1
+        players = [(team, ticket.player) for (team, ticket) in tickets]
+        names = {team: ticket.name for (team, ticket) in tickets}
+        game = {'game_id': game_id, 'bot_team': bot_team, 'names': names,
+                'players': [(team, version, bytes(reader.buffer).hex() if reader else '') for (team, (s, a, version, reader)) in players]}
+        sockets = [player_socket for (team, (player_socket, a, v, r)) in players]
+        logMatch(game_id, tickets, self.matchmaker)
+        for (team, (player_socket, player_address, version, reader)) in players:
+            player_socket.sendall(enteringMsg(version, game_id, team))
+
+        shard = self.handOff(game_id, game, sockets)
+        log.info(f'[SHARD] Game {game_id} to shard {shard.index}')
+
+        # The worker has its own copies of the sockets now
+        for player_socket in sockets: player_socket.close()
+
+    def handOff(self, game_id, game, sockets):
+        with self.shard_lock:
+            shard = self.shards[game_id % len(self.shards)]
+            try:
+                shard.handOff(game, sockets)
+            except OSError:
+                shard.restart()
+                shard.handOff(game, sockets)
+        return shard
+
+    def monitorShards(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            # Matchmaker stats first, so the shard lock is never held while waiting for the matchmaker's
+            matchmaking = self.matchmaker.stats()
+            with self.shard_lock:
+                for shard in self.shards:
+                    if not shard.healthy(): shard.restart()
+                shard_map = {'shards': len(self.shards), 'next_game_id': self.next_game_id, 'matchmaking': matchmaking,
+                             'workers': {shard.index: shard.info() for shard in self.shards}}
+
+            path = os.path.join(self.data_dir, 'shards.json')
+            with open(path + '.tmp', 'w') as f:
+                json.dump(shard_map, f, indent=2)
+            os.replace(path + '.tmp', path)